@@ -0,0 +1,668 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN DataStore Restful Extension.
+
+# CKAN DataStore Restful Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN DataStore Restful Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN DataStore Restful Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import ckan.plugins as plugins
+import ckan.lib.navl.dictization_functions as dictization_functions
+import ckanext.datastore.logic.action as datastore_action
+import ckanext.datastore.logic.schema as datastore_schema
+import ckanext.datastore_restful.advisor as advisor
+import ckanext.datastore_restful.db as db
+import ckanext.datastore_restful.export as export
+import ckanext.datastore_restful.query as query
+import ckanext.datastore_restful.stats as stats
+import ckanext.datastore_restful.webhooks as webhooks
+
+# Field that identifies the entries of the resources managed by the restful API
+IDENTIFIER = 'pk'
+
+
+@plugins.toolkit.side_effect_free
+def datastore_restful_metrics(context, data_dict):
+    '''Returns the counters collected by the restful layer in this process:
+    requests, datastore actions and SQL statements per restful action'''
+
+    plugins.toolkit.check_access('datastore_restful_metrics', context, data_dict)
+
+    return {'metrics': stats.metrics()}
+
+
+@plugins.toolkit.side_effect_free
+def datastore_restful_search(context, data_dict):
+    '''Searches a DataStore resource like datastore_search does, but the
+    total number of matching records is only computed when it is needed.
+    Accepts the same parameters than datastore_search, whose filters can
+    also be dicts of operators (eq, ne, gt, gte, lt, lte, in, between and
+    null), e.g. {'age': {'gte': 18}}, and:
+
+    :param count: how the total is computed: 'exact' (default), 'estimated'
+        from the planner statistics or 'none' to skip it. No records are
+        returned when the limit is 0
+    :type count: string
+    :param layout: 'records' (default) returns a dict per record, 'arrays'
+        a list of values per record and 'columns' a list of values per field.
+        In both cases the fields are only listed once
+    :type layout: string
+    '''
+
+    data_dict = dict(data_dict)
+    count = data_dict.pop('count', db.COUNT_EXACT)
+    if count not in db.COUNT_MODES:
+        raise plugins.toolkit.ValidationError({
+            'count': ['Count must be one of: %s' % ', '.join(db.COUNT_MODES)]
+        })
+
+    layout = data_dict.pop('layout', db.LAYOUT_RECORDS)
+    if layout not in db.LAYOUTS:
+        raise plugins.toolkit.ValidationError({
+            'layout': ['Layout must be one of: %s' % ', '.join(db.LAYOUTS)]
+        })
+
+    schema = context.get('schema', datastore_schema.datastore_search_schema())
+    data_dict, errors = dictization_functions.validate(data_dict, schema, context)
+    if errors:
+        raise plugins.toolkit.ValidationError(errors)
+
+    data_dict['resource_id'] = db.resolve_resource(data_dict['resource_id'])
+
+    plugins.toolkit.check_access('datastore_search', context, data_dict)
+
+    return db.search(data_dict, count, layout)
+
+
+def _aggregate_schema():
+    schema = datastore_schema.datastore_search_schema()
+    del schema['fields']
+    for key in ['group_by'] + query.AGGREGATES:
+        schema[key] = [datastore_schema.ignore_missing, datastore_schema.list_of_strings_or_string]
+    return schema
+
+
+@plugins.toolkit.side_effect_free
+def datastore_restful_aggregate(context, data_dict):
+    '''Groups the records of a DataStore resource that match the filters and
+    the full text search (as in datastore_search) and computes the aggregates
+    of each group in a single query.
+
+    :param group_by: the fields used to group the records (optional)
+    :type group_by: list or comma separated string
+    :param count: the fields whose non null values are counted, '*' counts
+        the records of each group (optional)
+    :type count: list or comma separated string
+    :param sum: the fields that are added up (optional)
+    :type sum: list or comma separated string
+    :param avg: the fields that are averaged (optional)
+    :type avg: list or comma separated string
+    :param min: the fields whose minimum is returned (optional)
+    :type min: list or comma separated string
+    :param max: the fields whose maximum is returned (optional)
+    :type max: list or comma separated string
+    :param sort: the returned columns (group_by fields or aggregates, e.g.
+        'sum_price desc') used to sort the groups (optional)
+    :type sort: string
+    '''
+
+    schema = context.get('schema', _aggregate_schema())
+    data_dict, errors = dictization_functions.validate(data_dict, schema, context)
+    if errors:
+        raise plugins.toolkit.ValidationError(errors)
+
+    data_dict['resource_id'] = db.resolve_resource(data_dict['resource_id'])
+
+    plugins.toolkit.check_access('datastore_search', context, data_dict)
+
+    return db.aggregate(data_dict)
+
+
+def _downsample_schema():
+    schema = _aggregate_schema()
+    del schema['group_by']
+    schema['time'] = [datastore_schema.not_missing, datastore_schema.not_empty, unicode]
+    schema['interval'] = [datastore_schema.ignore_missing, unicode]
+    schema['value'] = [datastore_schema.ignore_missing, unicode]
+    schema['points'] = [datastore_schema.ignore_missing, datastore_schema.int_validator]
+    return schema
+
+
+@plugins.toolkit.side_effect_free
+def datastore_restful_downsample(context, data_dict):
+    '''Returns the series of a timestamp field of a DataStore resource, with
+    the records that match the filters and the full text search (as in
+    datastore_search), grouped in buckets of the given interval and/or
+    reduced to a number of points that keep the shape of the series
+    (Largest-Triangle-Three-Buckets).
+
+    :param time: the timestamp field
+    :type time: string
+    :param interval: the width of the buckets: a calendar unit (second,
+        minute, hour, day, week, month, quarter or year) or a fixed interval
+        (ex: '15 minutes'). The aggregates of each bucket are computed as in
+        datastore_restful_aggregate (default: count '*') (optional)
+    :type interval: string
+    :param points: the number of points returned, at least 3 (optional)
+    :type points: int
+    :param value: the field (or the aggregate when an interval is given, ex:
+        'avg_temperature') used as the y coordinate of the points, required
+        when points is given
+    :type value: string
+    '''
+
+    schema = context.get('schema', _downsample_schema())
+    data_dict, errors = dictization_functions.validate(data_dict, schema, context)
+    if errors:
+        raise plugins.toolkit.ValidationError(errors)
+
+    if not data_dict.get('interval') and not data_dict.get('points'):
+        raise plugins.toolkit.ValidationError({
+            'interval': ['An interval or a number of points is required']
+        })
+
+    if 'points' in data_dict and (data_dict['points'] < 3 or not data_dict.get('value')):
+        raise plugins.toolkit.ValidationError({
+            'points': ['At least 3 points and a value field are required to reduce the series']
+        })
+
+    data_dict['resource_id'] = db.resolve_resource(data_dict['resource_id'])
+
+    plugins.toolkit.check_access('datastore_search', context, data_dict)
+
+    return db.downsample(data_dict)
+
+
+@plugins.toolkit.side_effect_free
+def datastore_restful_search_sql(context, data_dict):
+    '''Executes a read-only SQL statement once its estimated cost has been
+    checked against the configured limits. When params are given, values
+    are bound through native placeholders ($1, $2...) and the template is
+    prepared once per database session and reused by later requests with
+    the same shape.
+
+    :param sql: a single SQL select statement
+    :type sql: string
+    :param params: the values bound to the placeholders of the statement (optional)
+    :type params: list of strings, numbers, booleans or nulls
+    '''
+
+    sql = plugins.toolkit.get_or_bust(data_dict, 'sql')
+    params = data_dict.get('params')
+
+    if params is not None and not isinstance(params, list) or \
+            any(p is not None and not isinstance(p, (basestring, int, long, float, bool)) for p in params or []):
+        raise plugins.toolkit.ValidationError({
+            'params': ['Params must be a list of strings, numbers, booleans or nulls']
+        })
+
+    if not db.is_single_statement(sql):
+        raise plugins.toolkit.ValidationError({
+            'query': ['Query is not a single statement.']
+        })
+
+    plugins.toolkit.check_access('datastore_search_sql', context, data_dict)
+
+    if params is None:
+        return db.execute_sql(sql)
+    else:
+        return db.execute_prepared(sql, params)
+
+
+@plugins.toolkit.side_effect_free
+def datastore_restful_stream_sql(context, data_dict):
+    '''Executes a read-only SQL statement whose records are fetched in
+    batches from a server-side cursor while they are being serialized. The
+    number of records is limited by ckanext.datastore_restful.stream_max_rows
+
+    :param sql: a single SQL select statement
+    :type sql: string
+    '''
+
+    sql = plugins.toolkit.get_or_bust(data_dict, 'sql')
+
+    if not db.is_single_statement(sql):
+        raise plugins.toolkit.ValidationError({
+            'query': ['Query is not a single statement.']
+        })
+
+    plugins.toolkit.check_access('datastore_search_sql', context, data_dict)
+
+    return {'records': db.stream_sql(sql)}
+
+
+def datastore_restful_upsert_resource(context, data_dict):
+    '''Creates a DataStore resource or adds fields to it through
+    datastore_create, whose parameters are accepted, and starts tracking the
+    changes of its records.
+    '''
+
+    result = plugins.toolkit.get_action('datastore_create')(context, data_dict)
+    db.track_changes(result['resource_id'], IDENTIFIER)
+    return result
+
+
+def datastore_restful_delete_resource(context, data_dict):
+    '''Deletes a DataStore resource, its webhooks, its reserved identifiers
+    and the tombstones of its deleted records in a single transaction.
+
+    :param resource_id: the resource
+    :type resource_id: string
+    :param force: set to True to edit a read-only resource (default: False)
+    :type force: bool
+    '''
+
+    resource_id = plugins.toolkit.get_or_bust(data_dict, 'resource_id')
+
+    plugins.toolkit.check_access('datastore_delete', context, data_dict)
+
+    if not plugins.toolkit.asbool(data_dict.get('force', False)):
+        datastore_action._check_read_only(context, data_dict)
+
+    db.delete_resource(resource_id, [webhooks.WEBHOOKS_TABLE])
+    return {'resource_id': resource_id}
+
+
+def datastore_restful_track_changes(context, data_dict):
+    '''Starts tracking the changes of the records of a DataStore resource not
+    created through the restful API. Its existing records are returned as
+    changes, and the table is rewritten to number them.
+
+    :param resource_id: the resource
+    :type resource_id: string
+    '''
+
+    resource_id = db.resolve_resource(plugins.toolkit.get_or_bust(data_dict, 'resource_id'))
+
+    plugins.toolkit.check_access('datastore_create', context, {'resource_id': resource_id})
+
+    db.track_changes(resource_id, IDENTIFIER)
+    return {'resource_id': data_dict['resource_id']}
+
+
+def _changes_schema():
+    return {
+        'resource_id': [datastore_schema.not_missing, datastore_schema.not_empty, unicode],
+        'since': [datastore_schema.ignore_missing, datastore_schema.int_validator],
+        'limit': [datastore_schema.ignore_missing, datastore_schema.int_validator],
+        '__junk': [datastore_schema.empty]
+    }
+
+
+@plugins.toolkit.side_effect_free
+def datastore_restful_changes(context, data_dict):
+    '''Returns the records of a DataStore resource inserted or updated after
+    a version, and the 'pk' of the records deleted after it, sorted by the
+    version of the change ('_version'). Deleted records are flagged with
+    '_deleted'. The version of the last change returned is 'next', to be
+    used as 'since' in the following request while there are 'more' changes.
+
+    :param since: the last version already known (default: 0)
+    :type since: int
+    :param limit: the maximum number of changes returned (default: 1000)
+    :type limit: int
+    '''
+
+    schema = context.get('schema', _changes_schema())
+    data_dict, errors = dictization_functions.validate(data_dict, schema, context)
+    if errors:
+        raise plugins.toolkit.ValidationError(errors)
+
+    since = data_dict.get('since', 0)
+    limit = data_dict.get('limit', 1000)
+    if since < 0 or limit < 1:
+        raise plugins.toolkit.ValidationError({
+            'since': ['The version and the limit must be positive numbers']
+        })
+
+    data_dict['resource_id'] = db.resolve_resource(data_dict['resource_id'])
+
+    plugins.toolkit.check_access('datastore_search', context, data_dict)
+
+    return db.changes(data_dict['resource_id'], IDENTIFIER, since, limit)
+
+
+def _export_schema():
+    return {
+        'resource_id': [datastore_schema.not_missing, datastore_schema.not_empty, unicode],
+        'format': [datastore_schema.ignore_missing, unicode],
+        '__junk': [datastore_schema.empty]
+    }
+
+
+@plugins.toolkit.side_effect_free
+def datastore_restful_export(context, data_dict):
+    '''Returns the newest export of all the records of a DataStore resource
+    ('export_version', None if there is none yet) and whether it is older
+    than the current version of the resource ('stale'). Exports are
+    compressed files generated in the background, so the previous one is
+    returned until the export of the current version is ready.
+
+    :param format: the format of the export: csv or json (default: csv)
+    :type format: string
+    '''
+
+    schema = context.get('schema', _export_schema())
+    data_dict, errors = dictization_functions.validate(data_dict, schema, context)
+    if errors:
+        raise plugins.toolkit.ValidationError(errors)
+
+    fmt = data_dict.get('format', export.FORMATS[0])
+    if fmt not in export.FORMATS:
+        raise plugins.toolkit.ValidationError({
+            'format': ['Resources can only be exported as %s' % ', '.join(export.FORMATS)]
+        })
+
+    data_dict['resource_id'] = db.resolve_resource(data_dict['resource_id'])
+
+    plugins.toolkit.check_access('datastore_search', context, data_dict)
+
+    version = db.write_version(data_dict['resource_id'], IDENTIFIER)
+    result = export.get_export(data_dict['resource_id'], fmt, version, IDENTIFIER)
+    result.update({'resource_id': data_dict['resource_id'], 'format': fmt, 'version': version})
+    return result
+
+
+def datastore_restful_create_entries(context, data_dict):
+    '''Inserts records in a DataStore resource, numbering their 'pk' field
+    after the greatest one used or reserved in the resource. The identifiers
+    are reserved and the records are inserted in a single transaction.
+    When parallel ingestion is configured, lists longer than a chunk are
+    inserted in chunks, each one in its own transaction, by a pool of
+    threads: only the records of the inserted chunks are returned and the
+    result of every chunk is reported in 'chunks'.
+
+    :param resource_id: the resource
+    :type resource_id: string
+    :param records: the records, without 'pk'
+    :type records: list of dicts
+    '''
+
+    resource_id, records = plugins.toolkit.get_or_bust(data_dict, ['resource_id', 'records'])
+
+    if not isinstance(records, list) or not all(isinstance(record, dict) for record in records):
+        raise plugins.toolkit.ValidationError({
+            'records': ['Records must be a list of dicts']
+        })
+
+    if any(IDENTIFIER in record for record in records):
+        raise plugins.toolkit.ValidationError({
+            'records': ['The field \'%s\' is asigned automatically' % IDENTIFIER]
+        })
+
+    plugins.toolkit.check_access('datastore_upsert', context, {'resource_id': resource_id})
+
+    chunk_size = db.ingestion_chunks(records)
+    if chunk_size:
+        records, chunks = db.ingest_entries(resource_id, records, IDENTIFIER, chunk_size)
+        return {'resource_id': resource_id, 'records': records, 'chunks': chunks}
+
+    records = db.create_entries(resource_id, records, IDENTIFIER)
+    return {'resource_id': resource_id, 'records': records}
+
+
+def datastore_restful_upsert_entry(context, data_dict):
+    '''Inserts or updates a record of a DataStore resource by its 'pk'. The
+    record is not written again when its content has not changed since it
+    was last written by this action, what is returned as 'unchanged'.
+
+    :param resource_id: the resource
+    :type resource_id: string
+    :param records: the record, including its 'pk'
+    :type records: list with a dict
+    '''
+
+    resource_id, records = plugins.toolkit.get_or_bust(data_dict, ['resource_id', 'records'])
+
+    if not isinstance(records, list) or len(records) != 1 or not isinstance(records[0], dict) or \
+            IDENTIFIER not in records[0]:
+        raise plugins.toolkit.ValidationError({
+            'records': ['A single dict with the field \'%s\' is required' % IDENTIFIER]
+        })
+
+    plugins.toolkit.check_access('datastore_upsert', context, {'resource_id': resource_id})
+
+    written = db.upsert_entry(resource_id, IDENTIFIER, records[0])
+    return {'resource_id': resource_id, 'records': records, 'unchanged': not written}
+
+
+def datastore_restful_delete_entry(context, data_dict):
+    '''Deletes a record of a DataStore resource by its 'pk'. The record is
+    found and deleted in a single transaction.
+
+    :param resource_id: the resource
+    :type resource_id: string
+    :param pk: the identifier of the record
+    :type pk: int
+    '''
+
+    resource_id, entry_id = plugins.toolkit.get_or_bust(data_dict, ['resource_id', IDENTIFIER])
+
+    plugins.toolkit.check_access('datastore_delete', context, {'resource_id': resource_id})
+
+    if not db.delete_entry(resource_id, IDENTIFIER, entry_id):
+        raise plugins.toolkit.ObjectNotFound(plugins.toolkit._(
+            'The element %s does not exist in the resource %s' % (entry_id, resource_id)
+        ))
+
+    return {'resource_id': resource_id, IDENTIFIER: entry_id}
+
+
+def _check_index_name(name):
+    if not isinstance(name, basestring) or not db.INDEX_NAME.match(name):
+        raise plugins.toolkit.ValidationError({
+            'name': ['Index names can only contain up to 41 letters, digits and underscores']
+        })
+
+
+@plugins.toolkit.side_effect_free
+def datastore_restful_index_list(context, data_dict):
+    '''Lists the indexes of a DataStore resource with their size and usage
+    statistics.
+
+    :param resource_id: the resource
+    :type resource_id: string
+    :param name: only returns the index with this name (optional)
+    :type name: string
+    '''
+
+    resource_id = db.resolve_resource(plugins.toolkit.get_or_bust(data_dict, 'resource_id'))
+    name = data_dict.get('name')
+    if name is not None:
+        _check_index_name(name)
+
+    plugins.toolkit.check_access('datastore_search', context, {'resource_id': resource_id})
+
+    indexes = db.list_indexes(resource_id, name)
+    if name is not None and not indexes:
+        raise plugins.toolkit.ObjectNotFound(plugins.toolkit._('Index "{0}" was not found.'.format(name)))
+
+    return {'resource_id': data_dict['resource_id'], 'indexes': indexes}
+
+
+def datastore_restful_index_create(context, data_dict):
+    '''Creates or replaces an index of a DataStore resource. Indexes are
+    built concurrently, so the resource can be written meanwhile.
+
+    :param resource_id: the resource
+    :type resource_id: string
+    :param name: the name of the index
+    :type name: string
+    :param fields: the indexed fields
+    :type fields: list of strings
+    :param method: 'btree' (default) or 'gin', that indexes the text search
+        vector of the fields
+    :type method: string
+    :param unique: whether the values of the fields must be unique, only
+        for 'btree' indexes (default: false)
+    :type unique: boolean
+    :param language: the text search configuration of 'gin' indexes
+        (default: 'english')
+    :type language: string
+    '''
+
+    resource_id, name, fields = plugins.toolkit.get_or_bust(data_dict, ['resource_id', 'name', 'fields'])
+    method = data_dict.get('method', db.INDEX_BTREE)
+    unique = plugins.toolkit.asbool(data_dict.get('unique', False))
+    language = data_dict.get('language', db.DEFAULT_INDEX_LANGUAGE)
+
+    _check_index_name(name)
+
+    if not isinstance(fields, list) or not all(isinstance(field, basestring) for field in fields):
+        raise plugins.toolkit.ValidationError({
+            'fields': ['Fields must be a list of field names']
+        })
+
+    if method not in db.INDEX_METHODS:
+        raise plugins.toolkit.ValidationError({
+            'method': ['Method must be one of: %s' % ', '.join(db.INDEX_METHODS)]
+        })
+
+    if unique and method != db.INDEX_BTREE:
+        raise plugins.toolkit.ValidationError({
+            'unique': ['Only btree indexes can be unique']
+        })
+
+    resource_id = db.resolve_resource(resource_id)
+
+    plugins.toolkit.check_access('datastore_create', context, {'resource_id': resource_id})
+
+    index = db.create_index(resource_id, name, fields, method, unique, language)
+    return {'resource_id': data_dict['resource_id'], 'index': index}
+
+
+def datastore_restful_index_delete(context, data_dict):
+    '''Drops an index created through datastore_restful_index_create
+
+    :param resource_id: the resource
+    :type resource_id: string
+    :param name: the name of the index
+    :type name: string
+    '''
+
+    resource_id, name = plugins.toolkit.get_or_bust(data_dict, ['resource_id', 'name'])
+    _check_index_name(name)
+
+    resource_id = db.resolve_resource(resource_id)
+
+    plugins.toolkit.check_access('datastore_create', context, {'resource_id': resource_id})
+
+    db.drop_index(resource_id, name)
+    return {'resource_id': data_dict['resource_id'], 'name': name}
+
+
+def _check_webhook_name(name):
+    if not isinstance(name, basestring) or not webhooks.WEBHOOK_NAME.match(name):
+        raise plugins.toolkit.ValidationError({
+            'name': ['Webhook names can only contain up to 41 letters, digits and underscores']
+        })
+
+
+@plugins.toolkit.side_effect_free
+def datastore_restful_webhook_list(context, data_dict):
+    '''Lists the webhooks subscribed to the changes of a DataStore resource.
+    Only the users that can update the resource can read them.
+
+    :param resource_id: the resource
+    :type resource_id: string
+    :param name: only returns the webhook with this name (optional)
+    :type name: string
+    '''
+
+    resource_id = db.resolve_resource(plugins.toolkit.get_or_bust(data_dict, 'resource_id'))
+    name = data_dict.get('name')
+    if name is not None:
+        _check_webhook_name(name)
+
+    plugins.toolkit.check_access('datastore_create', context, {'resource_id': resource_id})
+
+    subscriptions = webhooks.list_webhooks(resource_id, name)
+    if name is not None and not subscriptions:
+        raise plugins.toolkit.ObjectNotFound(plugins.toolkit._('Webhook "{0}" was not found.'.format(name)))
+
+    return {'resource_id': data_dict['resource_id'], 'webhooks': subscriptions}
+
+
+def datastore_restful_webhook_create(context, data_dict):
+    '''Subscribes (or replaces) a webhook to the changes of a DataStore
+    resource. The events of the writes made through the restful API are
+    POSTed to the URL in batches, as a JSON object with the resource_id,
+    the name of the webhook and the list of events (action, timestamp and
+    the pks of the written entries, when they are known).
+
+    :param resource_id: the resource
+    :type resource_id: string
+    :param name: the name of the webhook
+    :type name: string
+    :param url: the http or https URL that receives the events
+    :type url: string
+    '''
+
+    resource_id, name, url = plugins.toolkit.get_or_bust(data_dict, ['resource_id', 'name', 'url'])
+    _check_webhook_name(name)
+    webhooks.check_url(url)
+
+    resource_id = db.resolve_resource(resource_id)
+
+    plugins.toolkit.check_access('datastore_create', context, {'resource_id': resource_id})
+
+    webhook = webhooks.create_webhook(resource_id, name, url)
+    return {'resource_id': data_dict['resource_id'], 'webhook': webhook}
+
+
+def datastore_restful_webhook_delete(context, data_dict):
+    '''Removes a webhook of a DataStore resource
+
+    :param resource_id: the resource
+    :type resource_id: string
+    :param name: the name of the webhook
+    :type name: string
+    '''
+
+    resource_id, name = plugins.toolkit.get_or_bust(data_dict, ['resource_id', 'name'])
+    _check_webhook_name(name)
+
+    resource_id = db.resolve_resource(resource_id)
+
+    plugins.toolkit.check_access('datastore_create', context, {'resource_id': resource_id})
+
+    webhooks.delete_webhook(resource_id, name)
+    return {'resource_id': data_dict['resource_id'], 'name': name}
+
+
+@plugins.toolkit.side_effect_free
+def datastore_restful_advisor(context, data_dict):
+    '''Recommends the indexes that would speed up the most frequent and
+    expensive searches received by the resources.
+
+    :param resource_id: only returns the recommendations of this resource (optional)
+    :type resource_id: string
+    '''
+
+    plugins.toolkit.check_access('datastore_restful_advisor', context, data_dict)
+
+    return {'recommendations': advisor.recommend(data_dict.get('resource_id'))}
+
+
+def datastore_restful_advisor_apply(context, data_dict):
+    '''Creates the recommended indexes that are within the configured size
+    limits for the resources that are still being scanned sequentially.
+
+    :param resource_id: only creates the indexes of this resource (optional)
+    :type resource_id: string
+    '''
+
+    plugins.toolkit.check_access('datastore_restful_advisor_apply', context, data_dict)
+
+    return {'recommendations': advisor.apply(advisor.recommend(data_dict.get('resource_id')))}
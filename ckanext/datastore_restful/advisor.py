@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN DataStore Restful Extension.
+
+# CKAN DataStore Restful Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN DataStore Restful Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN DataStore Restful Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+import ckan.plugins as plugins
+import ckanext.datastore_restful.db as db
+import ckanext.datastore_restful.stats as stats
+
+from collections import OrderedDict
+from pylons import config
+from sqlalchemy.exc import DBAPIError
+
+log = logging.getLogger(__name__)
+
+# Recommends the indexes of the resources from the filters and the sort
+# fields of the searches they receive. Shapes are aggregated in memory by
+# each process and saved periodically by a background thread, so all the
+# processes (and the paster command) share the same workload
+
+ADVISOR_FLUSH_INTERVAL = 'ckanext.datastore_restful.advisor_flush_interval'
+DEFAULT_ADVISOR_FLUSH_INTERVAL = 60         # seconds
+ADVISOR_MIN_REQUESTS = 'ckanext.datastore_restful.advisor_min_requests'
+DEFAULT_ADVISOR_MIN_REQUESTS = 100
+ADVISOR_MIN_ROWS = 'ckanext.datastore_restful.advisor_min_rows'
+DEFAULT_ADVISOR_MIN_ROWS = 10000
+ADVISOR_MAX_INDEX_SIZE = 'ckanext.datastore_restful.advisor_max_index_size'
+DEFAULT_ADVISOR_MAX_INDEX_SIZE = 100 * 1024 * 1024      # bytes
+
+STATUS_RECOMMENDED = 'recommended'
+STATUS_CREATED = 'created'
+STATUS_TOO_LARGE = 'too_large'
+STATUS_FAILED = 'failed'
+
+_WORKLOAD_TABLE = '_restful_workload'
+
+# Bytes used by each index entry in addition to its values (tuple header and
+# item pointer) and the fill factor of the B-tree leaf pages
+_ENTRY_OVERHEAD = 12
+_FILL_FACTOR = 0.9
+_DEFAULT_WIDTH = 8
+
+_flush_lock = threading.Lock()
+_flusher_lock = threading.Lock()
+_flusher_pid = [None]
+
+
+###############################################################################################
+#########################################  AUXILIAR  ##########################################
+###############################################################################################
+
+def _save_workload(workload):
+    connection = db.get_engine(write=True).connect()
+
+    try:
+        trans = connection.begin()
+        try:
+            for (resource_id, filters, sort), (requests, elapsed) in workload.items():
+                key = (resource_id, json.dumps(list(filters)), json.dumps(list(sort)))
+                updated = connection.execute(
+                    u'UPDATE "{0}" SET requests = requests + %s, elapsed = elapsed + %s, last_seen = now() '
+                    u'WHERE resource_id = %s AND filters = %s AND sort = %s'.format(_WORKLOAD_TABLE),
+                    (requests, elapsed) + key)
+                if not updated.rowcount:
+                    connection.execute(u'INSERT INTO "{0}" VALUES (%s, %s, %s, %s, %s, now())'.format(_WORKLOAD_TABLE),
+                                       key + (requests, elapsed))
+            trans.commit()
+        except Exception:
+            trans.rollback()
+            raise
+    finally:
+        connection.close()
+
+
+def _load_workload(connection, resource_id=None):
+    sql = u'SELECT resource_id, filters, sort, requests, elapsed FROM "{0}"'.format(_WORKLOAD_TABLE)
+    if resource_id is None:
+        results = connection.execute(sql)
+    else:
+        results = connection.execute(sql + u' WHERE resource_id = %s', resource_id)
+    return [(row[0], json.loads(row[1]), json.loads(row[2]), row[3], row[4]) for row in results]
+
+
+def _table_stats(connection, resource_id):
+    return connection.execute(u'''SELECT c.reltuples::bigint, coalesce(s.seq_scan, 0), coalesce(s.idx_scan, 0)
+        FROM pg_class c LEFT JOIN pg_stat_user_tables s ON s.relid = c.oid
+        WHERE c.oid = %s::regclass''', db._regclass(resource_id)).fetchone()
+
+
+def _field_widths(connection, resource_id):
+    return dict(connection.execute(u'SELECT attname, avg_width FROM pg_stats '
+                                   u'WHERE schemaname = current_schema() AND tablename = %s', resource_id).fetchall())
+
+
+def _unquote(field):
+    if field.startswith('"') and field.endswith('"'):
+        return field[1:-1].replace('""', '"')
+    return field
+
+
+def _covered(indexes, filters, sort):
+    # Equality filters can be checked in any order, but the index has to
+    # be sorted by the sort fields after them
+    for index in indexes:
+        if not index['valid'] or index['method'] != db.INDEX_BTREE:
+            continue
+
+        fields = [_unquote(field) for field in index['fields']]
+        if index['unique'] and fields and set(fields) <= set(filters):
+            return True     # At most one entry matches
+        if sorted(fields[:len(filters)]) == sorted(filters) and fields[len(filters):len(filters) + len(sort)] == sort:
+            return True
+
+    return False
+
+
+def _index_name(fields):
+    name = u'auto_' + u'_'.join(re.sub(r'[^A-Za-z0-9_]', '_', field) for field in fields)
+    if not db.INDEX_NAME.match(name):
+        name = u'auto_' + hashlib.md5(json.dumps(fields)).hexdigest()[:12]
+    return name
+
+
+def _estimate_size(rows, fields, widths):
+    width = sum(widths.get(field, _DEFAULT_WIDTH) for field in fields)
+    return int(rows * (width + _ENTRY_OVERHEAD) / _FILL_FACTOR)
+
+
+def _recommend_resource(connection, resource_id, shapes):
+    min_requests = int(config.get(ADVISOR_MIN_REQUESTS, DEFAULT_ADVISOR_MIN_REQUESTS))
+    min_rows = int(config.get(ADVISOR_MIN_ROWS, DEFAULT_ADVISOR_MIN_ROWS))
+
+    hot_shapes = [shape for shape in shapes if shape[3] >= min_requests and (shape[1] or shape[2])]
+    if not hot_shapes:
+        return []
+
+    try:
+        table = db.resolve_resource(resource_id)
+    except plugins.toolkit.ObjectNotFound:
+        return []
+
+    rows, seq_scans, idx_scans = _table_stats(connection, table)
+    if rows < min_rows:
+        return []       # Scanning small tables is cheaper than using an index
+
+    field_ids = db._get_field_ids(connection, table)
+    widths = _field_widths(connection, table)
+    indexes = db.list_indexes(table)
+    recommendations = OrderedDict()
+
+    for _, filters, sort, requests, elapsed in hot_shapes:
+        if not set(filters + sort) <= set(field_ids) or _covered(indexes, filters, sort):
+            continue
+
+        fields = filters + [field for field in sort if field not in filters]
+        name = _index_name(fields)
+
+        # Shapes that lead to the same index are merged
+        if name in recommendations:
+            recommendation = recommendations[name]
+            recommendation['requests'] += requests
+            recommendation['elapsed'] = round(recommendation['elapsed'] + elapsed, 3)
+            recommendation['mean'] = round(recommendation['elapsed'] / recommendation['requests'], 3)
+            continue
+
+        recommendation = OrderedDict()
+        recommendation['resource_id'] = resource_id
+        recommendation['name'] = name
+        recommendation['fields'] = fields
+        recommendation['requests'] = requests
+        recommendation['elapsed'] = round(elapsed, 3)
+        recommendation['mean'] = round(elapsed / requests, 3)
+        recommendation['rows'] = rows
+        recommendation['seq_scans'] = seq_scans
+        recommendation['idx_scans'] = idx_scans
+        recommendation['estimated_size'] = _estimate_size(rows, fields, widths)
+        recommendation['status'] = STATUS_RECOMMENDED
+        recommendations[name] = recommendation
+
+    return recommendations.values()
+
+
+def _run(interval):
+    while True:
+        time.sleep(interval)
+        flush_workload()
+
+
+###############################################################################################
+###########################################  MAIN  ############################################
+###############################################################################################
+
+def create_workload_table():
+    '''Creates the table of the saved shapes, if it does not exist. Called
+    once, when the plugin is configured.'''
+    db.create_table(_WORKLOAD_TABLE, u'''CREATE TABLE IF NOT EXISTS "{0}" (
+        resource_id text NOT NULL,
+        filters text NOT NULL,
+        sort text NOT NULL,
+        requests bigint NOT NULL,
+        elapsed double precision NOT NULL,
+        last_seen timestamp NOT NULL,
+        PRIMARY KEY (resource_id, filters, sort))'''.format(_WORKLOAD_TABLE))
+
+
+def start_flusher():
+    '''Starts the thread that saves the shapes recorded by this process every
+    advisor_flush_interval seconds, unless it is already running. Requests
+    never wait for the shapes to be saved.'''
+
+    interval = float(config.get(ADVISOR_FLUSH_INTERVAL, DEFAULT_ADVISOR_FLUSH_INTERVAL))
+    if not interval or _flusher_pid[0] == os.getpid():
+        return
+
+    # Threads are not inherited by the processes forked by the server
+    with _flusher_lock:
+        if _flusher_pid[0] != os.getpid():
+            _flusher_pid[0] = os.getpid()
+            flusher = threading.Thread(target=_run, args=(interval,), name='datastore_restful-advisor')
+            flusher.daemon = True
+            flusher.start()
+
+
+def flush_workload():
+    '''Saves the shapes recorded by this process. Errors are logged, and the
+    shapes that could not be saved are discarded.'''
+
+    with _flush_lock:
+        try:
+            workload = stats.pop_workload()
+            if workload:
+                _save_workload(workload)
+        except Exception:
+            log.exception('Unable to save the query shapes of the index advisor')
+
+
+def recommend(resource_id=None):
+    '''Returns the indexes that would speed up the searches of the resources
+    that have received at least advisor_min_requests requests with the same
+    filters and sort fields. Shapes already covered by a B-tree index and
+    small tables are skipped. Recommendations are sorted by the time spent
+    by their searches.'''
+
+    flush_workload()
+
+    shapes = {}
+    connection = db.get_engine(write=True).connect()
+
+    try:
+        with db.translate_errors():
+            trans = connection.begin()
+            try:
+                for shape in _load_workload(connection, resource_id):
+                    shapes.setdefault(shape[0], []).append(shape)
+
+                recommendations = []
+                for shape_resource_id in sorted(shapes):
+                    recommendations.extend(_recommend_resource(connection, shape_resource_id,
+                                                               shapes[shape_resource_id]))
+                trans.commit()
+            except Exception:
+                trans.rollback()
+                raise
+    finally:
+        connection.close()
+
+    return sorted(recommendations, key=lambda recommendation: recommendation['elapsed'], reverse=True)
+
+
+def apply(recommendations):
+    '''Creates the recommended indexes whose estimated size is within
+    advisor_max_index_size for the resources whose tables are still being
+    scanned sequentially. The status of each recommendation is updated.'''
+
+    max_size = int(config.get(ADVISOR_MAX_INDEX_SIZE, DEFAULT_ADVISOR_MAX_INDEX_SIZE))
+    min_requests = int(config.get(ADVISOR_MIN_REQUESTS, DEFAULT_ADVISOR_MIN_REQUESTS))
+
+    for recommendation in recommendations:
+        if recommendation['seq_scans'] < min_requests:
+            continue
+        elif recommendation['estimated_size'] > max_size:
+            recommendation['status'] = STATUS_TOO_LARGE
+            continue
+
+        try:
+            db.create_index(db.resolve_resource(recommendation['resource_id']), recommendation['name'],
+                            recommendation['fields'])
+            recommendation['status'] = STATUS_CREATED
+            stats.increment('advisor.created')
+        except (plugins.toolkit.ValidationError, plugins.toolkit.ObjectNotFound, DBAPIError):
+            log.exception('Unable to create the index %s', recommendation['name'])
+            recommendation['status'] = STATUS_FAILED
+
+    return recommendations
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN DataStore Restful Extension.
+
+# CKAN DataStore Restful Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN DataStore Restful Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN DataStore Restful Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+
+def datastore_restful_metrics(context, data_dict):
+    # Only sysadmins can read the metrics
+    return {'success': False}
+
+
+def datastore_restful_advisor(context, data_dict):
+    # Only sysadmins can read the recommendations
+    return {'success': False}
+
+
+def datastore_restful_advisor_apply(context, data_dict):
+    # Only sysadmins can create the recommended indexes
+    return {'success': False}
@@ -0,0 +1,560 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN DataStore Restful Extension.
+
+# CKAN DataStore Restful Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN DataStore Restful Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN DataStore Restful Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import contextlib
+import fcntl
+import hashlib
+import json
+import logging
+import mmap
+import os
+import random
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+import urlparse
+
+import ckanext.datastore_restful.stats as stats
+
+from collections import OrderedDict
+from pylons import config
+
+log = logging.getLogger(__name__)
+
+# Serialized responses are cached, so the most read entries and the most
+# repeated searches do not hit the database. Cached responses are scoped by
+# generations of the resource that are increased when it is written through
+# the API, so invalidating a resource does not have to find its keys: every
+# write increases the generations of both the searches and the entries, and
+# the responses under older generations are never read again until they are
+# evicted or expire.
+# Responses and generations are kept by a backend: the memory of the process,
+# a segment of shared memory for the workers of a host or a Redis server for
+# the workers of several hosts
+
+ENTRIES = 'entries'
+SEARCHES = 'searches'
+
+BACKEND_MEMORY = 'memory'
+BACKEND_MMAP = 'mmap'
+BACKEND_REDIS = 'redis'
+
+CACHE_BACKEND = 'ckanext.datastore_restful.cache_backend'
+DEFAULT_CACHE_BACKEND = BACKEND_MEMORY
+CACHE_URL = 'ckanext.datastore_restful.cache_url'
+DEFAULT_REDIS_URL = 'redis://localhost:6379/0'
+DEFAULT_MMAP_URL = os.path.join(tempfile.gettempdir(), 'ckanext_datastore_restful')
+ENTRY_CACHE_SIZE = 'ckanext.datastore_restful.entry_cache_size'
+DEFAULT_ENTRY_CACHE_SIZE = 0                # bytes
+ENTRY_CACHE_TTL = 'ckanext.datastore_restful.entry_cache_ttl'
+DEFAULT_ENTRY_CACHE_TTL = 60                # seconds
+SEARCH_CACHE_SIZE = 'ckanext.datastore_restful.search_cache_size'
+DEFAULT_SEARCH_CACHE_SIZE = 0               # bytes
+SEARCH_CACHE_TTL = 'ckanext.datastore_restful.search_cache_ttl'
+DEFAULT_SEARCH_CACHE_TTL = 10               # seconds
+
+CACHES = {
+    ENTRIES: (ENTRY_CACHE_SIZE, DEFAULT_ENTRY_CACHE_SIZE, ENTRY_CACHE_TTL, DEFAULT_ENTRY_CACHE_TTL),
+    SEARCHES: (SEARCH_CACHE_SIZE, DEFAULT_SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL, DEFAULT_SEARCH_CACHE_TTL)
+}
+
+# Shared memory segments are split in classes of slots of different sizes.
+# Each key can only be stored in WAYS slots of its class
+MMAP_MAGIC = 'RESTFUL1'
+MMAP_SLOT_SIZES = [1024, 8 * 1024, 64 * 1024, 512 * 1024]
+MMAP_WAYS = 4
+MMAP_COUNTERS = 4096
+_MMAP_HEADER = struct.Struct('<8sQ')
+_MMAP_COUNTER = struct.Struct('<16sq')
+_MMAP_SLOT = struct.Struct('<16sddI')
+
+REDIS_PREFIX = 'ckanext.datastore_restful:'
+REDIS_TIMEOUT = 1.0                         # seconds
+
+_lock = threading.Lock()
+_caches = {}
+
+
+###############################################################################################
+#########################################  AUXILIAR  ##########################################
+###############################################################################################
+
+def _digest(key):
+    return hashlib.md5(key).digest()
+
+
+def _serialize(response_data, headers):
+    if isinstance(response_data, unicode):
+        response_data = response_data.encode('utf-8')
+    return json.dumps(headers) + '\n' + response_data
+
+
+def _deserialize(value):
+    headers, response_data = value.split('\n', 1)
+    return response_data, dict((str(name), header) for name, header in json.loads(headers).items())
+
+
+def _get_backend(name, max_bytes):
+    backend = config.get(CACHE_BACKEND, DEFAULT_CACHE_BACKEND)
+
+    if backend == BACKEND_MEMORY:
+        return MemoryBackend(name, max_bytes)
+    elif backend == BACKEND_MMAP:
+        return MmapBackend(name, '%s.%s' % (config.get(CACHE_URL, DEFAULT_MMAP_URL), name), max_bytes)
+    elif backend == BACKEND_REDIS:
+        return RedisBackend(config.get(CACHE_URL, DEFAULT_REDIS_URL))
+    else:
+        raise CacheError('Invalid cache backend: %s' % backend)
+
+
+###############################################################################################
+###########################################  MAIN  ############################################
+###############################################################################################
+
+class CacheError(Exception):
+    pass
+
+
+class MemoryBackend(object):
+    '''Values of a single process, evicted in least recently used order once
+    their total size exceeds max_bytes. Counters are never evicted.'''
+
+    def __init__(self, name, max_bytes):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._values = OrderedDict()
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._values)
+
+    def _remove(self, key):
+        expires, value = self._values.pop(key)
+        self.bytes -= sys.getsizeof(key) + sys.getsizeof(value)
+
+    def get(self, key):
+        with self._lock:
+            cached = self._values.get(key)
+
+            if cached is not None and cached[0] is not None and cached[0] <= time.time():
+                self._remove(key)
+                stats.increment('cache.%s.expirations' % self.name)
+                cached = None
+
+            if cached is None:
+                return None
+
+            # Move the key to the end, so it is the last one to be evicted
+            del self._values[key]
+            self._values[key] = cached
+            return cached[1]
+
+    def set(self, key, value, ttl):
+        size = sys.getsizeof(key) + sys.getsizeof(value)
+
+        with self._lock:
+            if key in self._values:
+                self._remove(key)
+
+            if size > self.max_bytes:
+                return
+
+            while self.bytes + size > self.max_bytes:
+                self._remove(next(iter(self._values)))
+                stats.increment('cache.%s.evictions' % self.name)
+
+            self._values[key] = (time.time() + ttl if ttl > 0 else None, value)
+            self.bytes += size
+
+    def delete(self, keys):
+        with self._lock:
+            for key in keys:
+                if key in self._values:
+                    self._remove(key)
+
+    def incr(self, key):
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+            return self._counters[key]
+
+    def counter(self, key):
+        with self._lock:
+            return self._counters.get(key, 0)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+            self._counters.clear()
+            self.bytes = 0
+
+
+class MmapBackend(object):
+    '''Values shared by the processes of a host through a memory mapped file.
+    The file is split in classes of fixed size slots and each key can be stored
+    in MMAP_WAYS slots of the smallest class that fits its value, replacing
+    the least recently used one. Processes are synchronized with a lock of the
+    whole file.'''
+
+    def __init__(self, name, path, max_bytes):
+        self.name = name
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+        # Slots of each class (a multiple of the ways) and offset of the first one
+        self._classes = []
+        offset = _MMAP_HEADER.size + MMAP_COUNTERS * _MMAP_COUNTER.size
+        for slot_size in MMAP_SLOT_SIZES:
+            slots = max_bytes / len(MMAP_SLOT_SIZES) / slot_size / MMAP_WAYS * MMAP_WAYS
+            if slots:
+                self._classes.append((slot_size, slots, offset))
+                offset += slot_size * slots
+        self._size = offset
+
+        # Processes configured with other sizes use their own files, so the
+        # file is never resized while it is mapped by another process
+        self.path = '%s.%d' % (path, self._size)
+        self._open()
+
+    def _open(self):
+        self._pid = os.getpid()
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0600)
+        layout = _MMAP_HEADER.pack(MMAP_MAGIC, self._size)
+
+        # The first process that opens the file initializes it
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self._fd).st_size != self._size or os.read(self._fd, len(layout)) != layout:
+                os.ftruncate(self._fd, 0)
+                os.ftruncate(self._fd, self._size)
+                os.lseek(self._fd, 0, os.SEEK_SET)
+                os.write(self._fd, layout)
+            self._map = mmap.mmap(self._fd, self._size)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        with self._lock:
+            # Processes forked after opening the file would share its lock
+            if self._pid != os.getpid():
+                self._map.close()
+                os.close(self._fd)
+                self._open()
+
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _ways(self, digest, slot_size, slots, offset):
+        bucket = struct.unpack('<I', digest[:4])[0] % (slots / MMAP_WAYS)
+        return [offset + (bucket * MMAP_WAYS + way) * slot_size for way in range(MMAP_WAYS)]
+
+    def _find(self, digest):
+        for slot_size, slots, offset in self._classes:
+            for position in self._ways(digest, slot_size, slots, offset):
+                if self._map[position:position + 16] == digest:
+                    return position
+        return None
+
+    def _clear_slot(self, position):
+        self._map[position:position + _MMAP_SLOT.size] = '\0' * _MMAP_SLOT.size
+
+    def get(self, key):
+        digest = _digest(key)
+
+        with self._locked():
+            position = self._find(digest)
+            if position is None:
+                return None
+
+            _, expires, _, length = _MMAP_SLOT.unpack_from(self._map, position)
+            now = time.time()
+            if expires and expires <= now:
+                self._clear_slot(position)
+                stats.increment('cache.%s.expirations' % self.name)
+                return None
+
+            _MMAP_SLOT.pack_into(self._map, position, digest, expires, now, length)
+            start = position + _MMAP_SLOT.size
+            return self._map[start:start + length]
+
+    def set(self, key, value, ttl):
+        digest = _digest(key)
+        length = len(value)
+        classes = [c for c in self._classes if c[0] - _MMAP_SLOT.size >= length]
+
+        with self._locked():
+            # The key may be stored in the slot of another class
+            position = self._find(digest)
+            if position is not None:
+                self._clear_slot(position)
+
+            if not classes:
+                return
+
+            # Empty and expired slots are used first, then the least recently used one
+            now = time.time()
+            candidates = []
+            for position in self._ways(digest, *classes[0]):
+                current, expires, used, _ = _MMAP_SLOT.unpack_from(self._map, position)
+                empty = current == '\0' * 16 or (expires and expires <= now)
+                candidates.append((not empty, used, position))
+            occupied, _, position = min(candidates)
+
+            if occupied:
+                stats.increment('cache.%s.evictions' % self.name)
+
+            _MMAP_SLOT.pack_into(self._map, position, digest, now + ttl if ttl > 0 else 0, now, length)
+            start = position + _MMAP_SLOT.size
+            self._map[start:start + length] = value
+
+    def delete(self, keys):
+        with self._locked():
+            for key in keys:
+                position = self._find(_digest(key))
+                if position is not None:
+                    self._clear_slot(position)
+
+    def _counter_position(self, digest):
+        '''Returns the position of the counter, or the one where it can be
+        created, and whether it exists'''
+        first = struct.unpack('<I', digest[:4])[0] % MMAP_COUNTERS
+        for probe in range(MMAP_WAYS):
+            position = _MMAP_HEADER.size + (first + probe) % MMAP_COUNTERS * _MMAP_COUNTER.size
+            current = self._map[position:position + 16]
+            if current == digest:
+                return position, True
+            elif current == '\0' * 16:
+                return position, False
+        return _MMAP_HEADER.size + first * _MMAP_COUNTER.size, False
+
+    def _read_counter(self, digest):
+        position, exists = self._counter_position(digest)
+        if exists:
+            return position, _MMAP_COUNTER.unpack_from(self._map, position)[1]
+
+        # Counters that replace others start at a random value, so the values
+        # cached with the previous ones are not read again
+        value = 0 if self._map[position:position + 16] == '\0' * 16 else random.randint(1, 2 ** 62)
+        _MMAP_COUNTER.pack_into(self._map, position, digest, value)
+        return position, value
+
+    def incr(self, key):
+        digest = _digest(key)
+        with self._locked():
+            position, value = self._read_counter(digest)
+            _MMAP_COUNTER.pack_into(self._map, position, digest, value + 1)
+            return value + 1
+
+    def counter(self, key):
+        with self._locked():
+            return self._read_counter(_digest(key))[1]
+
+    def clear(self):
+        with self._locked():
+            self._map[_MMAP_HEADER.size:self._size] = '\0' * (self._size - _MMAP_HEADER.size)
+
+
+class RedisBackend(object):
+    '''Values shared through a Redis server. Each thread uses its own
+    connection. Memory limits and evictions are managed by the server.'''
+
+    def __init__(self, url):
+        url = urlparse.urlparse(url)
+        self.host = url.hostname or 'localhost'
+        self.port = url.port or 6379
+        self.db = int(url.path.strip('/') or 0)
+        self.password = url.password
+        self._local = threading.local()
+
+    def _connect(self):
+        connection = socket.create_connection((self.host, self.port), REDIS_TIMEOUT)
+        self._local.pid = os.getpid()
+        self._local.connection = connection
+        self._local.reader = connection.makefile('rb')
+
+        if self.password:
+            self._send('AUTH', self.password)
+        if self.db:
+            self._send('SELECT', self.db)
+
+    def _disconnect(self):
+        connection = getattr(self._local, 'connection', None)
+        self._local.connection = self._local.reader = None
+        if connection is not None:
+            connection.close()
+
+    def _read_reply(self):
+        line = self._local.reader.readline()
+        if not line.endswith('\r\n'):
+            raise CacheError('Connection closed by the Redis server')
+
+        kind, data = line[0], line[1:-2]
+        if kind == '+':
+            return data
+        elif kind == '-':
+            raise CacheError(data)
+        elif kind == ':':
+            return int(data)
+        elif kind == '$':
+            if int(data) < 0:
+                return None
+            value = self._local.reader.read(int(data) + 2)
+            return value[:-2]
+        elif kind == '*':
+            return None if int(data) < 0 else [self._read_reply() for _ in range(int(data))]
+        else:
+            raise CacheError('Invalid reply of the Redis server: %r' % line)
+
+    def _send(self, *args):
+        args = [arg if isinstance(arg, str) else str(arg) for arg in args]
+        command = '*%d\r\n%s' % (len(args), ''.join('$%d\r\n%s\r\n' % (len(arg), arg) for arg in args))
+        self._local.connection.sendall(command)
+        return self._read_reply()
+
+    def _command(self, *args):
+        try:
+            # Connections opened before forking are not used by the new process
+            if getattr(self._local, 'connection', None) is None or self._local.pid != os.getpid():
+                self._connect()
+            return self._send(*args)
+        except (CacheError, EnvironmentError):
+            # Replies of broken connections cannot be trusted
+            self._disconnect()
+            raise
+
+    def get(self, key):
+        return self._command('GET', REDIS_PREFIX + key)
+
+    def set(self, key, value, ttl):
+        if ttl > 0:
+            self._command('SET', REDIS_PREFIX + key, value, 'PX', int(ttl * 1000))
+        else:
+            self._command('SET', REDIS_PREFIX + key, value)
+
+    def delete(self, keys):
+        if keys:
+            self._command('DEL', *[REDIS_PREFIX + key for key in keys])
+
+    def incr(self, key):
+        return self._command('INCR', REDIS_PREFIX + key)
+
+    def counter(self, key):
+        return int(self._command('GET', REDIS_PREFIX + key) or 0)
+
+
+class Cache(object):
+    '''Serialized responses and their headers kept by a backend. Errors of
+    the backend are logged and the responses are computed again.'''
+
+    def __init__(self, name, backend, ttl):
+        self.name = name
+        self.backend = backend
+        self.ttl = ttl
+
+    def _key(self, key):
+        return '%s:%s' % (self.name, hashlib.md5(json.dumps(key)).hexdigest())
+
+    def _generation_key(self, resource_id):
+        return '%s:generation:%s' % (self.name, hashlib.md5(resource_id.encode('utf-8')).hexdigest())
+
+    def _count(self, counter, amount=1):
+        stats.increment('cache.%s.%s' % (self.name, counter), amount)
+
+    def _failed(self, operation):
+        log.warning('Unable to %s the %s cache', operation, self.name, exc_info=True)
+        self._count('errors')
+
+    def get(self, key):
+        try:
+            value = self.backend.get(self._key(key))
+        except (CacheError, EnvironmentError):
+            self._failed('read')
+            value = None
+
+        self._count('hits' if value is not None else 'misses')
+        return _deserialize(value) if value is not None else None
+
+    def set(self, key, response_data, headers):
+        try:
+            self.backend.set(self._key(key), _serialize(response_data, headers), self.ttl)
+        except (CacheError, EnvironmentError):
+            self._failed('write')
+
+    def delete(self, keys):
+        try:
+            self.backend.delete([self._key(key) for key in keys])
+            self._count('invalidations', len(keys))
+        except (CacheError, EnvironmentError):
+            self._failed('invalidate')
+
+    def generation(self, resource_id):
+        try:
+            return self.backend.counter(self._generation_key(resource_id))
+        except (CacheError, EnvironmentError):
+            self._failed('read')
+            return None
+
+    def increase_generation(self, resource_id):
+        try:
+            self.backend.incr(self._generation_key(resource_id))
+            self._count('invalidations')
+        except (CacheError, EnvironmentError):
+            self._failed('invalidate')
+
+
+def get_cache(name):
+    '''Returns the given cache or None when it is disabled'''
+    size_option, default_size, ttl_option, default_ttl = CACHES[name]
+    max_bytes = int(config.get(size_option, default_size))
+
+    if max_bytes <= 0:
+        return None
+
+    settings = (config.get(CACHE_BACKEND, DEFAULT_CACHE_BACKEND), config.get(CACHE_URL), max_bytes,
+                float(config.get(ttl_option, default_ttl)))
+
+    with _lock:
+        if name not in _caches or _caches[name][0] != settings:
+            _caches[name] = (settings, Cache(name, _get_backend(name, max_bytes), settings[-1]))
+        return _caches[name][1]
+
+
+def generation(name, resource_id):
+    '''Returns the generation of the cached responses of a resource, or None
+    when they cannot be cached'''
+    responses = get_cache(name)
+    return responses.generation(resource_id) if responses is not None else None
+
+
+def invalidate(resource_id):
+    '''Discards the cached searches and entries of a resource. Their keys are
+    versioned by a generation, so the responses computed before the write
+    and stored after it are kept under keys that are never read again'''
+    for name in (SEARCHES, ENTRIES):
+        cache = get_cache(name)
+        if cache is not None:
+            cache.increase_generation(resource_id)
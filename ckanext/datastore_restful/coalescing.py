@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN DataStore Restful Extension.
+
+# CKAN DataStore Restful Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN DataStore Restful Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN DataStore Restful Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+
+import ckanext.datastore_restful.stats as stats
+
+from pylons import config
+
+# Identical requests received at the same time by a process wait for the
+# first one instead of sending the same query to the database
+
+COALESCE_READS = 'ckanext.datastore_restful.coalesce_reads'
+
+_lock = threading.Lock()
+_flights = {}
+
+
+###############################################################################################
+#########################################  AUXILIAR  ##########################################
+###############################################################################################
+
+class _Flight(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+###############################################################################################
+###########################################  MAIN  ############################################
+###############################################################################################
+
+def coalescing_enabled():
+    return config.get(COALESCE_READS, 'true').lower() in ('true', 'yes', 'on', '1')
+
+
+def coalesce(key, function):
+    '''Calls the function, unless it is already being called with the same
+    key by another thread. In that case, its result (or its exception) is
+    shared. Returns the result and whether the function was called.'''
+    with _lock:
+        flight = _flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _flights[key] = _Flight()
+
+    if not leader:
+        flight.done.wait()
+        stats.increment('requests.coalesced')
+        if flight.error is not None:
+            raise flight.error
+        return flight.result, False
+
+    try:
+        flight.result = function()
+        return flight.result, True
+    except Exception as e:
+        flight.error = e
+        raise
+    finally:
+        with _lock:
+            del _flights[key]
+        flight.done.set()
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN DataStore Restful Extension.
+
+# CKAN DataStore Restful Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN DataStore Restful Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN DataStore Restful Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+
+import ckan.lib.cli as cli
+import ckan.plugins as plugins
+import ckanext.datastore_restful.actions as actions
+import ckanext.datastore_restful.db as db
+import ckanext.datastore_restful.export as export
+
+from pylons import config
+
+log = logging.getLogger(__name__)
+
+
+class DatastoreRestfulCommand(cli.CkanCommand):
+    '''Recommends and creates the indexes of the DataStore resources, starts
+    tracking their changes and exports them.
+
+    Usage::
+
+        paster datastore_restful advise [RESOURCE_ID]
+        paster datastore_restful apply [RESOURCE_ID]
+        paster datastore_restful track-changes RESOURCE_ID
+        paster datastore_restful export RESOURCE_ID [FORMAT]
+
+    Where:
+        advise        lists the indexes that would speed up the most frequent
+                      and expensive searches of the resources
+        apply         creates the recommended indexes that are within the
+                      advisor_max_index_size limit for the resources that are
+                      still being scanned sequentially. It can be scheduled to
+                      keep the indexes up to date automatically.
+        track-changes starts tracking the changes of a resource not created
+                      through the restful API. Its table is rewritten, so
+                      it should be run when the resource is not being used.
+        export        writes the export of the current version of a resource
+                      (csv and json, or only FORMAT) with export_processes
+                      processes. It can be scheduled for big resources, so
+                      the server only has to serve their files.
+    '''
+    summary = __doc__.split('\n')[0]
+    usage = __doc__
+    max_args = 3
+
+    def __init__(self, name):
+
+        super(DatastoreRestfulCommand, self).__init__(name)
+
+    def command(self):
+        '''
+        Parse command line arguments and call appropriate method.
+        '''
+        if not self.args or self.args[0] in ['--help', '-h', 'help']:
+            print DatastoreRestfulCommand.__doc__
+            return
+
+        cmd = self.args[0]
+        self._load_config()
+
+        if cmd == 'advise':
+            self._advise('datastore_restful_advisor')
+        elif cmd == 'apply':
+            self._advise('datastore_restful_advisor_apply')
+        elif cmd == 'track-changes' and len(self.args) > 1:
+            self._track_changes(self.args[1])
+        elif cmd == 'export' and len(self.args) > 1:
+            self._export(self.args[1], self.args[2:] or export.FORMATS)
+        else:
+            print self.usage
+            log.error('Command "%s" not recognized' % (cmd,))
+
+    def _advise(self, action):
+        data_dict = {'resource_id': self.args[1]} if len(self.args) > 1 else {}
+        context = {'user': self.site_user['name']}
+        recommendations = plugins.toolkit.get_action(action)(context, data_dict)['recommendations']
+
+        for recommendation in recommendations:
+            print '%s\t%s\t(%s)\t%d requests\t%.1f ms\t%d bytes\t%s' % (
+                recommendation['resource_id'], recommendation['name'], ', '.join(recommendation['fields']),
+                recommendation['requests'], recommendation['elapsed'], recommendation['estimated_size'],
+                recommendation['status'])
+
+        if self.verbose:
+            print '%d indexes recommended' % len(recommendations)
+
+    def _track_changes(self, resource_id):
+        context = {'user': self.site_user['name']}
+        plugins.toolkit.get_action('datastore_restful_track_changes')(context, {'resource_id': resource_id})
+
+        if self.verbose:
+            print 'Tracking the changes of %s' % resource_id
+
+    def _export(self, resource_id, formats):
+        resource_id = db.resolve_resource(resource_id)
+        processes = int(config.get(export.EXPORT_PROCESSES, export.DEFAULT_EXPORT_PROCESSES))
+
+        for fmt in formats:
+            if fmt not in export.FORMATS:
+                log.error('Resources can only be exported as %s' % ', '.join(export.FORMATS))
+            elif not export.generate(resource_id, fmt, actions.IDENTIFIER, processes):
+                log.error('The %s export of %s is already being written' % (fmt, resource_id))
+            elif self.verbose:
+                print 'Exported %s as %s' % (resource_id, fmt)
@@ -17,14 +17,23 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with CKAN DataStore Restful Extension.  If not, see <http://www.gnu.org/licenses/>.
 
+import json
 import logging
+import re
 
 import ckan.plugins as plugins
 import ckan.lib.base as base
 import ckan.model as model
 import ckan.lib.navl.dictization_functions as dictization_functions
 import ckan.lib.search as search
+import ckanext.datastore_restful.advisor as advisor
+import ckanext.datastore_restful.cache as cache
+import ckanext.datastore_restful.coalescing as coalescing
+import ckanext.datastore_restful.db as db
+import ckanext.datastore_restful.export as export
+import ckanext.datastore_restful.stats as stats
 import ckanext.datastore_restful.utils as utils
+import ckanext.datastore_restful.webhooks as webhooks
 
 from ckan.common import _, request
 
@@ -36,6 +45,21 @@ CKAN_IDENTIFIER = '_id'
 
 RESOURCE_ID = 'resource_id'
 RECORDS = 'records'
+COLUMNS = 'columns'
+PARAMS = 'params'
+INDEX = 'index'
+AGGREGATE_PARAMETERS = ['group_by', 'sum', 'avg', 'min', 'max']
+DOWNSAMPLE_PARAMETERS = ['time', 'interval', 'points', 'value', 'sum', 'avg', 'min', 'max']
+INDEXES = 'indexes'
+WEBHOOK = 'webhook'
+WEBHOOKS = 'webhooks'
+
+TOTAL_HEADER = 'X-Total-Count'
+UNCHANGED_HEADER = 'X-Entry-Unchanged'
+CACHED_HEADERS = [TOTAL_HEADER]
+
+# Filters with operators: 'field[operator]=value'
+OPERATOR_FILTER = re.compile(r'^(.+)\[(\w+)\]$')
 
 
 class RestfulDatastoreController(base.BaseController):
@@ -67,30 +91,120 @@ class RestfulDatastoreController(base.BaseController):
             'user': plugins.toolkit.c.user
         }
 
+    def _get_logic_function(self, logic_function):
+
+        function = plugins.toolkit.get_action(logic_function)
+
+        def _counted_function(context, data_dict):
+            stats.count_action()
+            return function(context, data_dict)
+
+        return _counted_function
+
+    def _get_action_name(self):
+        return request.environ.get('pylons.routes_dict', {}).get('action')
+
     def _entry_not_found(self, resource_id, entry_id):
         return plugins.toolkit.ObjectNotFound(_('The element %s does not exist in the resource %s' % (entry_id, resource_id)))
 
-    def _execute_logic_function(self, logic_function, get_parameters, response_parser, accepted_formats=[utils.JSON, utils.XML]):
+    def _entry_id(self, entry_id):
+        try:
+            return int(entry_id)
+        except ValueError:
+            return entry_id
+
+    def _written_entries(self, result, invalidates):
+        if len(invalidates) > 1:
+            return [invalidates[1]]
+        records = result.get(RECORDS) if isinstance(result.get(RECORDS), list) else []
+        return [record[IDENTIFIER] for record in records if IDENTIFIER in record]
+
+    def _get_cached(self, context, name, key):
+        responses = cache.get_cache(name)
+        cached = responses.get(key) if responses is not None else None
+
+        # Cached responses are only returned to the users that can still read the resource
+        if cached is not None:
+            plugins.toolkit.check_access('datastore_search', context, {RESOURCE_ID: key[0]})
+
+        return cached
+
+    def _set_cached(self, name, key, response_data):
+        responses = cache.get_cache(name)
+        if responses is not None and isinstance(response_data, basestring):
+            responses.set(key, response_data, utils.get_response_headers(CACHED_HEADERS))
+
+    def _execute_logic_function(self, logic_function, get_parameters, response_parser,
+                                accepted_formats=[utils.JSON, utils.XML, utils.MSGPACK],
+                                cache_key=None, invalidates=None, coalesce=False, finish=None):
+        '''Serialized responses are cached under the (cache name, key) returned
+        by cache_key for the request data, if any. The resource (and entry)
+        in invalidates is modified by the logic function: once it has been
+        executed, unless it reports that nothing has changed, the cached
+        responses of the resource are discarded and its webhooks are
+        notified. Identical concurrent requests of the same
+        user share a single execution when coalesce is set. Responses are
+        finished by finish (finish_ok by default), unless they come from the
+        cache'''
 
         def _remove_identifier(result):
             copy = result.copy()
-            if RECORDS in copy:
+            if RECORDS in copy and isinstance(copy[RECORDS], list):
                 for record in copy[RECORDS]:
                     if '_id' in record:
                         del record['_id']
             return copy
 
         return_dict = {}
+        request_stats = stats.RequestStats(self._get_action_name(), logic_function)
 
         try:
             context = self._get_context()                            # Get Context
             content_type = utils.get_content_type(accepted_formats)  # Get return content-type
             request_data = get_parameters()                          # Get parameters
-            function = plugins.toolkit.get_action(logic_function)    # Get logic function
-            result = function(context, request_data)                 # Execute the function
-            result = _remove_identifier(result)                      # Remove _id from the results
-            response_data = response_parser(result, content_type)    # Parse the results
-            return utils.finish_ok(response_data, content_type)      # Return the response
+            request_stats.describe(request_data)
+            request_stats.phase('parameters')
+            cached_key = cache_key(request_data) if cache_key else None
+            if cached_key is not None:                               # Return the cached response
+                cache_name, key = cached_key[0], cached_key[1] + (content_type,)
+                cached = self._get_cached(context, cache_name, key)
+                if cached is not None:
+                    response_data, headers = cached
+                    utils.set_response_headers(headers)
+                    request_stats.count_bytes(response_data)
+                    request_stats.phase('cache')
+                    return utils.finish_ok(response_data, content_type)
+
+            def _execute():
+                function = self._get_logic_function(logic_function)      # Get logic function
+                result = function(context, request_data)                 # Execute the function
+                request_stats.phase('action')
+                if invalidates is not None and not result.get('unchanged'):  # Discard the modified responses
+                    cache.invalidate(invalidates[0])
+                    webhooks.notify(invalidates[0], self._get_action_name(),
+                                    self._written_entries(result, invalidates))
+                result = _remove_identifier(result)                      # Remove _id from the results
+                request_stats.count_rows(result)
+                response_data = response_parser(result, content_type)    # Parse the results
+                return response_data, utils.get_response_headers(CACHED_HEADERS)
+
+            if coalesce and coalescing.coalescing_enabled():
+                parameters = json.dumps(request_data, sort_keys=True, default=repr)
+                flight_key = (logic_function, context['user'], content_type, parameters)
+                (response_data, headers), executed = coalescing.coalesce(flight_key, _execute)
+                if not executed and not isinstance(response_data, basestring):
+                    response_data, headers = _execute()                  # Streams can only be read once
+                elif not executed:
+                    utils.set_response_headers(headers)
+                    request_stats.phase('coalesced')
+            else:
+                response_data, headers = _execute()
+
+            request_stats.count_bytes(response_data)
+            request_stats.phase('serialization')
+            if cached_key is not None:
+                self._set_cached(cache_name, key, response_data)
+            return (finish or utils.finish_ok)(response_data, content_type)  # Return the response
 
         except ValueError as e:
             return utils.finish_bad_request(e)
@@ -114,6 +228,15 @@ class RestfulDatastoreController(base.BaseController):
             # CS nasty_string ignore
             return utils.parse_and_finish(409, return_dict)
 
+        except db.QueryRejected as e:
+            return_dict['error'] = {'__type': 'Query Rejected',
+                                    'message': e.message,
+                                    'estimate': e.estimate,
+                                    'limits': e.limits}
+            if e.retry_after:
+                utils.set_response_headers({'Retry-After': e.retry_after})
+            return utils.parse_and_finish(e.status, return_dict)
+
         except search.SearchQueryError as e:
             return_dict['error'] = {'__type': 'Search Query Error',
                                     'message': 'Search Query is invalid: %r' %
@@ -137,6 +260,12 @@ class RestfulDatastoreController(base.BaseController):
                                     'message': '%s: %s' % (type(e).__name__, str(e))}
             return utils.parse_and_finish(500, return_dict)
 
+        finally:
+            request_stats.finish()
+            if stats.debug_headers_enabled():
+                utils.set_response_headers(request_stats.headers())
+            advisor.start_flusher()
+
     ###############################################################################################
     ########################################  RESOURCES  ##########################################
     ###############################################################################################
@@ -179,7 +308,8 @@ class RestfulDatastoreController(base.BaseController):
         def response_parser(result, content_type):
             return self._parse_response(result, content_type, 'fields')
 
-        return self._execute_logic_function('datastore_create', get_parameters, response_parser)
+        return self._execute_logic_function('datastore_restful_upsert_resource', get_parameters, response_parser,
+                                            invalidates=(resource_id,))
 
     def structure(self, resource_id):
 
@@ -199,7 +329,7 @@ class RestfulDatastoreController(base.BaseController):
 
             return self._parse_response(result, content_type, fields_name)
 
-        return self._execute_logic_function('datastore_search', get_parameters, response_parser)
+        return self._execute_logic_function('datastore_search', get_parameters, response_parser, coalesce=True)
 
     def delete_resource(self, resource_id):
 
@@ -213,48 +343,184 @@ class RestfulDatastoreController(base.BaseController):
         def response_parser(result, content_type):
             return ''
 
-        return self._execute_logic_function('datastore_delete', get_parameters, response_parser)
+        return self._execute_logic_function('datastore_restful_delete_resource', get_parameters, response_parser,
+                                            invalidates=(resource_id,))
 
     ###############################################################################################
     #########################################  ENTRIES  ###########################################
     ###############################################################################################
 
+    def _get_search_parameters(self, resource_id, request_data, extra_parameters=()):
+        PARAMETERS_TO_TRANSFORM = ['q', 'plain', 'language', 'limit', 'offset', 'fields', 'sort']
+        DEFAULT_PARAMETERS = [RESOURCE_ID, 'filters'] + PARAMETERS_TO_TRANSFORM
+        # These parameters are only read with the dollar symbol, so fields with the same name can be filtered
+        PREFIXED_PARAMETERS = ['count', 'layout']
+        PREFIXED_PARAMETERS.extend(extra_parameters)
+
+        #Append resource_id
+        request_data[RESOURCE_ID] = resource_id
+
+        prefixed_values = {}
+        for parameter in PREFIXED_PARAMETERS:
+            if '$' + parameter in request_data:
+                prefixed_values[parameter] = request_data.pop('$' + parameter)
+
+        #Convert from '$parameter' to 'parameter' (ex: '$offset' -> 'offset')
+        for parameter in PARAMETERS_TO_TRANSFORM:
+            modified_parameter = '$' + parameter
+            if modified_parameter in request_data:
+                request_data[parameter] = request_data[modified_parameter]
+                del request_data[modified_parameter]
+
+        #Push all the request parameters (except for the default ones) in the filters list
+        filters = {}
+        for parameter in [p for p in request_data if p not in DEFAULT_PARAMETERS]:
+            value = request_data.pop(parameter)
+            operator = OPERATOR_FILTER.match(parameter)
+
+            # Operators are grouped by field (ex: 'age[gte]' -> {'age': {'gte': ...}})
+            if operator:
+                field, operator = operator.groups()
+                if not isinstance(filters.get(field, {}), dict):
+                    filters[field] = {'eq': filters[field]}
+                filters.setdefault(field, {})[operator] = value
+            elif isinstance(filters.get(parameter), dict):
+                filters[parameter]['eq'] = value
+            else:
+                filters[parameter] = value
+
+        request_data['filters'] = filters
+        request_data.update(prefixed_values)
+
+        return request_data
+
+    def _has_operators(self, request_data):
+        return any(OPERATOR_FILTER.match(parameter) for parameter in request_data)
+
+    def _set_total_header(self, result):
+        if 'total' in result:
+            utils.set_response_headers({TOTAL_HEADER: result['total']})
+
     def search_entries(self, resource_id):
 
+        request_data = utils.parse_get_parameters()
+        layout = request_data.get('$layout', db.LAYOUT_RECORDS)
+
+        # The exact total of the records is computed by datastore_search. The
+        # rest of count modes, layouts and filter operators are handled by
+        # the restful layer
+        if request_data.get('$count', db.COUNT_EXACT) == db.COUNT_EXACT and layout == db.LAYOUT_RECORDS \
+                and not self._has_operators(request_data):
+            request_data.pop('$count', None)
+            request_data.pop('$layout', None)
+            logic_function = 'datastore_search'
+            accepted_formats = [utils.JSON, utils.XML, utils.CSV, utils.ARROW, utils.MSGPACK]
+        else:
+            logic_function = 'datastore_restful_search'
+            if layout == db.LAYOUT_RECORDS:
+                accepted_formats = [utils.JSON, utils.XML, utils.CSV, utils.ARROW, utils.MSGPACK]
+            else:
+                accepted_formats = [utils.JSON, utils.ARROW, utils.MSGPACK]
+
         def get_parameters():
-            PARAMETERS_TO_TRANSFORM = ['q', 'plain', 'language', 'limit', 'offset', 'fields', 'sort']
-            DEFAULT_PARAMETERS = [RESOURCE_ID, 'filters'] + PARAMETERS_TO_TRANSFORM
+            return self._get_search_parameters(resource_id, request_data)
 
-            request_data = utils.parse_get_parameters()
+        def response_parser(result, content_type):
+            self._set_total_header(result)
+            if layout == db.LAYOUT_RECORDS:
+                return self._parse_response(result, content_type, RECORDS)
+            else:
+                # Fields are only listed once
+                values = COLUMNS if layout == db.LAYOUT_COLUMNS else RECORDS
+                return utils.parse_response({'fields': result['fields'], values: result[values]}, content_type)
 
-            #Append resource_id
-            request_data[RESOURCE_ID] = resource_id
+        def cache_key(request_data):
+            # The generation is read before searching, so results of searches that
+            # overlap with a write are never returned once the write has finished
+            generation = cache.generation(cache.SEARCHES, resource_id)
+            if generation is not None:
+                # XML responses include URLs built from the host of the request
+                return cache.SEARCHES, (resource_id, generation, request.headers.get('host'),
+                                        json.dumps(request_data, sort_keys=True))
 
-            #Convert from '$parameter' to 'parameter' (ex: '$offset' -> 'offset')
-            for parameter in PARAMETERS_TO_TRANSFORM:
-                modified_parameter = '$' + parameter
-                if modified_parameter in request_data:
-                    request_data[parameter] = request_data[modified_parameter]
-                    del request_data[modified_parameter]
+        return self._execute_logic_function(logic_function, get_parameters, response_parser, accepted_formats,
+                                            cache_key=cache_key, coalesce=True)
 
-            #Push all the request parameters (except for the default ones) in the filters list
-            request_data['filters'] = {}
-            for parameter in request_data:
-                if parameter not in DEFAULT_PARAMETERS:
-                    request_data['filters'][parameter] = request_data[parameter]
+    def count_entries(self, resource_id):
+
+        def get_parameters():
+            request_data = self._get_search_parameters(resource_id, utils.parse_get_parameters())
+            request_data['limit'] = 0       # Records are not needed
+            return request_data
+
+        def response_parser(result, content_type):
+            self._set_total_header(result)
+            return ''
+
+        return self._execute_logic_function('datastore_restful_search', get_parameters, response_parser,
+                                            coalesce=True)
+
+    def aggregate(self, resource_id):
+
+        def get_parameters():
+            return self._get_search_parameters(resource_id, utils.parse_get_parameters(), AGGREGATE_PARAMETERS)
+
+        def response_parser(result, content_type):
+            return self._parse_response(result, content_type, RECORDS)
+
+        return self._execute_logic_function('datastore_restful_aggregate', get_parameters, response_parser,
+                                            [utils.JSON, utils.XML, utils.CSV, utils.ARROW, utils.MSGPACK],
+                                            coalesce=True)
+
+    def downsample(self, resource_id):
+
+        def get_parameters():
+            return self._get_search_parameters(resource_id, utils.parse_get_parameters(), DOWNSAMPLE_PARAMETERS)
+
+        def response_parser(result, content_type):
+            return self._parse_response(result, content_type, RECORDS)
+
+        return self._execute_logic_function('datastore_restful_downsample', get_parameters, response_parser,
+                                            [utils.JSON, utils.XML, utils.CSV, utils.ARROW, utils.MSGPACK],
+                                            coalesce=True)
 
-            # Remove parameters considered as filter from the request_data object since they
-            # are already in the filters object
-            for filt in request_data['filters']:
-                del request_data[filt]
+    def changes(self, resource_id):
 
+        def get_parameters():
+            request_data = utils.parse_get_parameters()
+            request_data[RESOURCE_ID] = resource_id
             return request_data
 
         def response_parser(result, content_type):
             return self._parse_response(result, content_type, RECORDS)
 
-        return self._execute_logic_function('datastore_search', get_parameters, response_parser,
-                                            [utils.JSON, utils.XML, utils.CSV])
+        return self._execute_logic_function('datastore_restful_changes', get_parameters, response_parser,
+                                            coalesce=True)
+
+    def export(self, resource_id):
+
+        def get_parameters():
+            return {RESOURCE_ID: resource_id, 'format': utils.get_content_type(export.FORMATS)}
+
+        def response_parser(result, content_type):
+            # Nothing can be served until the first export has been generated
+            if result['export_version'] is None:
+                utils.set_response_headers({'Retry-After': export.RETRY_AFTER})
+                return utils.parse_and_finish(202, result)
+
+            path = export.export_path(result[RESOURCE_ID], content_type, result['export_version'])
+            app = export.ExportApp(path, export.etag(content_type, result['export_version']),
+                                   content_type=utils.CONTENT_TYPES[content_type])
+            app_iter = utils.finish_application(app)
+            if result['stale']:
+                utils.set_response_headers({'Warning': '110 - "Response is Stale"'})
+            return app_iter
+
+        def finish(response_data, content_type):
+            return response_data
+
+        return self._execute_logic_function('datastore_restful_export', get_parameters, response_parser,
+                                            export.FORMATS, finish=finish)
 
     def create_entries(self, resource_id):
 
@@ -269,40 +535,32 @@ class RestfulDatastoreController(base.BaseController):
             request_data = {}
             request_data[RECORDS] = utils.parse_body()
             request_data[RESOURCE_ID] = resource_id
-            request_data['method'] = 'upsert'
-            request_data['force'] = True
 
             if not isinstance(request_data[RECORDS], list):
                 _not_valid_input()
 
-            # Get the max identifier used until now
-            MAX_NAME = 'max'
-            function = plugins.toolkit.get_action('datastore_search_sql')
-            own_req = {}
-            own_req['sql'] = 'SELECT MAX(pk) AS %s FROM \"%s\";' % (MAX_NAME, resource_id)
-            max_id = function(self._get_context(), own_req)[RECORDS][0][MAX_NAME]
-
-            if max_id is None:
-                max_id = 0
-
-            #Asign pk to each record
-            #The value specified by the user in the ID will be overwritten by our value
+            # The pk of each record is assigned by the action, after the max identifier used until now
             for record in request_data[RECORDS]:
                 if not isinstance(record, dict):
                     _not_valid_input()
 
                 if IDENTIFIER in record:
                     raise plugins.toolkit.ValidationError(_('The field \'%s\' is asigned automatically' % IDENTIFIER))
-                else:
-                    max_id += 1
-                    record[IDENTIFIER] = max_id
 
             return request_data
 
+        failed_chunks = []
+
         def response_parser(result, content_type):
-            return self._parse_response(result, content_type, RECORDS)
+            # The report of the chunks is returned when some of them could not be inserted
+            failed_chunks.extend(chunk for chunk in result.get('chunks', []) if not chunk['inserted'])
+            return self._parse_response(result, content_type, None if failed_chunks else RECORDS)
+
+        def finish(response_data, content_type):
+            return utils.finish(207 if failed_chunks else 200, response_data, content_type)
 
-        return self._execute_logic_function('datastore_upsert', get_parameters, response_parser)
+        return self._execute_logic_function('datastore_restful_create_entries', get_parameters, response_parser,
+                                            invalidates=(resource_id,), finish=finish)
 
     def upsert_entry(self, resource_id, entry_id):
 
@@ -311,8 +569,6 @@ class RestfulDatastoreController(base.BaseController):
             request_data = {}
             request_data[RECORDS] = utils.parse_body()
             request_data[RESOURCE_ID] = resource_id
-            request_data['method'] = 'upsert'
-            request_data['force'] = True
 
             if isinstance(request_data[RECORDS], dict):
                 request_data[RECORDS] = [request_data[RECORDS]]
@@ -335,9 +591,12 @@ class RestfulDatastoreController(base.BaseController):
             return request_data
 
         def response_parser(result, content_type):
+            # Entries that have not changed are not written again
+            utils.set_response_headers({UNCHANGED_HEADER: str(result['unchanged']).lower()})
             return self._parse_response(result, content_type, RECORDS, 0)
 
-        return self._execute_logic_function('datastore_upsert', get_parameters, response_parser)
+        return self._execute_logic_function('datastore_restful_upsert_entry', get_parameters, response_parser,
+                                            invalidates=(resource_id, self._entry_id(entry_id)))
 
     def get_entry(self, resource_id, entry_id):
 
@@ -356,33 +615,153 @@ class RestfulDatastoreController(base.BaseController):
 
             return self._parse_response(result, content_type, RECORDS, 0)
 
-        return self._execute_logic_function('datastore_search', get_parameters, response_parser)
+        def cache_key(request_data):
+            generation = cache.generation(cache.ENTRIES, resource_id)
+            if generation is not None:
+                return cache.ENTRIES, (resource_id, generation, request.headers.get('host'),
+                                       self._entry_id(entry_id))
+
+        return self._execute_logic_function('datastore_search', get_parameters, response_parser,
+                                            cache_key=cache_key, coalesce=True)
 
     def delete_entry(self, resource_id, entry_id):
 
         def get_parameters():
             request_data = {}
-            request_data['filters'] = {}
-            request_data['filters'][IDENTIFIER] = entry_id
             request_data[RESOURCE_ID] = resource_id
-            request_data['force'] = True
+            request_data[IDENTIFIER] = entry_id
 
-            # Does the entry exist?
-            function = plugins.toolkit.get_action('datastore_search')
-            own_req = {}
-            own_req['filters'] = {IDENTIFIER: entry_id}
-            own_req[RESOURCE_ID] = resource_id
-            result = function(self._get_context(), own_req)
+            return request_data
 
-            if len(result[RECORDS]) != 1:
-                raise self._entry_not_found(resource_id, entry_id)
+        def response_parser(result, content_type):
+            return ''
+
+        return self._execute_logic_function('datastore_restful_delete_entry', get_parameters, response_parser,
+                                            invalidates=(resource_id, self._entry_id(entry_id)))
+
+    ###############################################################################################
+    #########################################  INDEXES  ###########################################
+    ###############################################################################################
+
+    def list_indexes(self, resource_id):
+
+        def get_parameters():
+            request_data = {}
+            request_data[RESOURCE_ID] = resource_id
+            return request_data
+
+        def response_parser(result, content_type):
+            return self._parse_response(result, content_type, INDEXES)
+
+        return self._execute_logic_function('datastore_restful_index_list', get_parameters, response_parser)
+
+    def get_index(self, resource_id, index_name):
+
+        def get_parameters():
+            request_data = {}
+            request_data[RESOURCE_ID] = resource_id
+            request_data['name'] = index_name
+            return request_data
+
+        def response_parser(result, content_type):
+            return self._parse_response({INDEX: result[INDEXES][0]}, content_type, INDEX)
+
+        return self._execute_logic_function('datastore_restful_index_list', get_parameters, response_parser)
+
+    def upsert_index(self, resource_id, index_name):
+
+        def get_parameters():
+            request_data = utils.parse_body()
+
+            if not isinstance(request_data, dict):
+                raise plugins.toolkit.ValidationError({
+                    'message': _('Only dicts can be placed to create/modify an index'),
+                    'data': request_data
+                })
+
+            request_data[RESOURCE_ID] = resource_id
+            request_data['name'] = index_name
+            return request_data
+
+        def response_parser(result, content_type):
+            return self._parse_response(result, content_type, INDEX)
+
+        return self._execute_logic_function('datastore_restful_index_create', get_parameters, response_parser)
+
+    def delete_index(self, resource_id, index_name):
+
+        def get_parameters():
+            request_data = {}
+            request_data[RESOURCE_ID] = resource_id
+            request_data['name'] = index_name
+            return request_data
+
+        def response_parser(result, content_type):
+            return ''
+
+        return self._execute_logic_function('datastore_restful_index_delete', get_parameters, response_parser)
+
+    ###############################################################################################
+    #########################################  WEBHOOKS  ##########################################
+    ###############################################################################################
+
+    def list_webhooks(self, resource_id):
+
+        def get_parameters():
+            request_data = {}
+            request_data[RESOURCE_ID] = resource_id
+            return request_data
+
+        def response_parser(result, content_type):
+            return self._parse_response(result, content_type, WEBHOOKS)
+
+        return self._execute_logic_function('datastore_restful_webhook_list', get_parameters, response_parser)
+
+    def get_webhook(self, resource_id, webhook_name):
+
+        def get_parameters():
+            request_data = {}
+            request_data[RESOURCE_ID] = resource_id
+            request_data['name'] = webhook_name
+            return request_data
+
+        def response_parser(result, content_type):
+            return self._parse_response({WEBHOOK: result[WEBHOOKS][0]}, content_type, WEBHOOK)
+
+        return self._execute_logic_function('datastore_restful_webhook_list', get_parameters, response_parser)
+
+    def upsert_webhook(self, resource_id, webhook_name):
+
+        def get_parameters():
+            request_data = utils.parse_body()
+
+            if not isinstance(request_data, dict):
+                raise plugins.toolkit.ValidationError({
+                    'message': _('Only dicts can be placed to create/modify a webhook'),
+                    'data': request_data
+                })
 
+            request_data[RESOURCE_ID] = resource_id
+            request_data['name'] = webhook_name
+            return request_data
+
+        def response_parser(result, content_type):
+            return self._parse_response(result, content_type, WEBHOOK)
+
+        return self._execute_logic_function('datastore_restful_webhook_create', get_parameters, response_parser)
+
+    def delete_webhook(self, resource_id, webhook_name):
+
+        def get_parameters():
+            request_data = {}
+            request_data[RESOURCE_ID] = resource_id
+            request_data['name'] = webhook_name
             return request_data
 
         def response_parser(result, content_type):
             return ''
 
-        return self._execute_logic_function('datastore_delete', get_parameters, response_parser)
+        return self._execute_logic_function('datastore_restful_webhook_delete', get_parameters, response_parser)
 
     ###############################################################################################
     ############################################  SQL  ############################################
@@ -390,11 +769,76 @@ class RestfulDatastoreController(base.BaseController):
 
     def sql(self):
 
+        request_data = utils.parse_get_parameters()
+
+        # Queries with bound parameters are run through prepared statements
+        # while the rest can be streamed from a server-side cursor. Queries
+        # are executed by the restful layer when their cost is limited
+        if PARAMS in request_data:
+            logic_function = 'datastore_restful_search_sql'
+        elif db.stream_enabled():
+            logic_function = 'datastore_restful_stream_sql'
+        elif db.admission_enabled():
+            logic_function = 'datastore_restful_search_sql'
+        else:
+            logic_function = 'datastore_search_sql'
+
         def get_parameters():
-            return utils.parse_get_parameters()
+            if PARAMS in request_data:
+                request_data[PARAMS] = utils.parse_json(request_data[PARAMS])
+            return request_data
 
         def response_parser(result, content_type):
-            return self._parse_response(result, content_type, RECORDS)
+            if logic_function == 'datastore_restful_stream_sql':
+                return utils.stream_response(result, content_type, RECORDS)
+            else:
+                return self._parse_response(result, content_type, RECORDS)
+
+        # The length of streamed results is unknown, so they cannot be packed
+        accepted_formats = [utils.JSON, utils.XML, utils.CSV, utils.ARROW]
+        if logic_function != 'datastore_restful_stream_sql':
+            accepted_formats.append(utils.MSGPACK)
+
+        return self._execute_logic_function(logic_function, get_parameters, response_parser, accepted_formats,
+                                            coalesce=logic_function != 'datastore_restful_stream_sql')
+
+    ###############################################################################################
+    ##########################################  METRICS  ##########################################
+    ###############################################################################################
+
+    def metrics(self):
+
+        def get_parameters():
+            return {}
+
+        def response_parser(result, content_type):
+            return self._parse_response(result, content_type, 'metrics')
+
+        return self._execute_logic_function('datastore_restful_metrics', get_parameters, response_parser)
+
+    ###############################################################################################
+    ##########################################  ADVISOR  ##########################################
+    ###############################################################################################
+
+    def _get_advisor_parameters(self):
+        request_data = {}
+        resource_id = utils.parse_get_parameters().get(RESOURCE_ID)
+        if resource_id:
+            request_data[RESOURCE_ID] = resource_id
+        return request_data
+
+    def advisor(self):
+
+        def response_parser(result, content_type):
+            return self._parse_response(result, content_type, 'recommendations')
+
+        return self._execute_logic_function('datastore_restful_advisor', self._get_advisor_parameters,
+                                            response_parser)
+
+    def apply_advisor(self):
+
+        def response_parser(result, content_type):
+            return self._parse_response(result, content_type, 'recommendations')
 
-        return self._execute_logic_function('datastore_search_sql', get_parameters, response_parser,
-                                            [utils.JSON, utils.XML, utils.CSV])
+        return self._execute_logic_function('datastore_restful_advisor_apply', self._get_advisor_parameters,
+                                            response_parser)
@@ -0,0 +1,1397 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN DataStore Restful Extension.
+
+# CKAN DataStore Restful Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN DataStore Restful Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN DataStore Restful Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+
+import ckan.plugins as plugins
+import ckanext.datastore.db as datastore_db
+import ckanext.datastore_restful.query as query
+import ckanext.datastore_restful.sampling as sampling
+import ckanext.datastore_restful.stats as stats
+
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from pylons import config
+from sqlalchemy.exc import DataError, DBAPIError, IntegrityError, ProgrammingError
+
+log = logging.getLogger(__name__)
+
+READ_URL = 'ckan.datastore.read_url'
+WRITE_URL = 'ckan.datastore.write_url'
+
+PREPARED_STATEMENTS = 'ckanext.datastore_restful.prepared_statements'
+DEFAULT_PREPARED_STATEMENTS = 100
+
+STREAM_SQL = 'ckanext.datastore_restful.stream_sql'
+STREAM_BATCH_SIZE = 'ckanext.datastore_restful.stream_batch_size'
+DEFAULT_STREAM_BATCH_SIZE = 1000
+STREAM_MAX_ROWS = 'ckanext.datastore_restful.stream_max_rows'
+DEFAULT_STREAM_MAX_ROWS = 0     # No limit
+
+SQL_TIMEOUT = 'ckanext.datastore_restful.sql_timeout'
+SQL_MAX_COST = 'ckanext.datastore_restful.sql_max_cost'
+SQL_MAX_ROWS = 'ckanext.datastore_restful.sql_max_rows'
+SQL_HEAVY_COST = 'ckanext.datastore_restful.sql_heavy_cost'
+SQL_HEAVY_SLOTS = 'ckanext.datastore_restful.sql_heavy_slots'
+DEFAULT_SQL_HEAVY_SLOTS = 1
+RETRY_AFTER = 5     # seconds
+
+COUNT_NONE = 'none'
+COUNT_EXACT = 'exact'
+COUNT_ESTIMATED = 'estimated'
+COUNT_MODES = [COUNT_NONE, COUNT_EXACT, COUNT_ESTIMATED]
+
+LAYOUT_RECORDS = 'records'
+LAYOUT_ARRAYS = 'arrays'
+LAYOUT_COLUMNS = 'columns'
+LAYOUTS = [LAYOUT_RECORDS, LAYOUT_ARRAYS, LAYOUT_COLUMNS]
+
+INDEX_BTREE = 'btree'
+INDEX_GIN = 'gin'
+INDEX_METHODS = [INDEX_BTREE, INDEX_GIN]
+DEFAULT_INDEX_LANGUAGE = u'english'
+
+# Index names are shared by all the tables, so they are prefixed with a
+# digest of the resource and limited to the length of a PostgreSQL identifier
+INDEX_NAME = re.compile(r'^[A-Za-z0-9_]{1,41}$')
+_INDEX_PREFIX = u'restful_{0}_'
+
+_INDEXES_SQL = u'''SELECT c.relname, am.amname, i.indisunique, i.indisprimary, i.indisvalid,
+        array(SELECT pg_get_indexdef(i.indexrelid, k, true) FROM generate_series(1, i.indnatts) k),
+        pg_get_indexdef(i.indexrelid), pg_relation_size(i.indexrelid),
+        s.idx_scan, s.idx_tup_read, s.idx_tup_fetch
+    FROM pg_index i
+    JOIN pg_class c ON c.oid = i.indexrelid
+    JOIN pg_am am ON am.oid = c.relam
+    LEFT JOIN pg_stat_user_indexes s ON s.indexrelid = i.indexrelid
+    WHERE i.indrelid = %s::regclass{0}
+    ORDER BY c.relname'''
+
+# Types whose values are returned by psycopg2 as they are serialized
+_UNCONVERTED_TYPES = set(['int2', 'int4', 'float4', 'float8', 'text', 'varchar'])
+
+# Writes of the same resource through the restful layer are serialized by an
+# advisory lock of this namespace and the hash of the resource
+WRITE_LOCK_NAMESPACE = 0x5245
+
+# Hidden column with the hash of the last record written through upsert_entry.
+# The trigger copies it from a setting local to the transaction of the write,
+# so rows written by any other way are left without hash.
+ROW_HASH_COLUMN = '_restful_hash'
+_ROW_HASH_SETTING = 'datastore_restful.row_hash'
+_ROW_HASH_FUNCTION_SQL = u'''CREATE OR REPLACE FUNCTION "_restful_row_hash"() RETURNS trigger AS $$
+BEGIN
+    NEW."{0}" := nullif(current_setting('{1}', true), '');
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql'''.format(ROW_HASH_COLUMN, _ROW_HASH_SETTING)
+
+# Hidden column with the version of the last change of each row, taken from a
+# sequence shared by all the resources. Deleted rows leave a tombstone with the
+# version of their deletion. The changes of a resource are serialized by its
+# write lock, so versions are committed in order.
+VERSION_COLUMN = '_restful_version'
+TOMBSTONES_TABLE = '_restful_tombstones'
+_VERSIONS_SEQUENCE = '_restful_versions'
+_VERSION_FUNCTION_SQL = u'''CREATE OR REPLACE FUNCTION "_restful_row_version"() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_advisory_xact_lock({0}, hashtext(TG_TABLE_NAME));
+    IF TG_OP = 'DELETE' THEN
+        INSERT INTO "{1}" (resource_id, {2}, version) VALUES (TG_TABLE_NAME, OLD.{2}, nextval('"{3}"'));
+        RETURN OLD;
+    END IF;
+    NEW."{4}" := nextval('"{3}"');
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql'''
+
+# Big lists of entries can be inserted in chunks by a pool of threads, each
+# one through its own pooled connection. The identifiers of all the chunks
+# are reserved beforehand, so every chunk is an independent transaction
+INGEST_THREADS = 'ckanext.datastore_restful.ingest_threads'
+DEFAULT_INGEST_THREADS = 1      # Entries are inserted in a single transaction
+INGEST_CHUNK_SIZE = 'ckanext.datastore_restful.ingest_chunk_size'
+DEFAULT_INGEST_CHUNK_SIZE = 10000
+PK_RESERVATIONS_TABLE = '_restful_pk_reservations'
+
+# Shared tables with rows of each resource, removed with the resource
+_RESOURCE_TABLES = [PK_RESERVATIONS_TABLE, TOMBSTONES_TABLE]
+
+_PREPARED_STATEMENTS_KEY = 'datastore_restful.prepared_statements'
+_PG_ERR_CODE = datastore_db._PG_ERR_CODE
+
+_heavy_lock = threading.Lock()
+_heavy_slots = {}
+_ingest_pools = {}
+_reservations_created = []
+
+
+###############################################################################################
+#########################################  AUXILIAR  ##########################################
+###############################################################################################
+
+def _set_timeout(connection, timeout=None):
+    timeout = timeout or int(config.get(SQL_TIMEOUT, datastore_db._TIMEOUT))
+    connection.execute(u'SET LOCAL statement_timeout TO {0}'.format(timeout))
+
+
+def _release_nothing():
+    pass
+
+
+def _get_heavy_slots():
+    # Shared by all the threads of the process
+    with _heavy_lock:
+        slots = int(config.get(SQL_HEAVY_SLOTS, DEFAULT_SQL_HEAVY_SLOTS))
+        if slots not in _heavy_slots:
+            _heavy_slots[slots] = threading.BoundedSemaphore(slots)
+        return _heavy_slots[slots]
+
+
+def _get_ingest_pool(threads):
+    # Shared by all the threads of the process. Pools are not inherited by the processes forked by the server
+    with _heavy_lock:
+        key = (os.getpid(), threads)
+        if key not in _ingest_pools:
+            _ingest_pools[key] = ThreadPool(threads)
+        return _ingest_pools[key]
+
+
+def _get_prepared_statements(connection):
+    # Prepared statements live as long as the database session, so they are
+    # tracked in the info dict of the pooled DBAPI connection
+    info = connection.connection.info
+    if _PREPARED_STATEMENTS_KEY not in info:
+        capacity = int(config.get(PREPARED_STATEMENTS, DEFAULT_PREPARED_STATEMENTS))
+        info[_PREPARED_STATEMENTS_KEY] = PreparedStatements(capacity)
+    return info[_PREPARED_STATEMENTS_KEY]
+
+
+def _execute(connection, statement, params=()):
+    # Statements without parameters are sent as they are
+    return connection.execute(statement, params) if params else connection.execute(statement)
+
+
+def _get_field_ids(connection, resource_id):
+    fields = datastore_db._get_fields({'connection': connection}, {'resource_id': resource_id})
+    return ['_id'] + [field['id'] for field in fields]
+
+
+def _regclass(resource_id):
+    # Tables are bound as values, so '%' does not have to be escaped
+    return u'"{0}"'.format(resource_id.replace('"', '""'))
+
+
+def _estimate_count(connection, resource_id, field_ids, data_dict):
+    # Planner statistics of the table are used when all its rows are requested
+    if not data_dict.get('filters') and not data_dict.get('q'):
+        result = connection.execute(u'SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass',
+                                    _regclass(resource_id)).fetchone()
+        return max(int(result[0]), 0) if result else 0
+    else:
+        sql, values = query.count(resource_id, field_ids, data_dict, u'1')
+        return int(explain(connection, sql, values).get('Plan Rows', 0))
+
+
+def _describe(connection, results):
+    context = {'connection': connection}
+    return [{
+        'id': field[0].decode('utf-8'),
+        'type': datastore_db._get_type(context, field[1])
+    } for field in results.cursor.description]
+
+
+def _format_arrays(connection, results, result, layout):
+    # Values are converted column by column, so no dict is built for each row
+    fields = _describe(connection, results)
+    rows = results.fetchall()
+
+    if fields and fields[-1]['id'] == '_full_count':
+        fields.pop()
+        if rows:
+            result['total'] = rows[0][-1]
+
+    columns = []
+    for position, field in enumerate(fields):
+        if field['type'] in _UNCONVERTED_TYPES:
+            columns.append([row[position] for row in rows])
+        else:
+            columns.append([datastore_db.convert(row[position], field['type']) for row in rows])
+
+    result['fields'] = datastore_db._unrename_json_field({'fields': fields})['fields']
+    if layout == LAYOUT_COLUMNS:
+        result['columns'] = columns
+    else:
+        result['records'] = [list(row) for row in zip(*columns)] if columns else [[] for row in rows]
+
+    return result
+
+
+def _index_prefix(resource_id):
+    return _INDEX_PREFIX.format(hashlib.md5(resource_id.encode('utf-8')).hexdigest()[:12])
+
+
+@contextlib.contextmanager
+def _autocommit(connection):
+    # Indexes are built and dropped concurrently, what cannot be done
+    # inside a transaction block
+    dbapi_connection = connection.connection.connection
+    dbapi_connection.autocommit = True
+    try:
+        yield
+    finally:
+        dbapi_connection.autocommit = False
+
+
+def _format_index(prefix, row):
+    name, method, unique, primary, valid, fields, definition, size, scans, read, fetched = row
+    managed = name.startswith(prefix)
+
+    index = OrderedDict()
+    index['name'] = name[len(prefix):] if managed else name
+    index['managed'] = managed
+    index['method'] = method
+    index['unique'] = unique
+    index['primary'] = primary
+    index['valid'] = valid
+    index['fields'] = fields
+    index['definition'] = definition
+    index['size'] = size
+    index['scans'] = scans or 0
+    index['tuples_read'] = read or 0
+    index['tuples_fetched'] = fetched or 0
+    return index
+
+
+def _index_expression(fields, method, language):
+    quoted = [query.quote(field) for field in fields]
+
+    # Full text indexes are built over all the fields, that are concatenated
+    # like the _full_text column does
+    if method == INDEX_GIN:
+        document = u" || ' ' || ".join(u"coalesce({0}::text, '')".format(field) for field in quoted)
+        return u'USING gin (to_tsvector(%s::regconfig, {0}))'.format(document), [language]
+    else:
+        return u'({0})'.format(u', '.join(quoted)), []
+
+
+def _fetch_records(connection, results, batch_size):
+    # Rows are fetched in batches from a server-side cursor, whose
+    # description is only available after the first fetch
+    batch = results.fetchmany(batch_size)
+    fields = _describe(connection, results)
+
+    def _records(batch):
+        while batch:
+            for row in batch:
+                yield dict((field['id'], datastore_db.convert(row[position], field['type']))
+                           for position, field in enumerate(fields))
+            batch = results.fetchmany(batch_size)
+
+    return fields, _records(batch)
+
+
+def _get_y(value):
+    def _y(record):
+        try:
+            return float(record[value])
+        except KeyError:
+            raise plugins.toolkit.ValidationError({
+                'value': [u'"{0}" is not a returned column'.format(value)]
+            })
+        except (TypeError, ValueError):
+            raise plugins.toolkit.ValidationError({
+                'value': [u'"{0}" is not a number'.format(value)]
+            })
+    return _y
+
+
+def _get_x(record):
+    return record[query.X_COLUMN]
+
+
+def _check_system_tables(plan):
+    system_tables = [t for t in plan_relations(plan) if t.startswith('pg_')]
+    if system_tables:
+        raise plugins.toolkit.NotAuthorized({
+            'permissions': ['Not authorized to access system tables']
+        })
+
+
+###############################################################################################
+###########################################  MAIN  ############################################
+###############################################################################################
+
+class QueryRejected(Exception):
+    '''Raised when the estimate of a query exceeds the configured limits'''
+
+    def __init__(self, message, estimate, limits, status=400, retry_after=None):
+        super(QueryRejected, self).__init__(message)
+        self.message = message
+        self.estimate = estimate
+        self.limits = limits
+        self.status = status
+        self.retry_after = retry_after
+
+
+def get_engine(write=False):
+    engine = datastore_db._get_engine({'connection_url': config[WRITE_URL if write else READ_URL]})
+    stats.instrument_engine(engine)
+    return engine
+
+
+def is_single_statement(sql):
+    return datastore_db._is_single_statement(sql)
+
+
+@contextlib.contextmanager
+def translate_errors():
+    '''Turns database errors into the errors returned by the DataStore actions'''
+    try:
+        yield
+    except ProgrammingError as e:
+        if e.orig.pgcode == _PG_ERR_CODE['permission_denied']:
+            raise plugins.toolkit.NotAuthorized({
+                'permissions': ['Not authorized to read resource.']
+            })
+        raise plugins.toolkit.ValidationError({
+            'query': [str(e.orig)],
+            'info': {
+                'statement': [e.statement],
+                'params': [e.params]
+            }
+        })
+    except IntegrityError as e:
+        raise plugins.toolkit.ValidationError({
+            'constraints': ['Cannot insert records because of a constraint of the resource'],
+            'info': {
+                'orig': str(e.orig),
+                'pgcode': e.orig.pgcode
+            }
+        })
+    except DataError as e:
+        raise plugins.toolkit.ValidationError({
+            'data': [str(e.orig)]
+        })
+    except DBAPIError as e:
+        if e.orig.pgcode == _PG_ERR_CODE['query_canceled']:
+            raise plugins.toolkit.ValidationError({
+                'query': ['Query took too long']
+            })
+        raise
+
+
+def explain(connection, sql, params=()):
+    '''Returns the plan that PostgreSQL estimates for the given statement'''
+    result = _execute(connection, u'EXPLAIN (FORMAT JSON) ' + sql, params).fetchone()
+    query_plan = result[0]
+    if isinstance(query_plan, basestring):
+        query_plan = json.loads(query_plan)
+    return query_plan[0]['Plan']
+
+
+def plan_relations(plan):
+    relations = []
+
+    if plan.get('Relation Name'):
+        relations.append(plan['Relation Name'])
+
+    for child_plan in plan.get('Plans', []):
+        relations.extend(plan_relations(child_plan))
+
+    return relations
+
+
+def admission_enabled():
+    return any(config.get(key) for key in (SQL_TIMEOUT, SQL_MAX_COST, SQL_MAX_ROWS, SQL_HEAVY_COST))
+
+
+def admit(plan):
+    '''Checks the estimate of a plan against the configured limits. Returns
+    the function that releases the slot taken by expensive queries, that
+    are rejected when all the slots are in use.'''
+
+    estimate = OrderedDict([('cost', plan.get('Total Cost', 0)), ('rows', plan.get('Plan Rows', 0))])
+    limits = OrderedDict((name, float(config[key])) for name, key in (('cost', SQL_MAX_COST), ('rows', SQL_MAX_ROWS))
+                         if config.get(key))
+
+    exceeded = [name for name in limits if estimate[name] > limits[name]]
+    if exceeded:
+        stats.increment('sql.rejected')
+        raise QueryRejected('The estimated %s of the query exceeds the allowed limit' % ' and '.join(exceeded),
+                            estimate, limits)
+
+    heavy_cost = float(config.get(SQL_HEAVY_COST, 0))
+    if heavy_cost and estimate['cost'] > heavy_cost:
+        slots = _get_heavy_slots()
+        if not slots.acquire(False):
+            stats.increment('sql.deferred')
+            raise QueryRejected('Too many expensive queries are being executed, retry later',
+                                estimate, {'heavy_cost': heavy_cost}, 503, RETRY_AFTER)
+        return slots.release
+
+    return _release_nothing
+
+
+def resolve_resource(resource_id):
+    '''Returns the table of a resource, that can be an alias. Raises
+    ObjectNotFound when the resource is not in the DataStore.'''
+
+    result = get_engine(write=True).execute(u'SELECT alias_of FROM "_table_metadata" WHERE name = %s',
+                                            resource_id).fetchone()
+    if result is None:
+        raise plugins.toolkit.ObjectNotFound(plugins.toolkit._(
+            'Resource "{0}" was not found.'.format(resource_id)
+        ))
+
+    return result[0] or resource_id
+
+
+def search(data_dict, count=COUNT_EXACT, layout=LAYOUT_RECORDS):
+    '''Searches the records of a resource like datastore_search does. The
+    total number of matching records can be exact, estimated from the planner
+    statistics or skipped (count=none). Records are not fetched when the
+    limit is 0.
+
+    Records are returned as dicts or, depending on the layout, as lists of
+    values (arrays) or one list of values per field (columns). Array layouts
+    do not include the _id field unless it is requested.'''
+
+    resource_id = data_dict['resource_id']
+    limit = data_dict.get('limit', 100)
+    offset = data_dict.get('offset', 0)
+    connection = get_engine(write=True).connect()
+
+    try:
+        with translate_errors():
+            trans = connection.begin()
+            try:
+                _set_timeout(connection, datastore_db._TIMEOUT)
+                field_ids = _get_field_ids(connection, resource_id)
+                result = dict(data_dict)
+
+                if limit:
+                    search_dict = data_dict
+                    if layout != LAYOUT_RECORDS and not data_dict.get('fields'):
+                        search_dict = dict(data_dict, fields=field_ids[1:])
+
+                    sql, values = query.search(resource_id, field_ids, search_dict, count == COUNT_EXACT)
+                    results = connection.execute(sql, values)
+                    if layout == LAYOUT_RECORDS:
+                        result = format_results(connection, results, result)
+                    else:
+                        result = _format_arrays(connection, results, result, layout)
+                    datastore_db._insert_links(result, limit, offset)
+                else:
+                    result['records'] = []
+                    result['fields'] = [{'id': field_id} for field_id in query.select(field_ids, data_dict)]
+
+                if count == COUNT_ESTIMATED:
+                    result['total'] = _estimate_count(connection, resource_id, field_ids, data_dict)
+                elif count == COUNT_EXACT and 'total' not in result:
+                    # The page is empty, so the window count is not available
+                    sql, values = query.count(resource_id, field_ids, data_dict)
+                    result['total'] = connection.execute(sql, values).fetchone()[0]
+                elif count == COUNT_NONE:
+                    result.pop('total', None)
+
+                trans.commit()
+                return result
+            except Exception:
+                trans.rollback()
+                raise
+    finally:
+        connection.close()
+
+
+def aggregate(data_dict):
+    '''Groups the records of a resource that match the filters and returns
+    the aggregates computed for each group'''
+
+    resource_id = data_dict['resource_id']
+    connection = get_engine(write=True).connect()
+
+    try:
+        with translate_errors():
+            trans = connection.begin()
+            try:
+                _set_timeout(connection, datastore_db._TIMEOUT)
+                field_ids = _get_field_ids(connection, resource_id)
+                sql, values = query.aggregate(resource_id, field_ids, data_dict)
+                result = format_results(connection, connection.execute(sql, values), dict(data_dict))
+                trans.commit()
+                return result
+            except Exception:
+                trans.rollback()
+                raise
+    finally:
+        connection.close()
+
+
+def downsample(data_dict):
+    '''Returns the series of a time field of a resource. The records can be
+    grouped in buckets of an interval and the series (of buckets or raw
+    records) reduced to a number of points with LTTB. Raw records are read
+    from a server-side cursor while they are reduced.'''
+
+    resource_id = data_dict['resource_id']
+    points = data_dict.get('points')
+    batch_size = int(config.get(STREAM_BATCH_SIZE, DEFAULT_STREAM_BATCH_SIZE))
+    connection = get_engine(write=True).connect()
+
+    try:
+        with translate_errors():
+            datastore_db._cache_types({'connection': connection})
+            trans = connection.begin()
+            try:
+                _set_timeout(connection, datastore_db._TIMEOUT)
+                field_ids = _get_field_ids(connection, resource_id)
+                result = dict(data_dict)
+
+                if data_dict.get('interval'):
+                    sql, values = query.buckets(resource_id, field_ids, data_dict)
+                    result = format_results(connection, connection.execute(sql, values), result)
+                    records, length = result['records'], len(result['records'])
+                else:
+                    sql, count_sql, values = query.series(resource_id, field_ids, data_dict)
+                    length = connection.execute(count_sql, values).fetchone()[0]
+                    results = connection.execution_options(stream_results=True).execute(sql, values)
+                    result['fields'], records = _fetch_records(connection, results, batch_size)
+
+                if points:
+                    records = sampling.lttb(records, length, points, _get_x, _get_y(data_dict['value']))
+
+                result['records'] = list(records)
+                result['fields'] = [field for field in result['fields'] if field['id'] != query.X_COLUMN]
+                for record in result['records']:
+                    del record[query.X_COLUMN]
+
+                trans.commit()
+                return result
+            except Exception:
+                trans.rollback()
+                raise
+    finally:
+        connection.close()
+
+
+@contextlib.contextmanager
+def unit_of_work(resource_id):
+    '''Runs the steps of a write in a single transaction of one pooled
+    connection, that is committed when all of them succeed. Yields the
+    context used by the DataStore write functions. Raises ObjectNotFound
+    when the resource is not a table of the DataStore.'''
+
+    connection = get_engine(write=True).connect()
+
+    try:
+        with translate_errors():
+            trans = connection.begin()
+            try:
+                _set_timeout(connection)
+                result = connection.execute(u'SELECT 1 FROM "_table_metadata" WHERE name = %s AND alias_of IS NULL',
+                                            resource_id)
+                if result.fetchone() is None:
+                    raise plugins.toolkit.ObjectNotFound(plugins.toolkit._(
+                        'Resource "{0}" was not found.'.format(resource_id)
+                    ))
+
+                # Released on commit or rollback
+                connection.execute(u'SELECT pg_advisory_xact_lock(%s, hashtext(%s))',
+                                   WRITE_LOCK_NAMESPACE, resource_id)
+
+                yield {'connection': connection}
+                trans.commit()
+            except Exception:
+                trans.rollback()
+                raise
+    finally:
+        connection.close()
+
+
+def create_table(name, sql):
+    '''Runs the statement that creates a table shared by all the resources in
+    its own transaction. Tables can not be created concurrently, even if
+    they do not exist, so the statements are serialized by the name.'''
+
+    connection = get_engine(write=True).connect()
+
+    try:
+        with translate_errors():
+            trans = connection.begin()
+            try:
+                connection.execute(u'SELECT pg_advisory_xact_lock(%s, hashtext(%s))', WRITE_LOCK_NAMESPACE, name)
+                connection.execute(sql)
+                trans.commit()
+            except Exception:
+                trans.rollback()
+                raise
+    finally:
+        connection.close()
+
+
+def delete_resource(resource_id, tables=()):
+    '''Drops the table of a resource and deletes its rows from the shared
+    tables (its identifier reservations, its tombstones and the given
+    tables, that must have a resource_id column) in the same transaction.
+    Tables that do not exist yet are skipped.'''
+
+    with unit_of_work(resource_id) as context:
+        connection = context['connection']
+        connection.execute(u'DROP TABLE {0} CASCADE'.format(query.quote(resource_id)))
+        for table in _RESOURCE_TABLES + list(tables):
+            if connection.execute(u'SELECT 1 FROM pg_tables WHERE tablename = %s', table).fetchone() is not None:
+                connection.execute(u'DELETE FROM "{0}" WHERE resource_id = %s'.format(table), resource_id)
+
+
+def _create_reservations_table():
+    # Once per process
+    if not _reservations_created:
+        create_table(PK_RESERVATIONS_TABLE, u'''CREATE TABLE IF NOT EXISTS "{0}" (
+            resource_id text PRIMARY KEY,
+            last_pk bigint NOT NULL)'''.format(PK_RESERVATIONS_TABLE))
+        _reservations_created.append(True)
+
+
+def _reserve_pks(connection, resource_id, identifier, count):
+    '''Reserves count identifiers after the greatest one used or reserved
+    until now and returns the last identifier before them. Must be called
+    under the write lock of the resource.'''
+
+    last_pk = connection.execute(u'SELECT greatest((SELECT last_pk FROM "{0}" WHERE resource_id = %s), '
+                                 u'(SELECT max({1}) FROM {2}), 0)'.format(
+                                     PK_RESERVATIONS_TABLE, query.quote(identifier), query.quote(resource_id)),
+                                 resource_id).scalar()
+
+    result = connection.execute(u'UPDATE "{0}" SET last_pk = %s WHERE resource_id = %s'.format(
+        PK_RESERVATIONS_TABLE), last_pk + count, resource_id)
+    if result.rowcount == 0:
+        connection.execute(u'INSERT INTO "{0}" (resource_id, last_pk) VALUES (%s, %s)'.format(
+            PK_RESERVATIONS_TABLE), resource_id, last_pk + count)
+
+    return last_pk
+
+
+def _number(records, identifier, last_pk):
+    for record in records:
+        last_pk += 1
+        record[identifier] = last_pk
+
+
+def _insert_chunk(resource_id, records):
+    '''Inserts the records in their own transaction and returns the error
+    that prevented it, if any'''
+
+    connection = get_engine(write=True).connect()
+
+    try:
+        with translate_errors():
+            trans = connection.begin()
+            try:
+                _set_timeout(connection)
+                datastore_db.upsert_data({'connection': connection},
+                                         {'resource_id': resource_id, 'records': records, 'method': 'insert'})
+                trans.commit()
+            except Exception:
+                trans.rollback()
+                raise
+    except Exception as e:
+        log.warning('Unable to insert a chunk of %d records in the resource %s: %s', len(records), resource_id, e)
+        return e
+    finally:
+        connection.close()
+
+
+def _chunk_error(error):
+    if isinstance(error, plugins.toolkit.ValidationError):
+        return error.error_dict
+    return {'message': u'%s: %s' % (type(error).__name__, error)}
+
+
+def ingestion_chunks(records):
+    '''Returns the size of the chunks the records have to be inserted in, or
+    None when they have to be inserted in a single transaction'''
+    threads = int(config.get(INGEST_THREADS, DEFAULT_INGEST_THREADS))
+    chunk_size = int(config.get(INGEST_CHUNK_SIZE, DEFAULT_INGEST_CHUNK_SIZE))
+    return chunk_size if threads > 1 and len(records) > chunk_size else None
+
+
+def create_entries(resource_id, records, identifier):
+    '''Inserts the records numbering their identifier field after the greatest
+    identifier used or reserved in the resource'''
+
+    _create_reservations_table()
+
+    with unit_of_work(resource_id) as context:
+        _number(records, identifier, _reserve_pks(context['connection'], resource_id, identifier, len(records)))
+        datastore_db.upsert_data(context, {'resource_id': resource_id, 'records': records, 'method': 'insert'})
+
+    return records
+
+
+def ingest_entries(resource_id, records, identifier, chunk_size):
+    '''Inserts the records in chunks, concurrently through a bounded pool of
+    threads. Their identifiers are reserved before, so each chunk is
+    numbered in order and inserted in its own transaction. Returns the
+    inserted records and the report of each chunk: its first and last
+    identifiers and the error that prevented inserting it, if any. Raises
+    the first error when no chunk could be inserted.'''
+
+    _create_reservations_table()
+
+    with unit_of_work(resource_id) as context:
+        _number(records, identifier, _reserve_pks(context['connection'], resource_id, identifier, len(records)))
+
+    chunks = [records[start:start + chunk_size] for start in range(0, len(records), chunk_size)]
+    pool = _get_ingest_pool(int(config.get(INGEST_THREADS, DEFAULT_INGEST_THREADS)))
+    errors = pool.map(lambda chunk: _insert_chunk(resource_id, chunk), chunks, chunksize=1)
+
+    if all(error is not None for error in errors):
+        raise errors[0]
+
+    report = []
+    for chunk, error in zip(chunks, errors):
+        chunk_report = {'first_pk': chunk[0][identifier], 'last_pk': chunk[-1][identifier], 'inserted': error is None}
+        if error is not None:
+            chunk_report['error'] = _chunk_error(error)
+        report.append(chunk_report)
+
+    return [record for chunk, error in zip(chunks, errors) if error is None for record in chunk], report
+
+
+def _row_hash(record):
+    return hashlib.md5(json.dumps(record, sort_keys=True, separators=(',', ':'))).hexdigest()
+
+
+def _has_column(connection, resource_id, column):
+    result = connection.execute(u'SELECT 1 FROM pg_attribute WHERE attrelid = %s::regclass AND attname = %s '
+                                u'AND NOT attisdropped', _regclass(resource_id), column)
+    return result.fetchone() is not None
+
+
+def _add_row_hash(connection, resource_id):
+    if not _has_column(connection, resource_id, ROW_HASH_COLUMN):
+        table = query.quote(resource_id)
+        connection.execute(_ROW_HASH_FUNCTION_SQL)
+        connection.execute(u'ALTER TABLE {0} ADD COLUMN "{1}" text'.format(table, ROW_HASH_COLUMN))
+        connection.execute(u'CREATE TRIGGER "{0}" BEFORE INSERT OR UPDATE ON {1} '
+                           u'FOR EACH ROW EXECUTE PROCEDURE "_restful_row_hash"()'.format(ROW_HASH_COLUMN, table))
+
+
+def _add_versions(connection, resource_id, identifier):
+    if _has_column(connection, resource_id, VERSION_COLUMN):
+        return
+
+    # Deleted rows are recorded by their identifier
+    if identifier not in _get_field_ids(connection, resource_id):
+        raise plugins.toolkit.ValidationError({
+            'fields': ['The resource "%s" has no "%s" field to identify its records' % (resource_id, identifier)]
+        })
+
+    table = query.quote(resource_id)
+    column = query.quote(VERSION_COLUMN)
+
+    # The objects shared by all the resources are created once
+    connection.execute(u'SELECT pg_advisory_xact_lock(%s, hashtext(%s))', WRITE_LOCK_NAMESPACE, TOMBSTONES_TABLE)
+    connection.execute(u'CREATE SEQUENCE IF NOT EXISTS "{0}"'.format(_VERSIONS_SEQUENCE))
+    connection.execute(u'CREATE TABLE IF NOT EXISTS "{0}" (resource_id text NOT NULL, {1} bigint NOT NULL, '
+                       u'version bigint NOT NULL)'.format(TOMBSTONES_TABLE, query.quote(identifier)))
+    connection.execute(u'CREATE INDEX IF NOT EXISTS "{0}_idx" ON "{0}" (resource_id, version)'.format(TOMBSTONES_TABLE))
+    connection.execute(_VERSION_FUNCTION_SQL.format(WRITE_LOCK_NAMESPACE, TOMBSTONES_TABLE, query.quote(identifier),
+                                                    _VERSIONS_SEQUENCE, VERSION_COLUMN))
+
+    # Existing rows are numbered as if they had just been written
+    connection.execute(u"ALTER TABLE {0} ADD COLUMN {1} bigint NOT NULL DEFAULT nextval('\"{2}\"')".format(
+        table, column, _VERSIONS_SEQUENCE))
+    connection.execute(u'CREATE INDEX ON {0} ({1})'.format(table, column))
+    connection.execute(u'CREATE TRIGGER {0} BEFORE INSERT OR UPDATE ON {1} '
+                       u'FOR EACH ROW EXECUTE PROCEDURE "_restful_row_version"()'.format(column, table))
+    connection.execute(u'CREATE TRIGGER "{0}_delete" AFTER DELETE ON {1} '
+                       u'FOR EACH ROW EXECUTE PROCEDURE "_restful_row_version"()'.format(VERSION_COLUMN, table))
+
+
+def _check_versions(connection, resource_id):
+    if not _has_column(connection, resource_id, VERSION_COLUMN):
+        raise plugins.toolkit.ValidationError({
+            'resource_id': ['The changes of the resource "%s" are not tracked' % resource_id]
+        })
+
+
+def _write_version(connection, resource_id):
+    # Both maximums are read backwards from their indexes
+    sql = (u'SELECT greatest((SELECT max({0}) FROM {1}), (SELECT max(version) FROM "{2}" '
+           u'WHERE resource_id = %s), 0)').format(query.quote(VERSION_COLUMN), query.quote(resource_id),
+                                                  TOMBSTONES_TABLE)
+    return connection.execute(sql, resource_id).scalar()
+
+
+def _export_sql(resource_id, identifier, field_ids, bounded=False):
+    column = query.quote(identifier)
+    sql = u'SELECT {0} FROM {1}'.format(u', '.join(query.quote(field_id) for field_id in field_ids),
+                                        query.quote(resource_id))
+    if bounded:
+        sql += u' WHERE {0} >= %s AND {0} < %s'.format(column)
+    return sql + u' ORDER BY {0}'.format(column)
+
+
+def upsert_entry(resource_id, identifier, record):
+    '''Inserts or updates the record with the given identifier, unless it was
+    last written with the same content. Returns whether it has been written.'''
+
+    row_hash = _row_hash(record)
+
+    with unit_of_work(resource_id) as context:
+        connection = context['connection']
+        _add_row_hash(connection, resource_id)
+
+        result = connection.execute(u'SELECT "{0}" FROM {1} WHERE {2} = %s FOR UPDATE'.format(
+            ROW_HASH_COLUMN, query.quote(resource_id), query.quote(identifier)), record[identifier])
+        row = result.fetchone()
+        if row is not None and row[0] == row_hash:
+            return False
+
+        connection.execute(u'SELECT set_config(%s, %s, true)', _ROW_HASH_SETTING, row_hash)
+        # The DataStore replaces nested values by their serialization
+        datastore_db.upsert_data(context, {'resource_id': resource_id, 'records': [dict(record)], 'method': 'upsert'})
+
+    return True
+
+
+def delete_entry(resource_id, identifier, entry_id):
+    '''Deletes the record with the given identifier, that is locked before.
+    Returns whether it existed.'''
+
+    with unit_of_work(resource_id) as context:
+        result = context['connection'].execute(u'SELECT 1 FROM {0} WHERE {1} = %s FOR UPDATE'.format(
+            query.quote(resource_id), query.quote(identifier)), entry_id)
+        if result.fetchone() is None:
+            return False
+
+        datastore_db.delete_data(context, {'resource_id': resource_id, 'filters': {identifier: entry_id}})
+
+    return True
+
+
+def track_changes(resource_id, identifier):
+    '''Starts tracking the versions of the rows of a resource, unless they are
+    already tracked. All the rows existing by then are numbered as changes,
+    which rewrites the table, so it is done when the resource is created
+    or by an administrator, never while reading.'''
+
+    with unit_of_work(resource_id) as context:
+        _add_versions(context['connection'], resource_id, identifier)
+
+
+def changes(resource_id, identifier, since=0, limit=1000):
+    '''Returns the rows of a resource written after the given version and the
+    identifiers of the rows deleted after it, sorted by version. Raises
+    ValidationError when the changes of the resource are not tracked.'''
+
+    connection = get_engine(write=True).connect()
+
+    try:
+        with translate_errors():
+            trans = connection.begin()
+            try:
+                _set_timeout(connection, datastore_db._TIMEOUT)
+                # Waits for the writes in progress, whose versions could be lower than the committed ones
+                connection.execute(u'SELECT pg_advisory_xact_lock_shared(%s, hashtext(%s))',
+                                   WRITE_LOCK_NAMESPACE, resource_id)
+                _check_versions(connection, resource_id)
+
+                table = query.quote(resource_id)
+                column = query.quote(VERSION_COLUMN)
+                field_ids = _get_field_ids(connection, resource_id)[1:]
+                sql = u'SELECT {0}, {1} AS "_version" FROM {2} WHERE {1} > %s ORDER BY {1} LIMIT %s'.format(
+                    u', '.join(query.quote(field_id) for field_id in field_ids), column, table)
+                result = format_results(connection, connection.execute(sql, since, limit), {})
+
+                records = [dict(record, _deleted=False) for record in result['records']]
+                tombstones = connection.execute(u'SELECT {0}, version FROM "{1}" WHERE resource_id = %s AND '
+                                                u'version > %s ORDER BY version LIMIT %s'.format(
+                                                    query.quote(identifier), TOMBSTONES_TABLE),
+                                                resource_id, since, limit)
+                records.extend({identifier: row[0], '_version': row[1], '_deleted': True} for row in tombstones)
+                trans.commit()
+            except Exception:
+                trans.rollback()
+                raise
+    finally:
+        connection.close()
+
+    records.sort(key=lambda record: record['_version'])
+    records = records[:limit]
+
+    return {
+        'resource_id': resource_id,
+        'since': since,
+        'fields': [field for field in result['fields'] if field['id'] != '_version'],
+        'records': records,
+        'next': records[-1]['_version'] if records else since,
+        'more': len(records) == limit
+    }
+
+
+def write_version(resource_id, identifier):
+    '''Returns the version of the last committed write of a resource, which
+    changes every time one of its rows is written or deleted. Raises
+    ValidationError when the changes of the resource are not tracked.'''
+
+    connection = get_engine(write=True).connect()
+
+    try:
+        with translate_errors():
+            _check_versions(connection, resource_id)
+            return _write_version(connection, resource_id)
+    finally:
+        connection.close()
+
+
+def export_records(resource_id, identifier):
+    '''Returns the version of a resource and all its rows sorted by their
+    identifier, which are fetched on demand. Both are read from the same
+    snapshot, so the rows are exactly the ones of that version.'''
+
+    batch_size = int(config.get(STREAM_BATCH_SIZE, DEFAULT_STREAM_BATCH_SIZE))
+    connection = get_engine(write=True).connect()
+
+    try:
+        with translate_errors():
+            _check_versions(connection, resource_id)
+            datastore_db._cache_types({'connection': connection})
+            connection = connection.execution_options(isolation_level='REPEATABLE READ')
+
+            trans = connection.begin()
+            try:
+                version = _write_version(connection, resource_id)
+
+                field_ids = _get_field_ids(connection, resource_id)[1:]
+                results = connection.execution_options(stream_results=True).execute(
+                    _export_sql(resource_id, identifier, field_ids))
+                return version, StreamedRecords(connection, trans, results, batch_size, 0)
+            except Exception:
+                trans.rollback()
+                raise
+    except Exception:
+        connection.close()
+        raise
+
+
+@contextlib.contextmanager
+def export_snapshot(resource_id, identifier):
+    '''Keeps a snapshot of a resource open while the block runs, so other
+    sessions can read exactly the same rows through export_range. Yields the
+    version of the resource, the name of the snapshot, the fields and the
+    lowest and the highest identifiers of the rows.'''
+
+    connection = get_engine(write=True).connect()
+
+    try:
+        with translate_errors():
+            _check_versions(connection, resource_id)
+            datastore_db._cache_types({'connection': connection})
+            connection = connection.execution_options(isolation_level='REPEATABLE READ')
+
+            trans = connection.begin()
+            try:
+                version = _write_version(connection, resource_id)
+                snapshot = connection.execute(u'SELECT pg_export_snapshot()').scalar()
+                field_ids = _get_field_ids(connection, resource_id)[1:]
+                lower, upper = connection.execute(u'SELECT min({0}), max({0}) FROM {1}'.format(
+                    query.quote(identifier), query.quote(resource_id))).fetchone()
+
+                yield {
+                    'version': version,
+                    'snapshot': snapshot,
+                    'field_ids': field_ids,
+                    'lower': lower,
+                    'upper': upper
+                }
+            finally:
+                trans.rollback()    # Read only, nothing to commit
+    finally:
+        connection.close()
+
+
+def export_range(engine, snapshot, resource_id, identifier, field_ids, lower=None, upper=None):
+    '''Returns the rows of a resource whose identifier is between lower
+    (included) and upper (excluded), as they were in an exported snapshot,
+    sorted by their identifier. Rows are read through the given engine,
+    which can belong to another process, and fetched on demand.'''
+
+    batch_size = int(config.get(STREAM_BATCH_SIZE, DEFAULT_STREAM_BATCH_SIZE))
+    connection = engine.connect()
+
+    try:
+        with translate_errors():
+            connection = connection.execution_options(isolation_level='REPEATABLE READ')
+            trans = connection.begin()
+            try:
+                connection.execute(u'SET TRANSACTION SNAPSHOT %s', snapshot)
+                sql = _export_sql(resource_id, identifier, field_ids, lower is not None)
+                params = (lower, upper) if lower is not None else ()
+                results = connection.execution_options(stream_results=True).execute(sql, *params)
+                return StreamedRecords(connection, trans, results, batch_size, 0)
+            except Exception:
+                trans.rollback()
+                raise
+    except Exception:
+        connection.close()
+        raise
+
+
+def list_indexes(resource_id, name=None):
+    '''Returns the indexes of a resource with their size and the number of
+    scans that have used them since the statistics were reset. Indexes
+    created through the restful API are listed with the name they were
+    created with and flagged as managed.'''
+
+    prefix = _index_prefix(resource_id)
+    table = _regclass(resource_id)
+    connection = get_engine(write=True).connect()
+
+    try:
+        with translate_errors():
+            if name is None:
+                results = connection.execute(_INDEXES_SQL.format(u''), table)
+            else:
+                results = connection.execute(_INDEXES_SQL.format(u' AND c.relname = %s'), table, prefix + name)
+            return [_format_index(prefix, row) for row in results]
+    finally:
+        connection.close()
+
+
+def create_index(resource_id, name, fields, method=INDEX_BTREE, unique=False, language=DEFAULT_INDEX_LANGUAGE):
+    '''Builds an index of the given fields concurrently, so the resource can
+    still be written while it is being built. An existing index with the
+    same name is replaced. B-tree indexes can be unique while GIN indexes
+    are built over the text search vector of the fields.'''
+
+    index_name = query.quote(_index_prefix(resource_id) + name)
+    table = query.quote(resource_id)
+    connection = get_engine(write=True).connect()
+
+    try:
+        with translate_errors():
+            trans = connection.begin()
+            try:
+                field_ids = _get_field_ids(connection, resource_id)
+                for field in fields:
+                    query._check_field(field, field_ids, 'fields')
+                trans.commit()
+            except Exception:
+                trans.rollback()
+                raise
+
+            expression, values = _index_expression(fields, method, language)
+            statement = u'CREATE {0}INDEX CONCURRENTLY {1} ON {2} {3}'.format(
+                u'UNIQUE ' if unique else u'', index_name, table, expression)
+
+            with _autocommit(connection):
+                connection.execute(u'DROP INDEX CONCURRENTLY IF EXISTS {0}'.format(index_name))
+                try:
+                    _execute(connection, statement, values)
+                except DBAPIError as e:
+                    # Failed builds leave an invalid index behind
+                    connection.execute(u'DROP INDEX CONCURRENTLY IF EXISTS {0}'.format(index_name))
+                    if isinstance(e, IntegrityError):
+                        raise plugins.toolkit.ValidationError({
+                            'unique': [str(e.orig)]
+                        })
+                    raise
+
+        return list_indexes(resource_id, name)[0]
+    finally:
+        connection.close()
+
+
+def drop_index(resource_id, name):
+    '''Drops concurrently an index created through the restful API'''
+
+    index_name = _index_prefix(resource_id) + name
+    connection = get_engine(write=True).connect()
+
+    try:
+        with translate_errors():
+            if not list_indexes(resource_id, name):
+                raise plugins.toolkit.ObjectNotFound(plugins.toolkit._(
+                    'Index "{0}" was not found.'.format(name)
+                ))
+
+            with _autocommit(connection):
+                connection.execute(u'DROP INDEX CONCURRENTLY IF EXISTS {0}'.format(query.quote(index_name)))
+    finally:
+        connection.close()
+
+
+def stream_enabled():
+    return plugins.toolkit.asbool(config.get(STREAM_SQL, False))
+
+
+def format_results(connection, results, data_dict):
+    return datastore_db.format_results({'connection': connection}, results, data_dict)
+
+
+def _statement_key(sql):
+    # Comments and backslash escapes are not understood by the normalization,
+    # so those statements are only shared when they are exactly the same
+    if '--' in sql or '/*' in sql or '\\' in sql:
+        return sql
+    return stats.normalize_sql(sql, keep_literals=True)
+
+
+class PreparedStatements(object):
+    '''LRU of the statements prepared in a database session. Statements are
+    keyed by their normalized template, but the original SQL is the one
+    prepared. The least recently used one is deallocated when the capacity
+    is exceeded.'''
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._statements = OrderedDict()
+        self._counter = 0
+
+    def __len__(self):
+        return len(self._statements)
+
+    def _deallocate(self, connection, name):
+        try:
+            connection.execute(u'DEALLOCATE {0}'.format(name))
+        except DBAPIError:
+            log.warn('Unable to deallocate the prepared statement %s', name)
+
+    def prepare(self, connection, sql):
+        '''Returns the name of the statement prepared for the SQL template and
+        whether it has just been prepared'''
+        key = _statement_key(sql)
+
+        if key in self._statements:
+            name = self._statements.pop(key)
+            self._statements[key] = name
+            return name, False
+
+        self._counter += 1
+        name = 'datastore_restful_%d' % self._counter
+        connection.execute(u'PREPARE {0} AS {1}'.format(name, sql.replace('%', '%%')))
+        self._statements[key] = name
+
+        while len(self._statements) > self.capacity:
+            _, evicted = self._statements.popitem(last=False)
+            self._deallocate(connection, evicted)
+
+        return name, True
+
+    def discard(self, connection, sql):
+        name = self._statements.pop(_statement_key(sql), None)
+        if name:
+            self._deallocate(connection, name)
+
+
+def execute_sql(sql):
+    '''Executes a read-only SQL statement once its estimate has been checked
+    against the configured limits'''
+
+    connection = get_engine().connect()
+    sql = sql.replace('%', '%%')
+
+    try:
+        with translate_errors():
+            trans = connection.begin()
+            try:
+                _set_timeout(connection)
+                plan = explain(connection, sql)
+                _check_system_tables(plan)
+
+                release = admit(plan)
+                try:
+                    results = connection.execute(sql)
+                    result = format_results(connection, results, {'sql': sql})
+                finally:
+                    release()
+
+                trans.commit()
+                return result
+            except Exception:
+                trans.rollback()
+                raise
+    finally:
+        connection.close()
+
+
+def execute_prepared(sql, params):
+    '''Executes a SQL template with bound parameters ($1, $2...) through a
+    prepared statement of the read-only connection'''
+
+    connection = get_engine().connect()
+
+    try:
+        with translate_errors():
+            statements = _get_prepared_statements(connection)
+            execute = u'EXECUTE {0}'
+            if params:
+                execute += u' ({0})'.format(', '.join(['%s'] * len(params)))
+
+            trans = connection.begin()
+            try:
+                _set_timeout(connection)
+                name, prepared = statements.prepare(connection, sql)
+
+                # Tables are checked only once, when the statement is prepared,
+                # but estimates depend on the values of the parameters
+                plan = None
+                if prepared or admission_enabled():
+                    plan = explain(connection, execute.format(name), params)
+                if prepared:
+                    _check_system_tables(plan)
+            except Exception:
+                trans.rollback()
+                statements.discard(connection, sql)
+                raise
+
+            try:
+                release = admit(plan) if plan else _release_nothing
+                try:
+                    results = _execute(connection, execute.format(name), params)
+                    result = format_results(connection, results, {'sql': sql, 'params': params})
+                finally:
+                    release()
+
+                trans.commit()
+                return result
+            except Exception:
+                trans.rollback()
+                raise
+    finally:
+        connection.close()
+
+
+class StreamedRecords(object):
+    '''Records of a query that are fetched in batches from a server-side
+    cursor while they are being serialized. The first batch is fetched on
+    creation so errors are raised before the response is started. The
+    transaction and the connection are released once the records have been
+    consumed.'''
+
+    def __init__(self, connection, trans, results, batch_size, max_rows, release=_release_nothing):
+        self._connection = connection
+        self._trans = trans
+        self._results = results
+        self._release = release
+        self._closed = False
+        self.batch_size = batch_size
+        self.max_rows = max_rows
+        self.count = 0
+        self.truncated = False
+
+        # The description of a named cursor is only available after fetching
+        self._first = results.fetchmany(batch_size)
+
+        context = {'connection': connection}
+        self.fields = datastore_db._unrename_json_field({'fields': [{
+            'id': field[0].decode('utf-8'),
+            'type': datastore_db._get_type(context, field[1])
+        } for field in results.cursor.description]})['fields']
+
+    def _convert(self, row):
+        record = OrderedDict()
+        for position, field in enumerate(self.fields):
+            record[field['id']] = datastore_db.convert(row[position], field['type'])
+        return record
+
+    def batches(self):
+        try:
+            batch = self._first
+            self._first = None
+
+            while batch:
+                if self.max_rows and self.count + len(batch) > self.max_rows:
+                    batch = batch[:self.max_rows - self.count]
+                    self.truncated = True
+
+                self.count += len(batch)
+                yield [self._convert(row) for row in batch]
+
+                if self.truncated:
+                    break
+                elif self.max_rows and self.count == self.max_rows:
+                    self.truncated = len(self._results.fetchmany(1)) > 0
+                    break
+
+                batch = self._results.fetchmany(self.batch_size)
+        except Exception:
+            # The response has already been started, so it can only be cut
+            log.exception('Unable to stream the query results')
+            self.truncated = True
+        finally:
+            self.close()
+
+    def __iter__(self):
+        for batch in self.batches():
+            for record in batch:
+                yield record
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            try:
+                self._results.close()
+                self._trans.rollback()    # Read only, nothing to commit
+            finally:
+                self._release()
+                self._connection.close()
+
+
+def stream_sql(sql):
+    '''Executes a read-only SQL statement through a server-side cursor and
+    returns its records, which are fetched on demand'''
+
+    batch_size = int(config.get(STREAM_BATCH_SIZE, DEFAULT_STREAM_BATCH_SIZE))
+    max_rows = int(config.get(STREAM_MAX_ROWS, DEFAULT_STREAM_MAX_ROWS))
+    sql = sql.replace('%', '%%')
+
+    connection = get_engine().connect()
+
+    try:
+        with translate_errors():
+            datastore_db._cache_types({'connection': connection})
+            trans = connection.begin()
+            try:
+                _set_timeout(connection)
+                plan = explain(connection, sql)
+                _check_system_tables(plan)
+
+                release = admit(plan)
+                try:
+                    results = connection.execution_options(stream_results=True).execute(sql)
+                    return StreamedRecords(connection, trans, results, batch_size, max_rows, release)
+                except Exception:
+                    release()
+                    raise
+            except Exception:
+                trans.rollback()
+                raise
+    except Exception:
+        connection.close()
+        raise
@@ -0,0 +1,348 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN DataStore Restful Extension.
+
+# CKAN DataStore Restful Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN DataStore Restful Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN DataStore Restful Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import fcntl
+import glob
+import gzip
+import hashlib
+import logging
+import multiprocessing
+import os
+import shutil
+import sqlalchemy
+import tempfile
+import threading
+
+import ckan.lib.helpers as helpers
+import ckanext.datastore_restful.db as db
+import ckanext.datastore_restful.response_parser as response_parser
+import ckanext.datastore_restful.stats as stats
+import ckanext.datastore_restful.utils as utils
+
+from paste.fileapp import FileApp
+from paste.httpheaders import RANGE
+from pylons import config
+from sqlalchemy.pool import NullPool
+
+log = logging.getLogger(__name__)
+
+# Full exports of the resources are written to compressed files, which are
+# served with range requests. They are regenerated in the background when
+# the resource has been written after them, so the database is only read
+# once for each version of the resource. Big resources can be exported by a
+# pool of processes from the paster command, outside the web server: each
+# one writes the rows of a range of identifiers, read from the same
+# snapshot, to a compressed part. The parts are then concatenated in order,
+# since a gzip file can be made of several members
+
+EXPORT_DIRECTORY = 'ckanext.datastore_restful.export_directory'
+DEFAULT_EXPORT_DIRECTORY = os.path.join(tempfile.gettempdir(), 'ckanext_datastore_restful_exports')
+EXTENSIONS = {
+    utils.CSV: '.csv.gz',
+    utils.JSON: '.json.gz'
+}
+FORMATS = sorted(EXTENSIONS)
+SEPARATORS = {
+    utils.CSV: '',
+    utils.JSON: ', '
+}
+EXPORT_PROCESSES = 'ckanext.datastore_restful.export_processes'
+DEFAULT_EXPORT_PROCESSES = 1    # Exports are written by a single process
+PARTS_PER_PROCESS = 4           # Smaller parts balance the work of the processes
+RETRY_AFTER = 5     # seconds
+KEPT_EXPORTS = 2    # The previous export may still be being downloaded
+
+_lock = threading.Lock()
+_generators = {}
+_worker_engine = None
+
+
+###############################################################################################
+#########################################  AUXILIAR  ##########################################
+###############################################################################################
+
+def _directory():
+    directory = config.get(EXPORT_DIRECTORY, DEFAULT_EXPORT_DIRECTORY)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):    # Created by another process meanwhile
+                raise
+    return directory
+
+
+def _prefix(resource_id):
+    return os.path.join(_directory(), hashlib.md5(resource_id.encode('utf-8')).hexdigest() + '.')
+
+
+def _exports(resource_id, fmt):
+    '''Returns the versions of the exports of a resource, newest first'''
+    prefix, extension = _prefix(resource_id), EXTENSIONS[fmt]
+    versions = [path[len(prefix):-len(extension)] for path in glob.glob(prefix + '*' + extension)]
+    return sorted((int(version) for version in versions if version.isdigit()), reverse=True)
+
+
+def _encode(chunks):
+    return (chunk.encode('utf-8') if isinstance(chunk, unicode) else chunk for chunk in chunks)
+
+
+def _compress(f, chunks):
+    # Every call writes a complete gzip member
+    compressed = gzip.GzipFile(filename='', mode='wb', fileobj=f)
+    for chunk in _encode(chunks):
+        compressed.write(chunk)
+    compressed.close()
+
+
+def _head(fmt, field_ids):
+    if fmt == utils.CSV:
+        return response_parser.csv_stream_head(field_ids)
+    return response_parser.json_stream_head()
+
+
+def _body(records, fmt):
+    if fmt == utils.CSV:
+        chunks = response_parser.csv_stream_records(records)
+    else:
+        chunks = response_parser.json_stream_records(records, helpers.json.dumps)
+
+    separator = ''
+    for chunk in chunks:
+        yield separator + chunk
+        separator = SEPARATORS[fmt]
+
+
+def _tail(fmt):
+    return '' if fmt == utils.CSV else response_parser.json_stream_tail(False)
+
+
+def _ranges(lower, upper, parts):
+    '''Splits the identifiers from lower to upper into consecutive ranges,
+    which include their start but not their end'''
+    if not isinstance(lower, (int, long)) or not isinstance(upper, (int, long)):
+        return [(None, None)]     # Only integers can be split
+
+    width = max(1, -(-(upper - lower + 1) // parts))
+    return [(start, start + width) for start in xrange(lower, upper + 1, width)]
+
+
+def _init_worker(url):
+    # The connections inherited from the parent process can not be used
+    global _worker_engine
+    _worker_engine = sqlalchemy.create_engine(url, poolclass=NullPool)
+
+
+def _export_part(args):
+    '''Writes the rows of a range to a compressed part and returns how many
+    they are. Runs in the processes of the pool, so errors are reported by
+    the parent process.'''
+    snapshot, resource_id, identifier, field_ids, lower, upper, fmt, path = args
+
+    try:
+        records = db.export_range(_worker_engine, snapshot, resource_id, identifier, field_ids, lower, upper)
+        try:
+            with open(path, 'wb') as f:
+                _compress(f, _body(records, fmt))
+        finally:
+            records.close()
+
+        if records.truncated:
+            raise IOError('The records could not be read')
+        return records.count
+    except Exception as e:
+        # Exceptions are sent back pickled, which not all of them support
+        raise IOError('Unable to export the range [%s, %s): %s: %s' % (lower, upper, type(e).__name__, e))
+
+
+def _write(records, fmt, path):
+    descriptor, temporary = tempfile.mkstemp(prefix=os.path.basename(path) + '.', dir=os.path.dirname(path))
+
+    try:
+        with os.fdopen(descriptor, 'wb') as f:
+            _compress(f, utils.stream_response({'records': records}, fmt, 'records'))
+
+        # Reading errors are swallowed by the records to cut the responses
+        if records.truncated:
+            raise IOError('The records could not be read')
+
+        os.rename(temporary, path)
+    except Exception:
+        os.remove(temporary)
+        raise
+
+
+def _write_parts(snapshot, resource_id, fmt, identifier, path, processes):
+    descriptor, temporary = tempfile.mkstemp(prefix=os.path.basename(path) + '.', dir=os.path.dirname(path))
+    ranges = _ranges(snapshot['lower'], snapshot['upper'], processes * PARTS_PER_PROCESS)
+    parts = ['%s.%d' % (temporary, position) for position in range(len(ranges))]
+
+    try:
+        with os.fdopen(descriptor, 'wb') as f:
+            pool = multiprocessing.Pool(min(processes, len(ranges)), _init_worker, (config[db.WRITE_URL],))
+            try:
+                counts = pool.map(_export_part, [(snapshot['snapshot'], resource_id, identifier,
+                                                  snapshot['field_ids'], lower, upper, fmt, part)
+                                                 for (lower, upper), part in zip(ranges, parts)], chunksize=1)
+            finally:
+                pool.terminate()
+                pool.join()
+
+            _compress(f, [_head(fmt, snapshot['field_ids'])])
+            written = False
+            for part, count in zip(parts, counts):
+                if count:
+                    if written and SEPARATORS[fmt]:
+                        _compress(f, [SEPARATORS[fmt]])
+                    with open(part, 'rb') as compressed_part:
+                        shutil.copyfileobj(compressed_part, f)
+                    written = True
+            if _tail(fmt):
+                _compress(f, [_tail(fmt)])
+
+        os.rename(temporary, path)
+    except Exception:
+        os.remove(temporary)
+        raise
+    finally:
+        for part in parts:
+            if os.path.exists(part):
+                os.remove(part)
+
+
+def _generate_serial(resource_id, fmt, identifier):
+    version, records = db.export_records(resource_id, identifier)
+    try:
+        path = export_path(resource_id, fmt, version)
+        if not os.path.exists(path):
+            _write(records, fmt, path)
+            stats.increment('exports.generated')
+    finally:
+        records.close()
+
+
+def _generate_parallel(resource_id, fmt, identifier, processes):
+    # The snapshot is kept while the processes read it
+    with db.export_snapshot(resource_id, identifier) as snapshot:
+        path = export_path(resource_id, fmt, snapshot['version'])
+        if not os.path.exists(path):
+            _write_parts(snapshot, resource_id, fmt, identifier, path, processes)
+            stats.increment('exports.generated')
+
+
+def _run(resource_id, fmt, identifier):
+    try:
+        generate(resource_id, fmt, identifier)
+    except Exception:
+        log.exception('Unable to export the resource %s', resource_id)
+        stats.increment('exports.failed')
+
+
+def _start(resource_id, fmt, identifier):
+    key = (resource_id, fmt)
+
+    # Threads are not inherited by the processes forked by the server, so they are not alive there
+    with _lock:
+        if key not in _generators or not _generators[key].is_alive():
+            _generators[key] = threading.Thread(target=_run, args=(resource_id, fmt, identifier),
+                                                name='datastore_restful-export')
+            _generators[key].daemon = True
+            _generators[key].start()
+
+
+###############################################################################################
+###########################################  MAIN  ############################################
+###############################################################################################
+
+def export_path(resource_id, fmt, version):
+    return '%s%d%s' % (_prefix(resource_id), version, EXTENSIONS[fmt])
+
+
+def etag(fmt, version):
+    # Versions are global, so they identify the content of every resource
+    return '"%d-%s"' % (version, fmt)
+
+
+def generate(resource_id, fmt, identifier, processes=1):
+    '''Writes the export of the current version of a resource, unless it is
+    already being written by another process, and returns whether it has
+    been written. Older exports are removed. With more than one process,
+    the export is split among a pool forked by this function, so it can
+    only be used outside the web server (paster datastore_restful export),
+    whose threads could leave the forked processes with held locks.'''
+
+    with open(_prefix(resource_id) + fmt + '.lock', 'a') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            return False
+
+        if processes > 1:
+            _generate_parallel(resource_id, fmt, identifier, processes)
+        else:
+            _generate_serial(resource_id, fmt, identifier)
+
+        for old_version in _exports(resource_id, fmt)[KEPT_EXPORTS:]:
+            os.remove(export_path(resource_id, fmt, old_version))
+
+    return True
+
+
+def get_export(resource_id, fmt, version, identifier):
+    '''Returns the version of the newest export of a resource (None if there
+    is none) and whether it is older than the given version of the resource.
+    Missing and stale exports are generated in the background by a single
+    thread.'''
+
+    exports = _exports(resource_id, fmt)
+    export_version = exports[0] if exports else None
+    stale = export_version is None or export_version < version
+
+    if stale:
+        _start(resource_id, fmt, identifier)
+    stats.increment('exports.stale' if stale else 'exports.current')
+
+    return {'export_version': export_version, 'stale': stale}
+
+
+class ExportApp(FileApp):
+    '''Serves an export file. Ranges are only honoured when If-Range, if
+    sent, matches the ETag of the export, so resumed downloads never mix two
+    versions. Files are sent through the server's file wrapper (sendfile)
+    unless the range has an end, which file wrappers do not respect.'''
+
+    def __init__(self, filename, etag, headers=None, **kwargs):
+        FileApp.__init__(self, filename, headers, **kwargs)
+        self.etag = etag
+
+    def calculate_etag(self):
+        return self.etag
+
+    def __call__(self, environ, start_response):
+        environ = dict(environ)
+
+        if_range = environ.get('HTTP_IF_RANGE')
+        if if_range is not None and if_range.strip() != self.etag:
+            environ.pop('HTTP_RANGE', None)
+
+        ranges = RANGE.parse(environ)
+        if ranges and ranges[1] and ranges[1][0][1] is not None:
+            environ.pop('wsgi.file_wrapper', None)
+
+        return FileApp.__call__(self, environ, start_response)
@@ -18,14 +18,70 @@
 # along with CKAN DataStore Restful Extension.  If not, see <http://www.gnu.org/licenses/>.
 
 import ckan.plugins as plugins
+import ckanext.datastore_restful.actions as actions
+import ckanext.datastore_restful.advisor as advisor
+import ckanext.datastore_restful.auth as auth
+import ckanext.datastore_restful.stats as stats
+import ckanext.datastore_restful.webhooks as webhooks
+
+DATASTORE_URLS = ['ckan.datastore.write_url', 'ckan.datastore.read_url']
 
 GET = dict(method=['GET'])
 PUT = dict(method=['PUT'])
 POST = dict(method=['POST'])
 DELETE = dict(method=['DELETE'])
+HEAD = dict(method=['HEAD'])
 
 class RestfulDataStorePlugin(plugins.SingletonPlugin):
     plugins.implements(plugins.IRoutes, inherit=True)
+    plugins.implements(plugins.IConfigurable)
+    plugins.implements(plugins.IActions)
+    plugins.implements(plugins.IAuthFunctions)
+
+    def configure(self, config):
+        import ckanext.datastore.db as datastore_db
+
+        # Count the statements sent to the DataStore database by each request
+        for url in DATASTORE_URLS:
+            if url in config:
+                stats.instrument_engine(datastore_db._get_engine({'connection_url': config[url]}))
+
+        if 'ckan.datastore.write_url' in config:
+            webhooks.create_webhooks_table()
+            advisor.create_workload_table()
+
+    def get_actions(self):
+        return {
+            'datastore_restful_metrics': actions.datastore_restful_metrics,
+            'datastore_restful_search': actions.datastore_restful_search,
+            'datastore_restful_aggregate': actions.datastore_restful_aggregate,
+            'datastore_restful_downsample': actions.datastore_restful_downsample,
+            'datastore_restful_search_sql': actions.datastore_restful_search_sql,
+            'datastore_restful_stream_sql': actions.datastore_restful_stream_sql,
+            'datastore_restful_upsert_resource': actions.datastore_restful_upsert_resource,
+            'datastore_restful_delete_resource': actions.datastore_restful_delete_resource,
+            'datastore_restful_track_changes': actions.datastore_restful_track_changes,
+            'datastore_restful_changes': actions.datastore_restful_changes,
+            'datastore_restful_export': actions.datastore_restful_export,
+            'datastore_restful_create_entries': actions.datastore_restful_create_entries,
+            'datastore_restful_upsert_entry': actions.datastore_restful_upsert_entry,
+            'datastore_restful_delete_entry': actions.datastore_restful_delete_entry,
+            'datastore_restful_index_list': actions.datastore_restful_index_list,
+            'datastore_restful_index_create': actions.datastore_restful_index_create,
+            'datastore_restful_index_delete': actions.datastore_restful_index_delete,
+            'datastore_restful_webhook_list': actions.datastore_restful_webhook_list,
+            'datastore_restful_webhook_create': actions.datastore_restful_webhook_create,
+            'datastore_restful_webhook_delete': actions.datastore_restful_webhook_delete,
+            'datastore_restful_advisor': actions.datastore_restful_advisor,
+            'datastore_restful_advisor_apply': actions.datastore_restful_advisor_apply
+        }
+
+    def get_auth_functions(self):
+        return {
+            'datastore_restful_metrics': auth.datastore_restful_metrics,
+            'datastore_restful_advisor': auth.datastore_restful_advisor,
+            'datastore_restful_advisor_apply': auth.datastore_restful_advisor_apply
+        }
 
     def after_map(self, m):
         #Create/update the resource
@@ -45,6 +101,26 @@ class RestfulDataStorePlugin(plugins.SingletonPlugin):
         m.connect('/resource/{resource_id}/entry',
                   controller='ckanext.datastore_restful.controller:RestfulDatastoreController',
                   action='search_entries', conditions=GET)
+        #Count the entries of the resource
+        m.connect('/resource/{resource_id}/entry',
+                  controller='ckanext.datastore_restful.controller:RestfulDatastoreController',
+                  action='count_entries', conditions=HEAD)
+        #Aggregate the entries
+        m.connect('/resource/{resource_id}/aggregate',
+                  controller='ckanext.datastore_restful.controller:RestfulDatastoreController',
+                  action='aggregate', conditions=GET)
+        #Downsample the time series of the entries
+        m.connect('/resource/{resource_id}/downsample',
+                  controller='ckanext.datastore_restful.controller:RestfulDatastoreController',
+                  action='downsample', conditions=GET)
+        #Get the changes of the entries since a version
+        m.connect('/resource/{resource_id}/changes',
+                  controller='ckanext.datastore_restful.controller:RestfulDatastoreController',
+                  action='changes', conditions=GET)
+        #Download a compressed export of all the entries
+        m.connect('/resource/{resource_id}/export',
+                  controller='ckanext.datastore_restful.controller:RestfulDatastoreController',
+                  action='export', conditions=GET)
         #Insert a entry or a set of entries
         m.connect('/resource/{resource_id}/entry',
                   controller='ckanext.datastore_restful.controller:RestfulDatastoreController',
@@ -63,11 +139,58 @@ class RestfulDataStorePlugin(plugins.SingletonPlugin):
                   controller='ckanext.datastore_restful.controller:RestfulDatastoreController',
                   action='delete_entry', conditions=DELETE)
 
+        #List the indexes of the resource
+        m.connect('/resource/{resource_id}/index',
+                  controller='ckanext.datastore_restful.controller:RestfulDatastoreController',
+                  action='list_indexes', conditions=GET)
+        #Create/replace an index
+        m.connect('/resource/{resource_id}/index/{index_name}',
+                  controller='ckanext.datastore_restful.controller:RestfulDatastoreController',
+                  action='upsert_index', conditions=PUT)
+        #Get an index
+        m.connect('/resource/{resource_id}/index/{index_name}',
+                  controller='ckanext.datastore_restful.controller:RestfulDatastoreController',
+                  action='get_index', conditions=GET)
+        #Drop an index
+        m.connect('/resource/{resource_id}/index/{index_name}',
+                  controller='ckanext.datastore_restful.controller:RestfulDatastoreController',
+                  action='delete_index', conditions=DELETE)
+
+        #List the webhooks of the resource
+        m.connect('/resource/{resource_id}/webhook',
+                  controller='ckanext.datastore_restful.controller:RestfulDatastoreController',
+                  action='list_webhooks', conditions=GET)
+        #Create/replace a webhook
+        m.connect('/resource/{resource_id}/webhook/{webhook_name}',
+                  controller='ckanext.datastore_restful.controller:RestfulDatastoreController',
+                  action='upsert_webhook', conditions=PUT)
+        #Get a webhook
+        m.connect('/resource/{resource_id}/webhook/{webhook_name}',
+                  controller='ckanext.datastore_restful.controller:RestfulDatastoreController',
+                  action='get_webhook', conditions=GET)
+        #Remove a webhook
+        m.connect('/resource/{resource_id}/webhook/{webhook_name}',
+                  controller='ckanext.datastore_restful.controller:RestfulDatastoreController',
+                  action='delete_webhook', conditions=DELETE)
+
         #Search SQL
         m.connect('/search_sql', 
                   controller='ckanext.datastore_restful.controller:RestfulDatastoreController',
                   action='sql', conditions=GET)
-        
+
+        #Restful layer metrics
+        m.connect('/datastore_restful/metrics',
+                  controller='ckanext.datastore_restful.controller:RestfulDatastoreController',
+                  action='metrics', conditions=GET)
+
+        #Index advisor
+        m.connect('/datastore_restful/advisor',
+                  controller='ckanext.datastore_restful.controller:RestfulDatastoreController',
+                  action='advisor', conditions=GET)
+        m.connect('/datastore_restful/advisor',
+                  controller='ckanext.datastore_restful.controller:RestfulDatastoreController',
+                  action='apply_advisor', conditions=POST)
+
         return m 
 
 
@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN DataStore Restful Extension.
+
+# CKAN DataStore Restful Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN DataStore Restful Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN DataStore Restful Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import ckan.plugins as plugins
+import ckanext.datastore.db as datastore_db
+
+# Compiles the search requests of the restful API into SQL statements. Values
+# are always bound as parameters (%s) and identifiers are checked against the
+# fields of the resource before being quoted
+
+# Comparison operators of the filters. Values are bound as untyped literals,
+# so they are converted to the type of the column and indexes can be used
+COMPARISONS = {
+    'eq': u'{0} = %s',
+    'ne': u'{0} <> %s',
+    'gt': u'{0} > %s',
+    'gte': u'{0} >= %s',
+    'lt': u'{0} < %s',
+    'lte': u'{0} <= %s'
+}
+OPERATORS = sorted(COMPARISONS.keys() + ['in', 'between', 'null'])
+
+AGGREGATES = ['count', 'sum', 'avg', 'min', 'max']
+
+TIME_UNITS = ['second', 'minute', 'hour', 'day', 'week', 'month', 'quarter', 'year']
+
+# Epoch of the time of each row or bucket, used to downsample the series
+X_COLUMN = u'_x'
+DEFAULT_BUCKETS = 1000
+
+
+###############################################################################################
+#########################################  AUXILIAR  ##########################################
+###############################################################################################
+
+def _check_field(field, field_ids, parameter):
+    if field not in field_ids:
+        raise plugins.toolkit.ValidationError({
+            parameter: [u'field "{0}" not in table'.format(field)]
+        })
+
+
+def _get_values(operator, value):
+    # Lists can be given as comma separated strings
+    values = value.split(',') if isinstance(value, basestring) else value
+    if not isinstance(values, list) or not values:
+        raise plugins.toolkit.ValidationError({
+            'filters': [u'operator "{0}" requires a list of values'.format(operator)]
+        })
+    return values
+
+
+def _operator_clause(column, operator, value):
+    if operator in COMPARISONS:
+        return COMPARISONS[operator].format(column), [value]
+    elif operator == 'in':
+        values = _get_values(operator, value)
+        return u'{0} IN ({1})'.format(column, u', '.join([u'%s'] * len(values))), values
+    elif operator == 'between':
+        values = _get_values(operator, value)
+        if len(values) != 2:
+            raise plugins.toolkit.ValidationError({
+                'filters': [u'operator "between" requires two values']
+            })
+        return u'{0} BETWEEN %s AND %s'.format(column), values
+    elif operator == 'null':
+        try:
+            is_null = plugins.toolkit.asbool(value)
+        except ValueError:
+            raise plugins.toolkit.ValidationError({
+                'filters': [u'operator "null" requires a boolean']
+            })
+        return u'{0} IS {1}NULL'.format(column, u'' if is_null else u'NOT '), []
+    else:
+        raise plugins.toolkit.ValidationError({
+            'filters': [u'operator "{0}" not supported, use one of: {1}'.format(operator, u', '.join(OPERATORS))]
+        })
+
+
+def _aggregate_columns(field_ids, data_dict):
+    # (expression, alias) of the aggregates requested in the data dict
+    columns = []
+
+    for function in AGGREGATES:
+        for field in datastore_db._get_list(data_dict.get(function)) or []:
+            if function == 'count' and field == '*':
+                columns.append((u'count(*)', u'count'))
+            else:
+                _check_field(field, field_ids, function)
+                columns.append((u'{0}({1})'.format(function, quote(field)), u'{0}_{1}'.format(function, field)))
+
+    return columns
+
+
+def _bucket(column, interval):
+    # Calendar units are truncated while the rest of intervals are fixed
+    # width buckets counted from the epoch
+    if interval in TIME_UNITS:
+        return u'date_trunc(%s, {0})'.format(column), [interval]
+    else:
+        width = u'extract(epoch from %s::interval)'
+        return (u"timestamp 'epoch' + floor(extract(epoch from {0}) / {1}) * {1} * interval '1 second'".format(
+            column, width), [interval, interval])
+
+
+###############################################################################################
+###########################################  MAIN  ############################################
+###############################################################################################
+
+def quote(identifier):
+    # Statements are always executed with parameters, so '%' has to be escaped
+    return u'"{0}"'.format(identifier.replace('"', '""').replace('%', '%%'))
+
+
+def select(field_ids, data_dict):
+    '''Returns the columns requested in the fields parameter'''
+
+    if not data_dict.get('fields'):
+        return list(field_ids)
+
+    selected = datastore_db._get_list(data_dict['fields'])
+    for field in selected:
+        _check_field(field, field_ids, 'fields')
+
+    return selected
+
+
+def text_search(data_dict):
+    '''Returns the FROM item, the rank column and the values of the full text search'''
+
+    if not data_dict.get('q'):
+        return u'', u'', []
+
+    function = 'plainto_tsquery' if data_dict.get('plain', True) else 'to_tsquery'
+    return (u', {0}(%s, %s) query'.format(function), u', ts_rank(_full_text, query, 32) AS rank',
+            [data_dict.get('language', u'english'), data_dict['q']])
+
+
+def where(field_ids, data_dict, conditions=()):
+    '''Returns the WHERE clause built from the filters, the full text search
+    and the given conditions. Filters can be values, that are compared for
+    equality, or dicts with the operators applied to the field, e.g.
+    {'age': {'gte': 18, 'lt': 65}}'''
+
+    filters = data_dict.get('filters', {})
+
+    if not isinstance(filters, dict):
+        raise plugins.toolkit.ValidationError({
+            'filters': ['Not a json object']
+        })
+
+    clauses = []
+    values = []
+
+    # Filters are sorted so the same request always results in the same statement
+    for field in sorted(filters):
+        _check_field(field, field_ids, 'filters')
+        if isinstance(filters[field], dict):
+            for operator in sorted(filters[field]):
+                clause, clause_values = _operator_clause(quote(field), operator, filters[field][operator])
+                clauses.append(clause)
+                values.extend(clause_values)
+        else:
+            clauses.append(u'{0} = %s'.format(quote(field)))
+            values.append(filters[field])
+
+    if data_dict.get('q'):
+        clauses.append(u'_full_text @@ query')
+
+    clauses.extend(conditions)
+
+    return (u'WHERE ' + u' AND '.join(clauses) if clauses else u''), values
+
+
+def sort(field_ids, data_dict):
+    return (datastore_db._sort(None, data_dict, field_ids) or u'').replace('%', '%%')
+
+
+def search(resource_id, field_ids, data_dict, total=False):
+    '''Returns the statement (and its values) that selects a page of records.
+    The number of matching records is included in a _full_count column when
+    total is set.'''
+
+    columns = u', '.join(quote(field) for field in select(field_ids, data_dict))
+    ts_query, rank_column, ts_values = text_search(data_dict)
+    where_clause, where_values = where(field_ids, data_dict)
+
+    sql = u'SELECT {columns}{rank}{full_count} FROM {resource}{ts_query} {where} {sort} LIMIT %s OFFSET %s'.format(
+        columns=columns,
+        full_count=u', count(*) over() AS "_full_count"' if total else u'',
+        rank=rank_column,
+        resource=quote(resource_id),
+        ts_query=ts_query,
+        where=where_clause,
+        sort=sort(field_ids, data_dict))
+
+    return sql, ts_values + where_values + [data_dict.get('limit', 100), data_dict.get('offset', 0)]
+
+
+def count(resource_id, field_ids, data_dict, function=u'count(*)'):
+    '''Returns the statement (and its values) that counts the matching records'''
+
+    ts_query, _, ts_values = text_search(data_dict)
+    where_clause, where_values = where(field_ids, data_dict)
+
+    sql = u'SELECT {function} FROM {resource}{ts_query} {where}'.format(
+        function=function,
+        resource=quote(resource_id),
+        ts_query=ts_query,
+        where=where_clause)
+
+    return sql, ts_values + where_values
+
+
+def aggregate(resource_id, field_ids, data_dict):
+    '''Returns the statement (and its values) that groups the matching records
+    by the group_by fields and computes the aggregates of each group. Each
+    aggregate is returned in a column named after the function and the field
+    (ex: sum_price) or 'count' for count(*). Groups are sorted by the
+    group_by fields unless a sort of the returned columns is given.'''
+
+    group_by = datastore_db._get_list(data_dict.get('group_by')) or []
+    columns = []
+
+    for field in group_by:
+        _check_field(field, field_ids, 'group_by')
+        columns.append((quote(field), field))
+
+    columns.extend(_aggregate_columns(field_ids, data_dict))
+
+    if not columns:
+        raise plugins.toolkit.ValidationError({
+            'group_by': [u'at least one group_by field or aggregate ({0}) is required'.format(u', '.join(AGGREGATES))]
+        })
+
+    ts_query, _, ts_values = text_search(data_dict)
+    where_clause, where_values = where(field_ids, data_dict)
+
+    if data_dict.get('sort'):
+        order = sort([alias for _, alias in columns], data_dict)
+    elif group_by:
+        order = u'ORDER BY ' + u', '.join(quote(field) for field in group_by)
+    else:
+        order = u''
+
+    sql = u'SELECT {columns} FROM {resource}{ts_query} {where} {group_by} {sort} LIMIT %s OFFSET %s'.format(
+        columns=u', '.join(u'{0} AS {1}'.format(expression, quote(alias)) for expression, alias in columns),
+        resource=quote(resource_id),
+        ts_query=ts_query,
+        where=where_clause,
+        group_by=(u'GROUP BY ' + u', '.join(quote(field) for field in group_by)) if group_by else u'',
+        sort=order)
+
+    return sql, ts_values + where_values + [data_dict.get('limit', 100), data_dict.get('offset', 0)]
+
+
+def buckets(resource_id, field_ids, data_dict):
+    '''Returns the statement (and its values) that groups the matching records
+    in buckets of the time field and computes the aggregates of each bucket
+    (count(*) by default). The interval is a calendar unit (hour, day,
+    month...) or a fixed width interval (ex: '15 minutes').'''
+
+    time_field = data_dict.get('time')
+    _check_field(time_field, field_ids, 'time')
+
+    columns = _aggregate_columns(field_ids, data_dict) or [(u'count(*)', u'count')]
+    bucket, bucket_values = _bucket(quote(time_field), data_dict['interval'])
+    ts_query, _, ts_values = text_search(data_dict)
+    where_clause, where_values = where(field_ids, data_dict)
+
+    # Buckets are computed in a subquery so their expression is only written once. Epochs
+    # are numeric since PostgreSQL 14, which is not converted to a Python number
+    sql = (u'SELECT "_bucket" AS {time}, {columns}, extract(epoch from "_bucket")::float8 AS {x} '
+           u'FROM (SELECT {bucket} AS "_bucket", * FROM {resource}{ts_query} {where}) AS records '
+           u'WHERE "_bucket" IS NOT NULL GROUP BY "_bucket" ORDER BY "_bucket" LIMIT %s OFFSET %s').format(
+        time=quote(time_field),
+        columns=u', '.join(u'{0} AS {1}'.format(expression, quote(alias)) for expression, alias in columns),
+        x=quote(X_COLUMN),
+        bucket=bucket,
+        resource=quote(resource_id),
+        ts_query=ts_query,
+        where=where_clause)
+
+    return sql, bucket_values + ts_values + where_values + [data_dict.get('limit', DEFAULT_BUCKETS),
+                                                            data_dict.get('offset', 0)]
+
+
+def series(resource_id, field_ids, data_dict):
+    '''Returns the statements (and their values) that select the time and the
+    value fields of the matching records sorted by time and that count them'''
+
+    time_field, value_field = data_dict.get('time'), data_dict.get('value')
+    _check_field(time_field, field_ids, 'time')
+    _check_field(value_field, field_ids, 'value')
+
+    ts_query, _, ts_values = text_search(data_dict)
+    where_clause, where_values = where(field_ids, data_dict, [u'{0} IS NOT NULL'.format(quote(time_field)),
+                                                               u'{0} IS NOT NULL'.format(quote(value_field))])
+
+    sql = (u'SELECT {time}, {value}, extract(epoch from {time})::float8 AS {x} '
+           u'FROM {resource}{ts_query} {where} ORDER BY {time}')
+    count_sql = u'SELECT count(*) FROM {resource}{ts_query} {where}'
+    parameters = dict(time=quote(time_field), value=quote(value_field), x=quote(X_COLUMN),
+                      resource=quote(resource_id), ts_query=ts_query, where=where_clause)
+
+    return sql.format(**parameters), count_sql.format(**parameters), ts_values + where_values
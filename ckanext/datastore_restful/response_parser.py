@@ -18,11 +18,27 @@
 # along with CKAN DataStore Restful Extension.  If not, see <http://www.gnu.org/licenses/>.
 
 from __future__ import unicode_literals
+import datetime
+import json
 import StringIO
 import unicodecsv as csv
 from xml.dom.minidom import parseString
 import unicodedata
 
+from collections import OrderedDict
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+ARROW_BATCH_SIZE = 10000
+
 
 def csv_parser(result):
     f = StringIO.StringIO()
@@ -36,63 +52,309 @@ def csv_parser(result):
     return f.getvalue()
 
 
-def xml_parser(result, root):
+# Obtained from https://gist.github.com/reimund/5435343/ and modified to fulfill our needs
+def xml_escape(s):
+    if type(s) in (str, unicode):
+        s = s.replace('&', '&amp;')
+        s = s.replace('"', '&quot;')
+        s = s.replace('\'', '&apos;')
+        s = s.replace('<', '&lt;')
+        s = s.replace('>', '&gt;')
+    return s
 
-    # Obtained from https://gist.github.com/reimund/5435343/ and modified to fulfill our needs
-    def xml_escape(s):
-        if type(s) in (str, unicode):
-            s = s.replace('&', '&amp;')
-            s = s.replace('"', '&quot;')
-            s = s.replace('\'', '&apos;')
-            s = s.replace('<', '&lt;')
-            s = s.replace('>', '&gt;')
-        return s
-
-    def key_is_valid_xml(key):
-        """Checks that a key is a valid XML name"""
-        test_xml = '<?xml version="1.0" encoding="UTF-8" ?><%s>foo</%s>' % (key, key)
-        try:
-            parseString(test_xml)
-            return True
-        except Exception:   # minidom does not implement exceptions well
-            return False
-
-    def dict2xml(d, root_node=None, start=False):
-        wrap = True if root_node is not None or (isinstance(d, list) and start) else False
-        root = 'rows' if None == root_node or not key_is_valid_xml(root_node) else root_node
-        root_singular = root[:-1] if 's' == root[-1] else root
-        xml = ''
-        children = []
-
-        if isinstance(d, dict):
-            for key, value in dict.items(d):
-                if key.startswith('__'):
-                    xml = xml + ' ' + key[2:] + '="' + xml_escape(unicode(value)) + '"'
-                else:
-                    children.append(dict2xml(value, key))
-        elif isinstance(d, list):
-            for value in d:
-                children.append(dict2xml(value, root_singular))
-        elif type(d) in (str, int, bool, float, unicode):
-            #Append strings, numbers and booleans as single nodes
-            children.append(unicode(d))
-        else:
-            TypeError('Unsupported data type: %s (%s)' % (d, type(d).__name__))
 
-        end_tag = '>' if len(children) > 0 else '/>'
+def key_is_valid_xml(key):
+    """Checks that a key is a valid XML name"""
+    test_xml = '<?xml version="1.0" encoding="UTF-8" ?><%s>foo</%s>' % (key, key)
+    try:
+        parseString(test_xml)
+        return True
+    except Exception:   # minidom does not implement exceptions well
+        return False
+
+
+def dict2xml(d, root_node=None, start=False):
+    wrap = True if root_node is not None or (isinstance(d, list) and start) else False
+    root = 'rows' if None == root_node or not key_is_valid_xml(root_node) else root_node
+    root_singular = root[:-1] if 's' == root[-1] else root
+    xml = ''
+    children = []
+
+    if isinstance(d, dict):
+        for key, value in d.items():
+            if key.startswith('__'):
+                xml = xml + ' ' + key[2:] + '="' + xml_escape(unicode(value)) + '"'
+            else:
+                children.append(dict2xml(value, key))
+    elif isinstance(d, list):
+        for value in d:
+            children.append(dict2xml(value, root_singular))
+    elif type(d) in (str, int, bool, float, unicode):
+        #Append strings, numbers and booleans as single nodes
+        children.append(unicode(d))
+    else:
+        TypeError('Unsupported data type: %s (%s)' % (d, type(d).__name__))
+
+    end_tag = '>' if len(children) > 0 else '/>'
+
+    if wrap or isinstance(d, dict):
+        xml = '<' + root + xml + end_tag
+
+    if len(children) > 0:
+        for child in children:
+            xml = xml + child
 
         if wrap or isinstance(d, dict):
-            xml = '<' + root + xml + end_tag
+            xml = xml + '</' + root + '>'
+
+    return xml
+
+
+def msgpack_available():
+    return msgpack is not None
+
+
+def _to_unicode(value):
+    # Byte strings would be packed as binaries instead of as text
+    if isinstance(value, str):
+        return value.decode('utf-8')
+    elif isinstance(value, dict):
+        return dict((_to_unicode(k), _to_unicode(v)) for k, v in value.iteritems())
+    elif isinstance(value, (list, tuple)):
+        return [_to_unicode(v) for v in value]
+    return value
 
-        if len(children) > 0:
-            for child in children:
-                xml = xml + child
 
-            if wrap or isinstance(d, dict):
-                xml = xml + '</' + root + '>'
+def msgpack_parser(result):
+    return msgpack.packb(_to_unicode(result), use_bin_type=True, default=unicode)
 
-        return xml
 
+def msgpack_loads(content):
+    return msgpack.unpackb(content, raw=False)
+
+
+def xml_parser(result, root):
     # It's needed to remove accents and not ascii characters
     xml = unicodedata.normalize('NFKD', dict2xml(result, root, True)).encode('ascii', 'ignore')
     return parseString(xml).toprettyxml()
+
+
+###############################################################################################
+#########################################  STREAMS  ###########################################
+###############################################################################################
+
+# Streamed records are serialized batch by batch. Once all the batches have been
+# written, a marker is included if the number of rows exceeded the configured limit
+
+def _stream_header(records):
+    return [x['id'] for x in records.fields if x['id'] != '_id']
+
+
+def json_stream_head():
+    return '{"records": ['
+
+
+def json_stream_records(records, dumps):
+    '''Yields the records of each batch, to be joined with commas'''
+    header = _stream_header(records)
+
+    for batch in records.batches():
+        chunk = ', '.join(dumps(OrderedDict((column, record[column]) for column in header)) for record in batch)
+        if chunk:
+            yield chunk
+
+
+def json_stream_tail(truncated):
+    return '], "truncated": %s}' % ('true' if truncated else 'false')
+
+
+def json_stream_parser(records, dumps):
+    separator = ''
+
+    yield json_stream_head()
+    for chunk in json_stream_records(records, dumps):
+        yield separator + chunk
+        separator = ', '
+    yield json_stream_tail(records.truncated)
+
+
+def xml_stream_parser(records, root):
+    header = _stream_header(records)
+    root = root if key_is_valid_xml(root) else 'rows'
+    row = root[:-1] if 's' == root[-1] else root
+
+    yield '<?xml version="1.0" encoding="utf-8"?>\n<%s>' % root
+    for batch in records.batches():
+        chunk = ''.join(dict2xml(OrderedDict((column, xml_escape(record[column])) for column in header), row)
+                        for record in batch)
+        yield chunk
+    if records.truncated:
+        yield '<truncated>%d</truncated>' % records.count
+    yield '</%s>\n' % root
+
+
+def csv_stream_head(header):
+    f = StringIO.StringIO()
+    wr = csv.writer(f, encoding='utf-8')
+    wr.writerow(header)
+    return f.getvalue()
+
+
+def csv_stream_records(records):
+    '''Yields the rows of each batch, without the header'''
+    header = _stream_header(records)
+
+    for batch in records.batches():
+        f = StringIO.StringIO()
+        wr = csv.writer(f, encoding='utf-8')
+        for record in batch:
+            wr.writerow([record[column] for column in header])
+        yield f.getvalue()
+
+
+def csv_stream_parser(records):
+    yield csv_stream_head(_stream_header(records))
+
+    for chunk in csv_stream_records(records):
+        yield chunk
+
+    if records.truncated:
+        yield '# truncated at %d rows\n' % records.count
+
+
+###############################################################################################
+##########################################  ARROW  ############################################
+###############################################################################################
+
+# Values are serialized by the DataStore (e.g. timestamps as ISO strings and bigints as
+# strings), so they are converted back to the native type of each Arrow column
+
+class _ChunkSink(object):
+    '''File-like object that keeps the bytes written by Arrow until they are sent'''
+
+    def __init__(self):
+        self.chunks = []
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def pop(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def _parse_timestamp(value):
+    if isinstance(value, datetime.datetime):
+        return value
+    return datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f' if '.' in value else '%Y-%m-%dT%H:%M:%S')
+
+
+def _parse_date(value):
+    if isinstance(value, datetime.date):
+        return value
+    return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def _to_text(value):
+    return value if isinstance(value, unicode) else json.dumps(value) if isinstance(value, (dict, list)) \
+        else unicode(value)
+
+
+def _arrow_type(type_name):
+    '''Returns the Arrow type of a DataStore type and the function that converts its values'''
+
+    if type_name.startswith('_'):
+        item_type, item_converter = _arrow_type(type_name[1:])
+        return pyarrow.list_(item_type), lambda values: [_convert(item_converter, v) for v in values]
+
+    types = {
+        'int2': (pyarrow.int16(), int),
+        'int4': (pyarrow.int32(), int),
+        'int8': (pyarrow.int64(), long),
+        'float4': (pyarrow.float32(), float),
+        'float8': (pyarrow.float64(), float),
+        'numeric': (pyarrow.float64(), float),
+        'bool': (pyarrow.bool_(), bool),
+        'timestamp': (pyarrow.timestamp('us'), _parse_timestamp),
+        'date': (pyarrow.date32(), _parse_date)
+    }
+    return types.get(type_name, (pyarrow.string(), _to_text))
+
+
+def _convert(converter, value):
+    # Empty strings are nulls in typed columns
+    if value is None or (value == '' and converter is not _to_text):
+        return None
+    return converter(value)
+
+
+def arrow_available():
+    return pyarrow is not None
+
+
+def arrow_batches_parser(fields, batches):
+    '''Writes an Arrow IPC stream with a record batch for each list of
+    columns. Each batch is sent as soon as it has been written.'''
+
+    types = [_arrow_type(field.get('type', 'text')) for field in fields]
+    schema = pyarrow.schema([pyarrow.field(field['id'], arrow_type) for field, (arrow_type, _) in zip(fields, types)])
+
+    sink = _ChunkSink()
+    writer = pyarrow.RecordBatchStreamWriter(pyarrow.PythonFile(sink, mode='w'), schema)
+    written = False
+
+    for columns in batches:
+        arrays = [pyarrow.array([_convert(converter, value) for value in column], type=arrow_type)
+                  for column, (arrow_type, converter) in zip(columns, types)]
+        writer.write_batch(pyarrow.RecordBatch.from_arrays(arrays, [field['id'] for field in fields]))
+        written = True
+        yield sink.pop()
+
+    # The schema is always sent, even when there are no records
+    if not written:
+        writer.write_batch(pyarrow.RecordBatch.from_arrays([pyarrow.array([], type=t) for t, _ in types],
+                                                           [field['id'] for field in fields]))
+    writer.close()
+    yield sink.pop()
+
+
+def arrow_parser(result):
+    '''Serializes the records (dicts or lists of values) or the columns of a
+    result as an Arrow IPC stream'''
+
+    records = result.get('records', [])
+    arrays = 'columns' in result or (records and not isinstance(records[0], dict))
+
+    # Like in CSV, the internal identifier is not included in the dict records
+    fields = [x for x in result['fields'] if x['id'] != '_id' or arrays]
+
+    def _batches():
+        if 'columns' in result:
+            yield result['columns']
+        else:
+            for start in range(0, len(records), ARROW_BATCH_SIZE):
+                batch = records[start:start + ARROW_BATCH_SIZE]
+                if arrays:
+                    yield [list(column) for column in zip(*batch)]
+                else:
+                    yield [[record[field['id']] for record in batch] for field in fields]
+
+    return arrow_batches_parser(fields, _batches())
+
+
+def arrow_stream_parser(records):
+    fields = [x for x in records.fields if x['id'] != '_id']
+
+    def _batches():
+        for batch in records.batches():
+            yield [[record[field['id']] for record in batch] for field in fields]
+
+    return arrow_batches_parser(fields, _batches())
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN DataStore Restful Extension.
+
+# CKAN DataStore Restful Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN DataStore Restful Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN DataStore Restful Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import itertools
+import math
+
+
+###############################################################################################
+#########################################  AUXILIAR  ##########################################
+###############################################################################################
+
+def _bucket_ends(length, threshold):
+    # The first and the last points are always kept, the rest of the points
+    # are split in threshold - 2 buckets of the same size
+    every = float(length - 2) / (threshold - 2)
+    return [min(int(math.floor((i + 1) * every)) + 1, length - 1) for i in range(threshold - 2)]
+
+
+def _average(points, x, y):
+    return (sum(x(point) for point in points) / len(points),
+            sum(y(point) for point in points) / len(points))
+
+
+###############################################################################################
+###########################################  MAIN  ############################################
+###############################################################################################
+
+def lttb(points, length, threshold, x, y):
+    '''Reduces a series of points sorted by x to threshold points with the
+    Largest-Triangle-Three-Buckets algorithm, that keeps the shape of the
+    series: the point of each bucket that forms the largest triangle with
+    the point selected in the previous bucket and the average of the next
+    one is kept. Points are consumed lazily, so only two buckets are kept in
+    memory. The length of the series has to be known beforehand.
+
+    :param points: the points of the series
+    :param length: the number of points
+    :param threshold: the number of points returned
+    :param x: function that returns the x coordinate of a point
+    :param y: function that returns the y coordinate of a point
+    '''
+
+    points = iter(points)
+
+    if threshold >= length or threshold < 3:
+        for point in points:
+            yield point
+        return
+
+    ends = _bucket_ends(length, threshold)
+    selected = next(points, None)
+    if selected is None:
+        return
+    yield selected
+
+    current = list(itertools.islice(points, ends[0] - 1))
+
+    for i in range(len(ends)):
+        if i + 1 < len(ends):
+            following = list(itertools.islice(points, ends[i + 1] - ends[i]))
+        else:
+            following = list(points)        # The last point
+
+        if not following:
+            # There are fewer points than expected
+            following = current[-1:]
+            current = current[:-1]
+
+        if current:
+            average_x, average_y = _average(following if i + 1 < len(ends) else following[-1:], x, y)
+            selected_x, selected_y = x(selected), y(selected)
+            selected = max(current, key=lambda point: abs((selected_x - average_x) * (y(point) - selected_y) -
+                                                          (selected_x - x(point)) * (average_y - selected_y)))
+            yield selected
+
+        current = following
+
+    if current:
+        yield current[-1]
@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN DataStore Restful Extension.
+
+# CKAN DataStore Restful Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN DataStore Restful Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN DataStore Restful Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import json
+import logging
+import re
+import threading
+import time
+
+from collections import OrderedDict
+from pylons import config
+from sqlalchemy import event
+
+log = logging.getLogger(__name__)
+slow_log = logging.getLogger('ckanext.datastore_restful.slow_requests')
+
+SLOW_REQUEST_THRESHOLD = 'ckanext.datastore_restful.slow_request_threshold'
+DEFAULT_SLOW_REQUEST_THRESHOLD = 1000   # milliseconds
+DEBUG_HEADERS = 'ckanext.datastore_restful.debug_headers'
+
+# Query shapes kept in memory until they are saved by the index advisor. Only
+# the searches are advised, since the rest of requests are served by the
+# primary key or read the whole resource
+MAX_SHAPES = 1000
+ADVISED_ACTIONS = ['search_entries']
+
+ACTIONS_HEADER = 'X-Datastore-Actions'
+STATEMENTS_HEADER = 'X-Datastore-Statements'
+
+# Quoted identifiers and dollar quoted strings are kept, literals are replaced and keywords are lowercased
+_SQL_TOKENS = re.compile(r'(?P<quoted>"(?:[^"]|"")*"|\$(?P<tag>[A-Za-z_]*)\$[\s\S]*?\$(?P=tag)\$)|'
+                         r'(?P<string>\'(?:[^\']|\'\')*\')|(?P<word>[A-Za-z_][A-Za-z0-9_$]*)|'
+                         r'(?P<number>\d+(?:\.\d+)?)|(?P<spaces>\s+)')
+_SQL_LISTS = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+
+_local = threading.local()
+_lock = threading.Lock()
+_counters = {}
+_shapes = {}
+_instrumented_engines = set()
+
+
+###############################################################################################
+#########################################  AUXILIAR  ##########################################
+###############################################################################################
+
+def _get_threshold():
+    return int(config.get(SLOW_REQUEST_THRESHOLD, DEFAULT_SLOW_REQUEST_THRESHOLD))
+
+
+def _count_statement(conn, cursor, statement, parameters, context, executemany):
+    request_stats = current()
+    if request_stats is not None:
+        request_stats.statements += 1
+
+
+def _normalize_sort(sort):
+    clauses = []
+
+    for clause in sort.split(','):
+        clause_parts = clause.split()
+        if len(clause_parts) == 1:
+            clause_parts.append('asc')
+        if clause_parts:
+            clauses.append('%s %s' % (clause_parts[0], clause_parts[-1].lower()))
+
+    return ', '.join(clauses)
+
+
+def _sort_fields(sort):
+    return [clause.rsplit(' ', 1)[0] for clause in sort.split(', ')] if sort else []
+
+
+###############################################################################################
+###########################################  MAIN  ############################################
+###############################################################################################
+
+def debug_headers_enabled():
+    return config.get(DEBUG_HEADERS, 'false').lower() in ('true', 'yes', 'on', '1')
+
+
+def increment(name, amount=1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+
+def metrics():
+    with _lock:
+        counters = dict(_counters)
+
+    # The hit ratio of each cache is computed from its hits and misses
+    for name in [name for name in counters if name.endswith('.hits')]:
+        prefix = name[:-len('hits')]
+        lookups = counters[name] + counters.get(prefix + 'misses', 0)
+        if lookups:
+            counters[prefix + 'hit_ratio'] = round(float(counters[name]) / lookups, 4)
+
+    return OrderedDict(sorted(counters.items()))
+
+
+def reset_metrics():
+    with _lock:
+        _counters.clear()
+
+
+def record_shape(resource_id, shape, elapsed):
+    '''Aggregates the number of requests and the time spent by the searches
+    of a resource that filter and sort by the same fields'''
+    key = (resource_id, tuple(shape['filters']), tuple(_sort_fields(shape.get('sort'))))
+
+    with _lock:
+        if key not in _shapes and len(_shapes) >= MAX_SHAPES:
+            _counters['workload.dropped'] = _counters.get('workload.dropped', 0) + 1
+            return
+        requests, total = _shapes.get(key, (0, 0.0))
+        _shapes[key] = (requests + 1, total + elapsed)
+
+
+def pop_workload():
+    '''Returns the shapes recorded since the last call'''
+    with _lock:
+        workload = dict(_shapes)
+        _shapes.clear()
+        return workload
+
+
+def instrument_engine(engine):
+    '''Counts the SQL statements sent through the given engine by the request
+    that is being processed in the current thread'''
+    if id(engine) not in _instrumented_engines:
+        event.listen(engine, 'before_cursor_execute', _count_statement)
+        _instrumented_engines.add(id(engine))
+
+
+def current():
+    return getattr(_local, 'request_stats', None)
+
+
+def count_action():
+    request_stats = current()
+    if request_stats is not None:
+        request_stats.actions += 1
+
+
+def normalize_sql(sql, keep_literals=False):
+    '''Returns the shape of a SQL statement: literals are replaced by '?',
+    keywords are lowercased and whitespace is collapsed. When keep_literals
+    is set, literals are left untouched so the result is equivalent to the
+    original statement'''
+
+    def _replace(match):
+        if match.group('quoted'):
+            return match.group('quoted')
+        elif match.group('word'):
+            return match.group('word').lower()
+        elif match.group('spaces'):
+            return ' '
+        elif keep_literals:
+            return match.group(0)
+        else:
+            return '?'
+
+    normalized = _SQL_TOKENS.sub(_replace, sql).strip().rstrip(';').strip()
+    return normalized if keep_literals else _SQL_LISTS.sub('(?)', normalized)
+
+
+def sql_fingerprint(sql):
+    return hashlib.md5(normalize_sql(sql).encode('utf-8')).hexdigest()[:16]
+
+
+def query_shape(request_data):
+    '''Returns the normalized filter/sort/limit shape of a search request'''
+
+    shape = OrderedDict()
+    shape['filters'] = sorted(request_data.get('filters', {}))
+
+    if request_data.get('sort'):
+        shape['sort'] = _normalize_sort(request_data['sort'])
+
+    if 'limit' in request_data:
+        shape['limit'] = request_data['limit']
+
+    shape['offset'] = bool(request_data.get('offset'))
+    shape['q'] = bool(request_data.get('q'))
+
+    return shape
+
+
+class RequestStats(object):
+    '''Timings and sizes of a single restful request. Requests slower than the
+    configured threshold are written to the slow requests log.'''
+
+    def __init__(self, action, logic_function):
+        self.action = action
+        self.logic_function = logic_function
+        self.resource_id = None
+        self.shape = None
+        self.fingerprint = None
+        self.rows = None
+        self.bytes = None
+        self.actions = 0
+        self.statements = 0
+        self.phases = OrderedDict()
+        self._start = self._last = time.time()
+        _local.request_stats = self
+
+    @property
+    def elapsed(self):
+        return (time.time() - self._start) * 1000
+
+    def phase(self, name):
+        now = time.time()
+        self.phases[name] = round((now - self._last) * 1000, 3)
+        self._last = now
+
+    def describe(self, request_data):
+        if not isinstance(request_data, dict):
+            return
+
+        self.resource_id = request_data.get('resource_id')
+
+        if 'sql' in request_data:
+            self.fingerprint = sql_fingerprint(request_data['sql'])
+        elif 'records' not in request_data:
+            self.shape = query_shape(request_data)
+
+    def count_rows(self, result):
+        if isinstance(result, dict) and isinstance(result.get('records'), list):
+            self.rows = len(result['records'])
+
+    def count_bytes(self, response_data):
+        if isinstance(response_data, basestring):
+            self.bytes = len(response_data)
+
+    def to_dict(self):
+        entry = OrderedDict()
+        entry['action'] = self.action
+        entry['logic_function'] = self.logic_function
+        entry['resource_id'] = self.resource_id
+        entry['shape'] = self.shape
+        entry['sql_fingerprint'] = self.fingerprint
+        entry['rows'] = self.rows
+        entry['bytes'] = self.bytes
+        entry['actions'] = self.actions
+        entry['statements'] = self.statements
+        entry['elapsed'] = round(self.elapsed, 3)
+        entry['phases'] = self.phases
+        return entry
+
+    def headers(self):
+        headers = OrderedDict()
+        headers[ACTIONS_HEADER] = self.actions
+        headers[STATEMENTS_HEADER] = self.statements
+        return headers
+
+    def finish(self):
+        threshold = _get_threshold()
+        elapsed = self.elapsed
+        slow = threshold >= 0 and elapsed >= threshold
+
+        if current() is self:
+            _local.request_stats = None
+
+        prefix = 'requests.%s.' % self.action
+        increment(prefix + 'count')
+        increment(prefix + 'actions', self.actions)
+        increment(prefix + 'statements', self.statements)
+        increment(prefix + 'elapsed', int(elapsed))
+        if self.shape is not None and self.resource_id and self.action in ADVISED_ACTIONS:
+            record_shape(self.resource_id, self.shape, elapsed)
+        if slow:
+            increment(prefix + 'slow')
+            try:
+                slow_log.warning(json.dumps(self.to_dict(), default=str))
+            except Exception:
+                log.exception('Unable to write the slow request log entry')
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN DataStore Restful Extension.
+
+# CKAN DataStore Restful Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN DataStore Restful Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN DataStore Restful Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Local stand-in of a Redis server that implements the commands used by the
+cache backend, so it can be tested without a real server.
+'''
+import SocketServer
+import threading
+import time
+
+
+class _Handler(SocketServer.StreamRequestHandler):
+
+    def _read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+
+        args = []
+        for _ in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    def _reply(self, value):
+        if value is None:
+            self.wfile.write('$-1\r\n')
+        elif isinstance(value, int):
+            self.wfile.write(':%d\r\n' % value)
+        else:
+            self.wfile.write('$%d\r\n%s\r\n' % (len(value), value))
+
+    def _get(self, key):
+        value, expires = self.server.values.get(key, (None, None))
+        if expires is not None and expires <= time.time():
+            del self.server.values[key]
+            return None
+        return value
+
+    def handle(self):
+        while True:
+            args = self._read_command()
+            if args is None:
+                return
+
+            command = args[0].upper()
+            self.server.commands.append(args)
+
+            with self.server.lock:
+                if command == 'GET':
+                    self._reply(self._get(args[1]))
+                elif command == 'SET':
+                    expires = time.time() + int(args[4]) / 1000.0 if len(args) > 4 else None
+                    self.server.values[args[1]] = (args[2], expires)
+                    self.wfile.write('+OK\r\n')
+                elif command == 'DEL':
+                    deleted = [key for key in args[1:] if self.server.values.pop(key, None) is not None]
+                    self._reply(len(deleted))
+                elif command == 'INCR':
+                    value = int(self._get(args[1]) or 0) + 1
+                    self.server.values[args[1]] = (str(value), None)
+                    self._reply(value)
+                elif command in ('SELECT', 'AUTH'):
+                    self.wfile.write('+OK\r\n')
+                else:
+                    self.wfile.write('-ERR unknown command \'%s\'\r\n' % args[0])
+
+
+class RedisServer(SocketServer.ThreadingTCPServer):
+    '''Serves the GET, SET (with PX), DEL and INCR commands in a background thread'''
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        SocketServer.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), _Handler)
+        self.values = {}
+        self.commands = []
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'redis://%s:%d/1' % self.server_address
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, args=(0.01,))
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN DataStore Restful Extension.
+
+# CKAN DataStore Restful Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN DataStore Restful Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN DataStore Restful Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+
+import ckanext.datastore_restful.advisor as advisor
+
+from mock import MagicMock
+from nose_parameterized import parameterized
+from nose.tools import assert_equal, assert_true, assert_false
+from sqlalchemy.exc import DBAPIError
+
+BTREE = {'method': 'btree', 'valid': True, 'unique': False}
+PK_INDEX = dict(BTREE, unique=True, fields=['pk'])
+
+
+class TestAdvisor(object):
+    '''Tests for the index advisor.'''
+
+    def setup(self):
+        self._config = advisor.config
+        self._db = advisor.db
+        self._stats = advisor.stats
+
+        advisor.config = {advisor.ADVISOR_MIN_REQUESTS: '10', advisor.ADVISOR_MIN_ROWS: '1000'}
+        advisor.db = MagicMock(INDEX_BTREE=self._db.INDEX_BTREE, INDEX_NAME=self._db.INDEX_NAME)
+        advisor.db.resolve_resource.side_effect = lambda resource_id: resource_id
+        advisor.db._get_field_ids.return_value = ['_id', 'pk', 'a', 'b', 'c']
+        advisor.db.list_indexes.return_value = [PK_INDEX]
+        advisor.stats = MagicMock()
+
+        self.connection = MagicMock()
+        self._table_stats = advisor._table_stats
+        self._field_widths = advisor._field_widths
+        advisor._table_stats = MagicMock(return_value=(100000, 50, 10))
+        advisor._field_widths = MagicMock(return_value={'a': 4, 'b': 20})
+
+    def teardown(self):
+        advisor.config = self._config
+        advisor.db = self._db
+        advisor.stats = self._stats
+        advisor._table_stats = self._table_stats
+        advisor._field_widths = self._field_widths
+
+    @parameterized.expand([
+        ([PK_INDEX], ['pk', 'a'], [], True),
+        ([PK_INDEX], ['a'], [], False),
+        ([dict(BTREE, fields=['b', 'a'])], ['a', 'b'], [], True),
+        ([dict(BTREE, fields=['a'])], ['a'], ['c'], False),
+        ([dict(BTREE, fields=['a', '"c"'])], ['a'], ['c'], True),
+        ([dict(BTREE, fields=['a', 'c'], valid=False)], ['a'], ['c'], False),
+        ([dict(BTREE, fields=['a'], method='gin')], ['a'], [], False)
+    ])
+    def test_covered(self, indexes, filters, sort, expected_covered):
+        assert_equal(expected_covered, advisor._covered(indexes, filters, sort))
+
+    def test_index_name(self):
+        assert_equal(u'auto_a_my_field', advisor._index_name(['a', 'my field']))
+        assert_true(advisor._index_name(['a' * 30, 'b' * 30]).startswith(u'auto_'))
+        assert_true(advisor.db.INDEX_NAME.match(advisor._index_name(['a' * 30, 'b' * 30])))
+
+    def test_recommend_resource(self):
+        shapes = [
+            ('res', ['a'], [], 100, 5000.0),
+            ('res', [], ['a'], 20, 100.0),          # Same index than the previous one
+            ('res', ['a', 'b'], ['c'], 50, 2500.0),
+            ('res', ['pk'], [], 1000, 1000.0),      # Already indexed
+            ('res', ['d'], [], 100, 1000.0),        # Not a field anymore
+            ('res', ['b'], [], 5, 1000.0),          # Not frequent enough
+            ('res', [], [], 1000, 1000.0)           # Nothing to index
+        ]
+
+        recommendations = advisor._recommend_resource(self.connection, 'res', shapes)
+
+        assert_equal([['a'], ['a', 'b', 'c']], [r['fields'] for r in recommendations])
+        assert_equal((120, 5100.0, 42.5), tuple(recommendations[0][key] for key in ('requests', 'elapsed', 'mean')))
+        assert_equal(int(100000 * (4 + 20 + 8 + 12) / 0.9), recommendations[1]['estimated_size'])
+
+    def test_recommend_small_table(self):
+        advisor._table_stats.return_value = (500, 50, 10)
+        assert_equal([], advisor._recommend_resource(self.connection, 'res', [('res', ['a'], [], 100, 5000.0)]))
+
+    @parameterized.expand([
+        (50, 1000, advisor.STATUS_CREATED),
+        (5, 1000, advisor.STATUS_RECOMMENDED),      # The table is not scanned sequentially
+        (50, 10 ** 10, advisor.STATUS_TOO_LARGE),
+        (50, 1000, advisor.STATUS_FAILED, advisor.plugins.toolkit.ValidationError({'index': ['Invalid']})),
+        (50, 1000, advisor.STATUS_FAILED, DBAPIError('CREATE INDEX', (), Exception('Lock timeout')))
+    ])
+    def test_apply(self, seq_scans, estimated_size, expected_status, error=None):
+        recommendation = {'resource_id': 'res', 'name': 'auto_a', 'fields': ['a'], 'seq_scans': seq_scans,
+                          'estimated_size': estimated_size, 'status': advisor.STATUS_RECOMMENDED}
+        advisor.db.create_index.side_effect = error
+
+        advisor.apply([recommendation])
+
+        assert_equal(expected_status, recommendation['status'])
+        # Indexes that can not be created are reported as failed
+        assert_equal(expected_status in (advisor.STATUS_CREATED, advisor.STATUS_FAILED),
+                     advisor.db.create_index.called)
+
+    @parameterized.expand([
+        (None,),
+        (Exception('Connection refused'),)
+    ])
+    def test_flush_workload(self, error):
+        self._save_workload = advisor._save_workload
+        advisor._save_workload = MagicMock(side_effect=error)
+        advisor.stats.pop_workload.return_value = {('res', ('a',), ()): (1, 1.0)}
+
+        try:
+            # Errors are logged, never raised
+            advisor.flush_workload()
+            advisor._save_workload.assert_called_once_with({('res', ('a',), ()): (1, 1.0)})
+        finally:
+            advisor._save_workload = self._save_workload
+
+    @parameterized.expand([
+        ('0', False),
+        ('0.01', True)
+    ])
+    def test_start_flusher(self, interval, expected_flush):
+        self._run = advisor._run
+        self._flusher_pid = advisor._flusher_pid
+        started = threading.Event()
+        advisor._run = MagicMock(side_effect=lambda interval: started.set())
+        advisor._flusher_pid = [None]
+
+        try:
+            advisor.config[advisor.ADVISOR_FLUSH_INTERVAL] = interval
+            advisor.start_flusher()
+            advisor.start_flusher()
+
+            # A single thread saves the shapes of the process periodically
+            assert_equal(expected_flush, started.wait(1.0 if expected_flush else 0.05))
+            assert_equal([((0.01,), {})] if expected_flush else [], advisor._run.call_args_list)
+        finally:
+            advisor._run = self._run
+            advisor._flusher_pid = self._flusher_pid
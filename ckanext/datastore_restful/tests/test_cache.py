@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN DataStore Restful Extension.
+
+# CKAN DataStore Restful Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN DataStore Restful Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN DataStore Restful Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tempfile
+import ckanext.datastore_restful.cache as cache
+import ckanext.datastore_restful.stats as stats
+
+from mock import MagicMock
+from redis_server import RedisServer
+from nose_parameterized import parameterized
+from nose.tools import assert_equal, assert_is_none, assert_raises
+
+
+class TestCache(object):
+    '''Tests for the module.'''
+
+    def setup(self):
+        self._config = cache.config
+        self._time = cache.time
+        self._directory = tempfile.mkdtemp()
+        self._server = RedisServer()
+        self._server.start()
+
+        cache.config = {}
+        cache.time = MagicMock()
+        cache.time.time.return_value = 1000.0
+        stats.reset_metrics()
+
+    def teardown(self):
+        cache.config = self._config
+        cache.time = self._time
+        shutil.rmtree(self._directory)
+        self._server.stop()
+
+    def _get_backend(self, backend, max_bytes=1024 * 1024):
+        if backend == cache.BACKEND_MEMORY:
+            return cache.MemoryBackend('test', max_bytes)
+        elif backend == cache.BACKEND_MMAP:
+            return cache.MmapBackend('test', os.path.join(self._directory, 'test'), max_bytes)
+        else:
+            return cache.RedisBackend(self._server.url)
+
+    @parameterized.expand([
+        (cache.BACKEND_MEMORY,),
+        (cache.BACKEND_MMAP,),
+        (cache.BACKEND_REDIS,)
+    ])
+    def test_backend(self, backend_name):
+        backend = self._get_backend(backend_name)
+
+        assert_is_none(backend.get('a'))
+        backend.set('a', 'value\n\0', 60)
+        backend.set('b', 'other value', 60)
+        assert_equal('value\n\0', backend.get('a'))
+
+        backend.set('a', 'new value', 60)
+        assert_equal('new value', backend.get('a'))
+
+        backend.delete(['a', 'c'])
+        assert_is_none(backend.get('a'))
+        assert_equal('other value', backend.get('b'))
+
+        assert_equal(0, backend.counter('generation'))
+        assert_equal(1, backend.incr('generation'))
+        assert_equal(2, backend.incr('generation'))
+        assert_equal(2, backend.counter('generation'))
+
+    @parameterized.expand([
+        (cache.BACKEND_MEMORY,),
+        (cache.BACKEND_MMAP,)
+    ])
+    def test_backend_ttl(self, backend_name):
+        backend = self._get_backend(backend_name)
+        backend.set('a', 'value', 60)
+        backend.set('b', 'value', 0)
+
+        cache.time.time.return_value = 1059.0
+        assert_equal('value', backend.get('a'))
+
+        cache.time.time.return_value = 1060.0
+        assert_is_none(backend.get('a'))
+        assert_equal('value', backend.get('b'))
+        assert_equal(1, stats.metrics()['cache.test.expirations'])
+
+    def test_redis_ttl(self):
+        backend = self._get_backend(cache.BACKEND_REDIS)
+        backend.set('a', 'value', 60)
+        backend.set('b', 'value', 0)
+
+        assert_equal(['SET', cache.REDIS_PREFIX + 'a', 'value', 'PX', '60000'], self._server.commands[-2])
+        assert_equal(['SET', cache.REDIS_PREFIX + 'b', 'value'], self._server.commands[-1])
+
+    def test_memory_eviction(self):
+        size = cache.sys.getsizeof('a') + cache.sys.getsizeof('x' * 100)
+        backend = cache.MemoryBackend('test', size * 2)
+
+        backend.set('a', 'x' * 100, 60)
+        backend.set('b', 'y' * 100, 60)
+        backend.get('a')                    # b is now the least recently used value
+        backend.set('c', 'z' * 100, 60)
+
+        assert_equal('x' * 100, backend.get('a'))
+        assert_is_none(backend.get('b'))
+        assert_equal(size * 2, backend.bytes)
+        assert_equal(1, stats.metrics()['cache.test.evictions'])
+
+        # Values bigger than the cache are not stored
+        backend.set('d', 'x' * 1000, 60)
+        assert_is_none(backend.get('d'))
+        assert_equal(2, len(backend))
+
+    def test_mmap_eviction(self):
+        # A single set of the smallest slots
+        backend = self._get_backend(cache.BACKEND_MMAP, len(cache.MMAP_SLOT_SIZES) * cache.MMAP_WAYS * 1024)
+
+        for i in range(cache.MMAP_WAYS):
+            cache.time.time.return_value = 1000.0 + i
+            backend.set(str(i), 'value %d' % i, 0)
+        backend.get('0')                    # 1 is now the least recently used value
+        backend.set('new', 'new value', 0)
+
+        assert_equal('value 0', backend.get('0'))
+        assert_is_none(backend.get('1'))
+        assert_equal('new value', backend.get('new'))
+        assert_equal(1, stats.metrics()['cache.test.evictions'])
+
+        # Values bigger than the slots are not stored
+        backend.set('big', 'x' * 1024, 0)
+        assert_is_none(backend.get('big'))
+
+    def test_mmap_shared(self):
+        # Values and counters are shared with the other processes that map the same file
+        backend = self._get_backend(cache.BACKEND_MMAP)
+        other_backend = self._get_backend(cache.BACKEND_MMAP)
+
+        backend.set('a', 'x' * 5000, 60)
+        backend.incr('generation')
+        assert_equal('x' * 5000, other_backend.get('a'))
+        assert_equal(1, other_backend.counter('generation'))
+
+        # Segments of other sizes are kept in other files
+        resized_backend = self._get_backend(cache.BACKEND_MMAP, 2 * 1024 * 1024)
+        assert_is_none(resized_backend.get('a'))
+        assert_equal(0, resized_backend.counter('generation'))
+
+    def test_cache(self):
+        responses = cache.Cache('test', self._get_backend(cache.BACKEND_MEMORY), 60)
+
+        assert_is_none(responses.get(('res', 1, 'json')))
+        responses.set(('res', 1, 'json'), u'{"a": "\xe1"}', {'X-Total-Count': '1'})
+        assert_equal((u'{"a": "\xe1"}'.encode('utf-8'), {'X-Total-Count': '1'}), responses.get(('res', 1, 'json')))
+
+        metrics = stats.metrics()
+        assert_equal(1, metrics['cache.test.hits'])
+        assert_equal(1, metrics['cache.test.misses'])
+        assert_equal(0.5, metrics['cache.test.hit_ratio'])
+
+    def test_cache_errors(self):
+        # Nothing listens in the port of the stopped server
+        self._server.stop()
+        responses = cache.Cache('test', cache.RedisBackend(self._server.url), 60)
+
+        responses.set(('res', 1, 'json'), 'value', {})
+        assert_is_none(responses.get(('res', 1, 'json')))
+        assert_is_none(responses.generation('res'))
+        responses.increase_generation('res')
+        assert_equal(4, stats.metrics()['cache.test.errors'])
+        assert_equal(1, stats.metrics()['cache.test.misses'])
+
+        self._server = RedisServer()
+        self._server.start()
+
+    @parameterized.expand([
+        ({}, None),
+        ({cache.ENTRY_CACHE_SIZE: '10000'}, cache.MemoryBackend),
+        ({cache.ENTRY_CACHE_SIZE: '10000', cache.CACHE_BACKEND: cache.BACKEND_MMAP}, cache.MmapBackend),
+        ({cache.ENTRY_CACHE_SIZE: '10000', cache.CACHE_BACKEND: cache.BACKEND_REDIS}, cache.RedisBackend)
+    ])
+    def test_get_cache(self, config, expected_backend):
+        cache.config.update(config)
+        cache.config[cache.CACHE_URL] = os.path.join(self._directory, 'test') \
+            if expected_backend == cache.MmapBackend else self._server.url
+
+        entries = cache.get_cache(cache.ENTRIES)
+        assert_is_none(cache.get_cache(cache.SEARCHES))
+
+        if expected_backend is None:
+            assert_is_none(entries)
+        else:
+            assert_equal(expected_backend, type(entries.backend))
+            assert_equal(cache.DEFAULT_ENTRY_CACHE_TTL, entries.ttl)
+            assert_equal(entries, cache.get_cache(cache.ENTRIES))
+
+    def test_get_cache_invalid_backend(self):
+        cache.config = {cache.SEARCH_CACHE_SIZE: '10000', cache.CACHE_BACKEND: 'invalid'}
+        assert_raises(cache.CacheError, cache.get_cache, cache.SEARCHES)
+
+    def test_invalidate(self):
+        cache.config = {cache.ENTRY_CACHE_SIZE: '10000', cache.SEARCH_CACHE_SIZE: '10000'}
+        entries = cache.get_cache(cache.ENTRIES)
+        generation = cache.generation(cache.ENTRIES, 'res')
+        search_generation = cache.generation(cache.SEARCHES, 'res')
+        entries.set(('res', generation, 1, 'json'), 'value', {})
+
+        # Writes discard the entries and searches of the resource
+        cache.invalidate('res')
+        assert_equal(generation + 1, cache.generation(cache.ENTRIES, 'res'))
+        assert_equal(search_generation + 1, cache.generation(cache.SEARCHES, 'res'))
+        assert_equal(generation, cache.generation(cache.ENTRIES, 'other'))
+
+        # Responses read before the write and stored after it are never returned
+        entries.set(('res', generation, 2, 'json'), 'stale', {})
+        assert_is_none(entries.get(('res', cache.generation(cache.ENTRIES, 'res'), 2, 'json')))
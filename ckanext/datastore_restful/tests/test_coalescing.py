@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN DataStore Restful Extension.
+
+# CKAN DataStore Restful Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN DataStore Restful Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN DataStore Restful Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import time
+import ckanext.datastore_restful.coalescing as coalescing
+import ckanext.datastore_restful.stats as stats
+
+from nose.tools import assert_equal, assert_raises
+
+
+class TestCoalescing(object):
+    '''Tests for the module.'''
+
+    def _run_concurrently(self, keys, function):
+        '''Calls coalesce with each key once the first call has started'''
+        started = threading.Event()
+        release = threading.Event()
+        results = {}
+
+        def _function():
+            started.set()
+            release.wait()
+            return function()
+
+        def _call(i, key):
+            try:
+                results[i] = coalescing.coalesce(key, _function)
+            except Exception as e:
+                results[i] = e
+
+        threads = [threading.Thread(target=_call, args=(0, keys[0]))]
+        threads[0].start()
+        started.wait()
+        threads.extend(threading.Thread(target=_call, args=(i, key)) for i, key in enumerate(keys[1:], 1))
+        for thread in threads[1:]:
+            thread.start()
+
+        # Let the rest of the calls reach the flight
+        time.sleep(0.1)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        return [results[i] for i in range(len(keys))]
+
+    def test_coalesce(self):
+        stats.reset_metrics()
+        calls = []
+
+        def _function():
+            calls.append(1)
+            return 'result'
+
+        results = self._run_concurrently(['key'] * 5, _function)
+
+        assert_equal(1, len(calls))
+        assert_equal([('result', True)] + [('result', False)] * 4, results)
+        assert_equal(4, stats.metrics()['requests.coalesced'])
+        assert_equal({}, coalescing._flights)
+
+    def test_coalesce_other_keys(self):
+        calls = []
+
+        def _function():
+            calls.append(1)
+            return 'result'
+
+        results = self._run_concurrently(['key', 'other key'], _function)
+
+        assert_equal(2, len(calls))
+        assert_equal([('result', True), ('result', True)], results)
+
+    def test_coalesce_error(self):
+        error = ValueError('Invalid query')
+
+        def _function():
+            raise error
+
+        assert_equal([error] * 3, self._run_concurrently(['key'] * 3, _function))
+        assert_equal({}, coalescing._flights)
+
+        # Once finished, the function is called again
+        assert_equal(('new result', True), coalescing.coalesce('key', lambda: 'new result'))
+        assert_raises(ValueError, coalescing.coalesce, 'key', _function)
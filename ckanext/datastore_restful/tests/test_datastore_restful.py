@@ -22,6 +22,7 @@ Tests for the ckanext.datastore_restful extension.
 This tests require nose_parameterized to run.
 '''
 import ckanext.datastore_restful.controller as controller
+import ckanext.datastore_restful.stats as stats
 import ckanext.datastore_restful.utils as utils
 import json
 import re
@@ -35,7 +36,38 @@ DEFAULT_FIELDS = [{'id': 'test', 'type': 'int'}, {'id': 'test1', 'type': 'text'}
 DEFAULT_RECORDS = [{'test': 'test', 'test1': 'test1'}, {'test': '_test', 'test1': '_test1', controller.IDENTIFIER: 1}]
 INVALID_FIELDS = [{'_id': 'test', 'type': 'int'}, {'id': 'test1', '_type': 'text'}]
 FIELDS_PK = [{'id': controller.IDENTIFIER, 'type': 'int'}, {'id': 'test1', 'type': 'text'}]
-
+INDEX = {'name': 'by_test', 'managed': True, 'method': 'btree', 'unique': False, 'fields': ['test'], 'size': 8192}
+WEBHOOK = {'name': 'sync', 'url': 'http://localhost:8080/events', 'created': '2014-01-01T00:00:00'}
+
+
+# Maximum number of DataStore actions that each endpoint is allowed to call
+ROUND_TRIP_BUDGETS = {
+    'upsert_resource': 1,
+    'structure': 1,
+    'delete_resource': 1,
+    'search_entries': 1,
+    'count_entries': 1,
+    'aggregate': 1,
+    'downsample': 1,
+    'changes': 1,
+    'export': 1,
+    'create_entries': 1,
+    'upsert_entry': 1,
+    'get_entry': 1,
+    'delete_entry': 1,
+    'list_indexes': 1,
+    'get_index': 1,
+    'upsert_index': 1,
+    'delete_index': 1,
+    'list_webhooks': 1,
+    'get_webhook': 1,
+    'upsert_webhook': 1,
+    'delete_webhook': 1,
+    'sql': 1,
+    'metrics': 1,
+    'advisor': 1,
+    'apply_advisor': 1
+}
 
 DEFAULT_LOGIC_FUNCTION_RES = {
     'fields': DEFAULT_FIELDS,
@@ -118,6 +150,20 @@ SEARCH_INDEX_ERROR = {
     'status': 500
 }
 
+QUERY_REJECTED = {
+    'type': 'Query Rejected',
+    'exception': controller.db.QueryRejected('The estimated cost of the query exceeds the allowed limit',
+                                             {'cost': 2000.0, 'rows': 10.0}, {'cost': 1000.0}),
+    'status': 400
+}
+
+QUERY_DEFERRED = {
+    'type': 'Query Rejected',
+    'exception': controller.db.QueryRejected('Too many expensive queries are being executed, retry later',
+                                             {'cost': 2000.0, 'rows': 10.0}, {'heavy_cost': 1000.0}, 503, 5),
+    'status': 503
+}
+
 ##### ACCEPT TYPE AND THE EXPECTED RESPONSE FOR THIS TYPE #####
 JSON = {'type': utils.JSON, 'expected': 'application/json', 'response': 'JSON CONTENT', }
 XML = {'type': utils.XML, 'expected': 'application/xml', 'response': 'XML CONTENT'}
@@ -162,6 +208,18 @@ INVALID_CONTENT_CREATE_ENTRY = {
     'message': 'Only lists of dicts can be placed to create entries'
 }
 
+INVALID_CONTENT_UPSERT_INDEX = {
+    'status': 409,
+    'type': 'Validation Error',
+    'message': 'Only dicts can be placed to create/modify an index'
+}
+
+INVALID_CONTENT_UPSERT_WEBHOOK = {
+    'status': 409,
+    'type': 'Validation Error',
+    'message': 'Only dicts can be placed to create/modify a webhook'
+}
+
 AUTOMATIC_PK = {
     'status': 409,
     'type': 'Validation Error',
@@ -185,6 +243,16 @@ class TestDataStoreController(object):
         self._json_loads = utils.helpers.json.loads
         self._finish = utils.finish
         self._parse_response = utils.parse_response
+        self._stats_config = stats.config
+        self._db_config = controller.db.config
+        self._stream_response = utils.stream_response
+        self._start_flusher = controller.advisor.start_flusher
+        self._cache_config = controller.cache.config
+        self._check_access = controller.plugins.toolkit.check_access
+        self._coalesce = controller.coalescing.coalesce
+        self._coalescing_config = controller.coalescing.config
+        self._notify = controller.webhooks.notify
+        self._export_config = controller.export.config
 
         # Create mocks
         utils.finish = MagicMock(return_value='FINISH FUNCTION')
@@ -199,6 +267,15 @@ class TestDataStoreController(object):
         utils.response_parser.xml_parser = MagicMock(return_value=XML['response'])
         utils.response_parser.csv_parser = MagicMock(return_value=CSV['response'])
         utils.helpers.json.dumps = MagicMock(return_value=JSON['response'])
+        stats.config = {stats.DEBUG_HEADERS: 'true'}
+        controller.db.config = {}
+        utils.stream_response = utils.parse_response     # Streamed responses are checked as parsed ones
+        controller.advisor.start_flusher = MagicMock()
+        controller.cache.config = {}
+        controller.plugins.toolkit.check_access = MagicMock()
+        controller.coalescing.config = {}
+        controller.webhooks.notify = MagicMock()
+        controller.export.config = {}
 
     def teardown(self):
         # Restore the mocks
@@ -209,10 +286,26 @@ class TestDataStoreController(object):
         utils.helpers.json.loads = self._json_loads
         utils.finish = self._finish
         utils.parse_response = self._parse_response
+        stats.config = self._stats_config
+        controller.db.config = self._db_config
+        utils.stream_response = self._stream_response
+        controller.advisor.start_flusher = self._start_flusher
+        controller.cache.config = self._cache_config
+        controller.plugins.toolkit.check_access = self._check_access
+        controller.coalescing.coalesce = self._coalesce
+        controller.coalescing.config = self._coalescing_config
+        controller.webhooks.notify = self._notify
+        controller.export.config = self._export_config
 
     def set_side_effect(self, logic_function, side_effect):
         logic_function.side_effect = side_effect['exception']
 
+    def _assert_round_trips(self, action):
+        # The number of DataStore actions called by each endpoint is returned in the debug headers
+        actions = int(controller.response.headers[stats.ACTIONS_HEADER])
+        assert actions <= ROUND_TRIP_BUDGETS[action], \
+            '%s called %d DataStore actions (budget: %d)' % (action, actions, ROUND_TRIP_BUDGETS[action])
+
     def _generic_test(self, function, logic_functions_prop, content_type, resource_id=None, entry_id=None,
                       get_content=None, post_content=None, fields=None, expected_error=None):
 
@@ -227,6 +320,7 @@ class TestDataStoreController(object):
             get_params = copy.deepcopy(get_content)
             controller.request.GET.mixed = Mock(return_value=get_params)                    # Set GET content
         controller.response.headers = {}                                                    # This object will be used by _finish function
+        controller.request.environ = {'pylons.routes_dict': {'action': function.__name__}}  # Used to identify the endpoint
 
         logic_functions = {}
         side_effect = None
@@ -352,6 +446,10 @@ class TestDataStoreController(object):
         utils.finish.assert_called_once_with(expected_status, expected_response, expected_content_type)
         assert_equal(utils.finish.return_value, response)
 
+        self._assert_round_trips(function.__name__)
+        # Query shapes are saved in the background
+        controller.advisor.start_flusher.assert_called_once_with()
+
     @parameterized.expand([
         ('71bba7b5-6882-4099-88b3-4ca9a7468b38', DEFAULT_FIELDS, JSON),
         ('ddddbeab-d0e0-417a-9582-c7b02dd858da', DEFAULT_FIELDS, XML),
@@ -413,7 +511,7 @@ class TestDataStoreController(object):
         logic_functions_prop = []
 
         logic_functions_prop.append({})     # 0
-        logic_functions_prop[0]['name'] = 'datastore_create'
+        logic_functions_prop[0]['name'] = 'datastore_restful_upsert_resource'
         logic_functions_prop[0]['side_effect'] = side_effect
         logic_functions_prop[0]['expected_call'] = expected_call
 
@@ -494,7 +592,7 @@ class TestDataStoreController(object):
 
         logic_functions_prop = []
         logic_functions_prop.append({})     # 0
-        logic_functions_prop[0]['name'] = 'datastore_delete'
+        logic_functions_prop[0]['name'] = 'datastore_restful_delete_resource'
         logic_functions_prop[0]['side_effect'] = side_effect
         logic_functions_prop[0]['expected_call'] = expected_call
 
@@ -550,6 +648,266 @@ class TestDataStoreController(object):
         self._generic_test(self.restController.search_entries, logic_functions_prop, content_type, resource_id,
                            get_content=get_parameters, fields='records')
 
+    @parameterized.expand([
+        ('71bba7b5-6882-4099-88b3-4ca9a7468b38', {'test[gt]': '30'}, {'test': {'gt': '30'}}, JSON),
+        ('ddddbeab-d0e0-417a-9582-c7b02dd858da', {'test[gte]': '1', 'test[lt]': '9', 'test1': 'a'},
+         {'test': {'gte': '1', 'lt': '9'}, 'test1': 'a'}, XML),
+        ('7b98539d-57f8-466d-9810-91cff04848ff', {'test': '3', 'test[ne]': '4'}, {'test': {'eq': '3', 'ne': '4'}}, CSV),
+        ('8fa623dc-1368-4756-a741-15bba0b16fc9', {'test[in]': '1,2', '$count': 'none'}, {'test': {'in': '1,2'}}, JSON),
+        ('a04bf1c0-7b25-4e18-82a2-545741dacdf4', {'count[gt]': '5', 'layout': 'a'},
+         {'count': {'gt': '5'}, 'layout': 'a'}, JSON),
+        ('586330ce-b4f7-4160-b0d3-7c19dd59cd14', {'count': '5', '$count': 'estimated'}, {'count': '5'}, XML),
+        ('737d6f99-4a8a-42c2-8205-6907be05f103', {'test[like]': 'a'}, {'test': {'like': 'a'}}, JSON, VALIDATION_ERROR)
+    ])
+    def test_search_resource_operators(self, resource_id, get_parameters, expected_filters, content_type,
+                                       side_effect=None):
+
+        expected_call = {'resource_id': resource_id, 'filters': expected_filters}
+        if '$count' in get_parameters:
+            expected_call['count'] = get_parameters['$count']
+
+        logic_functions_prop = []
+        logic_functions_prop.append({})     # 0
+        logic_functions_prop[0]['name'] = 'datastore_restful_search'
+        logic_functions_prop[0]['side_effect'] = side_effect
+        logic_functions_prop[0]['expected_call'] = expected_call
+
+        self._generic_test(self.restController.search_entries, logic_functions_prop, content_type, resource_id,
+                           get_content=get_parameters, fields='records')
+
+    @parameterized.expand([
+        ('71bba7b5-6882-4099-88b3-4ca9a7468b38', None, 'datastore_search', JSON),
+        ('ddddbeab-d0e0-417a-9582-c7b02dd858da', 'exact', 'datastore_search', XML),
+        ('7b98539d-57f8-466d-9810-91cff04848ff', 'estimated', 'datastore_restful_search', CSV),
+        ('8fa623dc-1368-4756-a741-15bba0b16fc9', 'none', 'datastore_restful_search', JSON),
+        ('a04bf1c0-7b25-4e18-82a2-545741dacdf4', 'estimated', 'datastore_restful_search', JSON, NOT_AUTHORIZED),
+        ('737d6f99-4a8a-42c2-8205-6907be05f103', 'invalid', 'datastore_restful_search', XML, VALIDATION_ERROR)
+    ])
+    def test_search_resource_count(self, resource_id, count, expected_function, content_type, side_effect=None):
+
+        get_parameters = {'$limit': 1, 'test': 'a value'}
+        if count:
+            get_parameters['$count'] = count
+
+        expected_call = {'resource_id': resource_id, 'limit': 1, 'filters': {'test': 'a value'}}
+        if expected_function == 'datastore_restful_search':
+            expected_call['count'] = count
+
+        return_value = copy.deepcopy(DEFAULT_LOGIC_FUNCTION_RES)
+        if count != 'none':
+            return_value['total'] = 27
+
+        logic_functions_prop = []
+        logic_functions_prop.append({})     # 0
+        logic_functions_prop[0]['name'] = expected_function
+        logic_functions_prop[0]['side_effect'] = side_effect
+        logic_functions_prop[0]['expected_call'] = expected_call
+        logic_functions_prop[0]['return_value'] = return_value
+
+        self._generic_test(self.restController.search_entries, logic_functions_prop, content_type, resource_id,
+                           get_content=get_parameters, fields='records')
+
+        if not side_effect:
+            assert_equal(count != 'none', controller.TOTAL_HEADER in controller.response.headers)
+
+    @parameterized.expand([
+        ('71bba7b5-6882-4099-88b3-4ca9a7468b38', 'columns', None, JSON),
+        ('ddddbeab-d0e0-417a-9582-c7b02dd858da', 'columns', 'test, test1', JSON),
+        ('7b98539d-57f8-466d-9810-91cff04848ff', 'records', 'test', JSON),
+        ('737d6f99-4a8a-42c2-8205-6907be05f103', 'invalid', None, JSON, VALIDATION_ERROR)
+    ])
+    def test_search_resource_layout(self, resource_id, layout, fields, content_type, side_effect=None):
+
+        get_parameters = {'$layout': layout, '$count': 'none'}
+        expected_call = {'resource_id': resource_id, 'layout': layout, 'count': 'none', 'filters': {}}
+        if fields:
+            get_parameters['$fields'] = fields
+            expected_call['fields'] = fields
+
+        if layout == 'columns':
+            values = 'columns'
+            return_value = {'resource_id': resource_id, 'fields': [{'id': 'test', 'type': 'text'}], values: [['a', 'b']]}
+        else:
+            values = 'records'
+            return_value = copy.deepcopy(DEFAULT_LOGIC_FUNCTION_RES)
+
+        logic_functions_prop = []
+        logic_functions_prop.append({})     # 0
+        logic_functions_prop[0]['name'] = 'datastore_restful_search'
+        logic_functions_prop[0]['side_effect'] = side_effect
+        logic_functions_prop[0]['expected_call'] = expected_call
+        logic_functions_prop[0]['return_value'] = return_value
+
+        self._generic_test(self.restController.search_entries, logic_functions_prop, content_type, resource_id,
+                           get_content=get_parameters, fields=values)
+
+        # Array layouts are returned with the list of fields
+        if not side_effect and layout != 'records':
+            parsed = utils.parse_response.call_args[0][0]
+            assert_equal(sorted(['fields', values]), sorted(parsed.keys()))
+            assert_equal(return_value[values], parsed[values])
+
+    @parameterized.expand([
+        ('71bba7b5-6882-4099-88b3-4ca9a7468b38', {}, JSON),
+        ('ddddbeab-d0e0-417a-9582-c7b02dd858da', {'$count': 'estimated', 'test': 'a value'}, JSON),
+        ('7b98539d-57f8-466d-9810-91cff04848ff', {'$count': 'none', 'count': '5', 'layout': 'a'}, JSON),
+        ('a04bf1c0-7b25-4e18-82a2-545741dacdf4', {}, JSON, NOT_AUTHORIZED),
+        ('7445f342-c1fa-407c-8482-a03ca972d621', {}, JSON, NOT_FOUND)
+    ])
+    def test_count_entries(self, resource_id, get_parameters, content_type, side_effect=None):
+
+        expected_call = {'resource_id': resource_id, 'limit': 0, 'filters': {}}
+        for parameter in get_parameters:
+            if parameter.startswith('$'):
+                expected_call[parameter[1:]] = get_parameters[parameter]
+            else:
+                expected_call['filters'][parameter] = get_parameters[parameter]
+
+        logic_functions_prop = []
+        logic_functions_prop.append({})     # 0
+        logic_functions_prop[0]['name'] = 'datastore_restful_search'
+        logic_functions_prop[0]['side_effect'] = side_effect
+        logic_functions_prop[0]['expected_call'] = expected_call
+        logic_functions_prop[0]['return_value'] = {'resource_id': resource_id, 'fields': [], 'records': [], 'total': 27}
+
+        self._generic_test(self.restController.count_entries, logic_functions_prop, content_type, resource_id,
+                           get_content=get_parameters)
+
+        if not side_effect:
+            assert_equal('27', controller.response.headers[controller.TOTAL_HEADER])
+
+    @parameterized.expand([
+        ('71bba7b5-6882-4099-88b3-4ca9a7468b38', {'$group_by': 'test1', '$sum': 'test'}, JSON),
+        ('ddddbeab-d0e0-417a-9582-c7b02dd858da', {'$count': '*', 'test1': 'a value', 'test[gt]': '3'}, XML),
+        ('7b98539d-57f8-466d-9810-91cff04848ff', {'$group_by': 'test1', '$avg': 'test', '$min': 'test',
+                                                  '$max': 'test', '$sort': 'avg_test desc', '$limit': 20}, CSV),
+        ('586330ce-b4f7-4160-b0d3-7c19dd59cd14', {'$group_by': 'sum', '$min': 'max', 'sum': 'a value',
+                                                  'group_by': '1', 'avg': '2', 'min': '3', 'max': '4'}, JSON),
+        ('a04bf1c0-7b25-4e18-82a2-545741dacdf4', {'$group_by': 'test1'}, JSON, NOT_AUTHORIZED),
+        ('737d6f99-4a8a-42c2-8205-6907be05f103', {'$sum': 'unknown'}, JSON, VALIDATION_ERROR)
+    ])
+    def test_aggregate(self, resource_id, get_parameters, content_type, side_effect=None):
+
+        expected_call = {'resource_id': resource_id, 'filters': {}}
+        for parameter in get_parameters:
+            if parameter.startswith('$'):
+                expected_call[parameter[1:]] = get_parameters[parameter]
+            elif parameter == 'test[gt]':
+                expected_call['filters']['test'] = {'gt': get_parameters[parameter]}
+            else:
+                expected_call['filters'][parameter] = get_parameters[parameter]
+
+        logic_functions_prop = []
+        logic_functions_prop.append({})     # 0
+        logic_functions_prop[0]['name'] = 'datastore_restful_aggregate'
+        logic_functions_prop[0]['side_effect'] = side_effect
+        logic_functions_prop[0]['expected_call'] = expected_call
+        logic_functions_prop[0]['return_value'] = {'resource_id': resource_id, 'fields': [{'id': 'test1'}],
+                                                   'records': [{'test1': 'a', 'sum_test': 3}]}
+
+        self._generic_test(self.restController.aggregate, logic_functions_prop, content_type, resource_id,
+                           get_content=get_parameters, fields='records')
+
+    @parameterized.expand([
+        ('71bba7b5-6882-4099-88b3-4ca9a7468b38', {'$time': 'test1', '$interval': 'day', '$avg': 'test'}, JSON),
+        ('ddddbeab-d0e0-417a-9582-c7b02dd858da', {'$time': 'test1', '$points': '500', '$value': 'test'}, XML),
+        ('7b98539d-57f8-466d-9810-91cff04848ff', {'$time': 'test1', '$interval': '5 minutes', '$max': 'test',
+                                                  '$points': '100', '$value': 'max_test', 'test[gt]': '0'}, CSV),
+        ('586330ce-b4f7-4160-b0d3-7c19dd59cd14', {'$time': 'time', '$interval': 'day', '$sum': 'value',
+                                                  'time': '2014-01-01', 'value': '3', 'interval': 'a',
+                                                  'points': '4', 'sum': '5'}, JSON),
+        ('a04bf1c0-7b25-4e18-82a2-545741dacdf4', {'$time': 'test1', '$interval': 'day'}, JSON, NOT_AUTHORIZED),
+        ('737d6f99-4a8a-42c2-8205-6907be05f103', {'$time': 'test1'}, JSON, VALIDATION_ERROR)
+    ])
+    def test_downsample(self, resource_id, get_parameters, content_type, side_effect=None):
+
+        expected_call = {'resource_id': resource_id, 'filters': {}}
+        for parameter in get_parameters:
+            if parameter.startswith('$'):
+                expected_call[parameter[1:]] = get_parameters[parameter]
+            elif parameter == 'test[gt]':
+                expected_call['filters']['test'] = {'gt': get_parameters[parameter]}
+            else:
+                expected_call['filters'][parameter] = get_parameters[parameter]
+
+        logic_functions_prop = []
+        logic_functions_prop.append({})     # 0
+        logic_functions_prop[0]['name'] = 'datastore_restful_downsample'
+        logic_functions_prop[0]['side_effect'] = side_effect
+        logic_functions_prop[0]['expected_call'] = expected_call
+        logic_functions_prop[0]['return_value'] = {'resource_id': resource_id, 'fields': [{'id': 'test1'}],
+                                                   'records': [{'test1': '2014-01-01T00:00:00', 'count': 3}]}
+
+        self._generic_test(self.restController.downsample, logic_functions_prop, content_type, resource_id,
+                           get_content=get_parameters, fields='records')
+
+    @parameterized.expand([
+        ('71bba7b5-6882-4099-88b3-4ca9a7468b38', {}, JSON),
+        ('ddddbeab-d0e0-417a-9582-c7b02dd858da', {'since': '25', 'limit': '100'}, XML),
+        ('a04bf1c0-7b25-4e18-82a2-545741dacdf4', {'since': '25'}, JSON, NOT_AUTHORIZED),
+        ('7445f342-c1fa-407c-8482-a03ca972d621', {'since': '25'}, JSON, NOT_FOUND),
+        ('737d6f99-4a8a-42c2-8205-6907be05f103', {'since': '-1'}, JSON, VALIDATION_ERROR)
+    ])
+    def test_changes(self, resource_id, get_parameters, content_type, side_effect=None):
+
+        expected_call = dict(get_parameters, resource_id=resource_id)
+
+        logic_functions_prop = []
+        logic_functions_prop.append({})     # 0
+        logic_functions_prop[0]['name'] = 'datastore_restful_changes'
+        logic_functions_prop[0]['side_effect'] = side_effect
+        logic_functions_prop[0]['expected_call'] = expected_call
+        logic_functions_prop[0]['return_value'] = {'resource_id': resource_id, 'fields': [{'id': 'test1'}],
+                                                   'records': [{'pk': 1, 'test1': 'a', '_version': 26, '_deleted': False},
+                                                               {'pk': 2, '_version': 27, '_deleted': True}],
+                                                   'next': 27, 'more': False}
+
+        self._generic_test(self.restController.changes, logic_functions_prop, content_type, resource_id,
+                           get_content=get_parameters, fields='records')
+
+    @parameterized.expand([
+        ('71bba7b5-6882-4099-88b3-4ca9a7468b38', CSV, 26, 26, '206 Partial Content'),
+        ('ddddbeab-d0e0-417a-9582-c7b02dd858da', JSON, 25, 26, '200 OK'),
+        ('7b98539d-57f8-466d-9810-91cff04848ff', CSV, None, 26, None),
+        ('a04bf1c0-7b25-4e18-82a2-545741dacdf4', CSV, None, None, None, NOT_AUTHORIZED),
+        ('7445f342-c1fa-407c-8482-a03ca972d621', JSON, None, None, None, NOT_FOUND)
+    ])
+    def test_export(self, resource_id, content_type, export_version, version, status, side_effect=None):
+
+        utils.get_content_type.return_value = content_type['type']
+        controller.response.headers = {}
+        controller.request.environ = {'pylons.routes_dict': {'action': 'export'}}
+        controller.request.call_application.return_value = (status, [('ETag', '"%s"' % export_version)], ['GZIP'])
+        controller.plugins.toolkit.get_action = MagicMock()
+        logic_function = controller.plugins.toolkit.get_action.return_value
+        logic_function.side_effect = side_effect['exception'] if side_effect else None
+        logic_function.return_value = {'resource_id': resource_id, 'format': content_type['type'], 'version': version,
+                                       'export_version': export_version, 'stale': export_version < version}
+
+        result = self.restController.export(resource_id)
+
+        controller.plugins.toolkit.get_action.assert_called_once_with('datastore_restful_export')
+        assert_equal({'resource_id': resource_id, 'format': content_type['type']}, logic_function.call_args[0][1])
+        self._assert_round_trips('export')
+
+        if side_effect:
+            assert_equal(side_effect['status'], utils.finish.call_args[0][0])
+        elif export_version is None:
+            # The first export is still being generated
+            assert_equal(202, utils.finish.call_args[0][0])
+            assert_equal('5', controller.response.headers['Retry-After'])
+            assert_equal(0, controller.request.call_application.call_count)
+        else:
+            # The file is served with the status and the headers of the file application
+            assert_equal(['GZIP'], result)
+            assert_equal(0, utils.finish.call_count)
+            assert_equal(status, controller.response.status)
+            assert_equal('"%s"' % export_version, controller.response.headers['ETag'])
+            app = controller.request.call_application.call_args[0][0]
+            assert_equal('"%d-%s"' % (export_version, content_type['type']), app.calculate_etag())
+            assert app.filename.endswith('.%d.%s.gz' % (export_version, content_type['type']))
+            assert_equal(export_version < version, 'Warning' in controller.response.headers)
+
     @parameterized.expand([
         ('71bba7b5-6882-4099-88b3-4ca9a7468b38', 1, JSON),
         ('ddddbeab-d0e0-417a-9582-c7b02dd858da', 2, XML),
@@ -635,15 +993,14 @@ class TestDataStoreController(object):
         expected_call['resource_id'] = resource_id
         expected_call['records'] = records
         expected_call['records'][0][controller.IDENTIFIER] = entry_id
-        expected_call['force'] = True
-        expected_call['method'] = 'upsert'
 
         return_value = copy.deepcopy(DEFAULT_LOGIC_FUNCTION_RES)
         return_value['records'] = [return_value['records'][0]]
+        return_value['unchanged'] = False
 
         logic_functions_prop = []
         logic_functions_prop.append({})     # 0
-        logic_functions_prop[0]['name'] = 'datastore_upsert'
+        logic_functions_prop[0]['name'] = 'datastore_restful_upsert_entry'
         logic_functions_prop[0]['side_effect'] = side_effect
         logic_functions_prop[0]['expected_call'] = expected_call
         logic_functions_prop[0]['return_value'] = return_value
@@ -651,6 +1008,9 @@ class TestDataStoreController(object):
         self._generic_test(self.restController.upsert_entry, logic_functions_prop, content_type, resource_id,
                            entry_id, post_content=record, fields='records', expected_error=expected_error)
 
+        if not side_effect and not expected_error:
+            assert_equal('false', controller.response.headers[controller.UNCHANGED_HEADER])
+
     @parameterized.expand([
         ('71bba7b5-6882-4099-88b3-4ca9a7468b38', DEFAULT_RECORDS, JSON),
         ('ddddbeab-d0e0-417a-9582-c7b02dd858da', DEFAULT_RECORDS, XML),
@@ -688,12 +1048,7 @@ class TestDataStoreController(object):
         ('3137df0f-4304-4166-a7a6-f0aa9b9ef13e', [8, "test", "test2"], XML, None, INVALID_CONTENT_CREATE_ENTRY),
         ('2450063c-3085-415e-aab5-516d534e0c85', ["test", 1, 3], CSV, None, INVALID_CONTENT_CREATE_ENTRY)
     ])
-    def test_create_entries(self, resource_id, records, content_type, side_effect=None, expected_error=None, remove_pk=True, max_pk_exists=True, jsonp=False):
-
-        max_pk = 8 if max_pk_exists else None
-
-        expected_call_max = {}
-        expected_call_max['sql'] = 'SELECT MAX(pk) AS max FROM \"%s\";' % resource_id
+    def test_create_entries(self, resource_id, records, content_type, side_effect=None, expected_error=None, remove_pk=True):
 
         records = copy.deepcopy(records)
 
@@ -704,37 +1059,16 @@ class TestDataStoreController(object):
                     if controller.IDENTIFIER in record:
                         del record[controller.IDENTIFIER]
 
-        # The records included in the upsert method should include a 'pk' field
-        # set automatically by the API
-        expected_records = copy.deepcopy(records)
-        if isinstance(records, list):
-            pk = max_pk if max_pk else 0
-            for record in expected_records:
-                if isinstance(record, dict):
-                    pk += 1
-                    record[controller.IDENTIFIER] = pk
-
-        expected_call_upsert = {}
-        expected_call_upsert['resource_id'] = resource_id
-        expected_call_upsert['records'] = expected_records
-        expected_call_upsert['force'] = True
-        expected_call_upsert['method'] = 'upsert'
-
-        return_value_max = {}
-        return_value_max['records'] = []
-        return_value_max['records'].append({'max': max_pk})
+        # The 'pk' of the records is set by the action, in the same transaction that inserts them
+        expected_call = {}
+        expected_call['resource_id'] = resource_id
+        expected_call['records'] = records
 
         logic_functions_prop = []
         logic_functions_prop.append({})     # 0
-        logic_functions_prop[0]['name'] = 'datastore_search_sql'
-        logic_functions_prop[0]['side_effect'] = None
-        logic_functions_prop[0]['expected_call'] = expected_call_max
-        logic_functions_prop[0]['return_value'] = return_value_max
-
-        logic_functions_prop.append({})     # 1
-        logic_functions_prop[1]['name'] = 'datastore_upsert'
-        logic_functions_prop[1]['side_effect'] = side_effect
-        logic_functions_prop[1]['expected_call'] = expected_call_upsert
+        logic_functions_prop[0]['name'] = 'datastore_restful_create_entries'
+        logic_functions_prop[0]['side_effect'] = side_effect
+        logic_functions_prop[0]['expected_call'] = expected_call
 
         self._generic_test(self.restController.create_entries, logic_functions_prop, content_type, resource_id,
                            post_content=records, fields='records', expected_error=expected_error)
@@ -765,35 +1099,149 @@ class TestDataStoreController(object):
     ])
     def test_delete_entry(self, resource_id, entry_id, content_type, side_effect=None, expected_error=None, returned_records=None):
 
-        expected_call_search = {}
-        expected_call_search = {}
-        expected_call_search['filters'] = {controller.IDENTIFIER: entry_id}
-        expected_call_search['resource_id'] = resource_id
-
-        expected_call_del = {}
-        expected_call_del['resource_id'] = resource_id
-        expected_call_del['filters'] = {}
-        expected_call_del['filters'][controller.IDENTIFIER] = entry_id
-        expected_call_del['force'] = True
+        expected_call = {}
+        expected_call['resource_id'] = resource_id
+        expected_call['pk'] = entry_id
 
-        return_value_search = copy.deepcopy(DEFAULT_LOGIC_FUNCTION_RES)
-        return_value_search['records'] = returned_records if returned_records is not None else [return_value_search['records'][0]]
+        # The action checks that the entry exists in the same transaction that deletes it
+        if returned_records == []:
+            side_effect = {
+                'exception': controller.plugins.toolkit.ObjectNotFound(
+                    'The element %s does not exist in the resource %s' % (entry_id, resource_id))
+            }
 
         logic_functions_prop = []
         logic_functions_prop.append({})     # 0
-        logic_functions_prop[0]['name'] = 'datastore_search'
-        logic_functions_prop[0]['side_effect'] = None
-        logic_functions_prop[0]['expected_call'] = expected_call_search
-        logic_functions_prop[0]['return_value'] = return_value_search
-
-        logic_functions_prop.append({})     # 1
-        logic_functions_prop[1]['name'] = 'datastore_delete'
-        logic_functions_prop[1]['side_effect'] = side_effect
-        logic_functions_prop[1]['expected_call'] = expected_call_del
+        logic_functions_prop[0]['name'] = 'datastore_restful_delete_entry'
+        logic_functions_prop[0]['side_effect'] = side_effect
+        logic_functions_prop[0]['expected_call'] = expected_call
 
         self._generic_test(self.restController.delete_entry, logic_functions_prop, content_type,
                            resource_id, entry_id, expected_error=expected_error)
 
+    @parameterized.expand([
+        ('upsert_entry', 1, 1, DEFAULT_RECORDS[0], True),
+        # Writes of any entry discard all the cached entries of the resource
+        ('upsert_entry', 2, 1, DEFAULT_RECORDS[0], True),
+        # Entries whose content has not changed are not written, so nothing is invalidated
+        ('upsert_entry', 1, 1, DEFAULT_RECORDS[0], False, True),
+        ('delete_entry', 1, 1, None, True),
+        ('create_entries', 1, None, [DEFAULT_RECORDS[0]], True),
+        ('delete_resource', 1, None, None, True),
+        ('upsert_resource', 1, None, DEFAULT_FIELDS, True)
+    ])
+    def test_get_entry_cache(self, action, entry_id, written_entry_id, body, expected_invalidation, unchanged=False):
+
+        resource_id = '71bba7b5-6882-4099-88b3-4ca9a7468b38'
+        controller.cache.config = {controller.cache.ENTRY_CACHE_SIZE: '1048576'}
+        controller.cache.get_cache(controller.cache.ENTRIES).backend.clear()
+
+        self.test_get_entry(resource_id, entry_id, JSON)
+
+        # The cached response is returned without calling the DataStore, but the access is still checked
+        controller.plugins.toolkit.get_action.reset_mock()
+        utils.finish.reset_mock()
+        assert_equal(utils.finish.return_value, self.restController.get_entry(resource_id, entry_id))
+        assert_equal(0, controller.plugins.toolkit.get_action.call_count)
+        controller.plugins.toolkit.check_access.assert_called_once_with('datastore_search', {
+            'model': controller.model,
+            'session': controller.model.Session,
+            'user': controller.plugins.toolkit.c.user
+        }, {'resource_id': resource_id})
+        utils.finish.assert_called_once_with(200, utils.parse_response.return_value, JSON['type'])
+
+        # Writes through the API remove the cached entries
+        function = getattr(self.restController, action)
+        controller.request.body = json.dumps(body)
+        controller.plugins.toolkit.get_action = MagicMock()
+        controller.plugins.toolkit.get_action.return_value.return_value = copy.deepcopy(DEFAULT_LOGIC_FUNCTION_RES)
+        controller.plugins.toolkit.get_action.return_value.return_value['records'] = [{'max': 1}]
+        controller.plugins.toolkit.get_action.return_value.return_value['unchanged'] = unchanged
+        if written_entry_id is None:
+            function(resource_id)
+        else:
+            function(resource_id, written_entry_id)
+
+        controller.plugins.toolkit.get_action.reset_mock()
+        self.restController.get_entry(resource_id, entry_id)
+        assert_equal(expected_invalidation, controller.plugins.toolkit.get_action.called)
+
+    def test_search_entries_cache(self):
+
+        resource_id = '71bba7b5-6882-4099-88b3-4ca9a7468b38'
+        controller.cache.config = {controller.cache.SEARCH_CACHE_SIZE: '1048576'}
+        controller.cache.get_cache(controller.cache.SEARCHES).backend.clear()
+
+        utils.get_content_type.return_value = JSON['type']
+        controller.request.environ = {'pylons.routes_dict': {'action': 'search_entries'}}
+        controller.request.headers = {'host': 'localhost'}
+        result = copy.deepcopy(DEFAULT_LOGIC_FUNCTION_RES)
+        result['total'] = 2
+        controller.plugins.toolkit.get_action = MagicMock()
+        search = controller.plugins.toolkit.get_action.return_value
+        search.return_value = result
+
+        def _search(get_parameters):
+            controller.request.GET.mixed = Mock(return_value=copy.deepcopy(get_parameters))
+            controller.response.headers = {}
+            return self.restController.search_entries(resource_id)
+
+        _search(DEFAULT_SEARCH)
+        assert_equal(1, search.call_count)
+
+        # Identical searches are returned from the cache, with their headers
+        assert_equal(utils.finish.return_value, _search(DEFAULT_SEARCH))
+        assert_equal(1, search.call_count)
+        assert_equal('2', controller.response.headers[controller.TOTAL_HEADER])
+        assert_equal(1, controller.plugins.toolkit.check_access.call_count)
+
+        # Searches with other parameters are executed
+        other_search = copy.deepcopy(DEFAULT_SEARCH)
+        other_search['$offset'] = 4
+        _search(other_search)
+        assert_equal(2, search.call_count)
+
+        # Responses are not shared among hosts, since the XML ones include their URLs
+        controller.request.headers = {'host': 'example.com'}
+        _search(DEFAULT_SEARCH)
+        assert_equal(3, search.call_count)
+        controller.request.headers = {'host': 'localhost'}
+
+        # Writes discard all the searches of the resource
+        controller.request.body = json.dumps(DEFAULT_RECORDS[0])
+        self.restController.upsert_entry(resource_id, 1)
+        _search(DEFAULT_SEARCH)
+        _search(other_search)
+        assert_equal(6, search.call_count)     # The upsert is mocked by the same function
+
+    @parameterized.expand([
+        ('true', 0),
+        ('false', 1)
+    ])
+    def test_search_entries_coalesced(self, coalesce_reads, expected_calls):
+
+        resource_id = '71bba7b5-6882-4099-88b3-4ca9a7468b38'
+        controller.coalescing.config[controller.coalescing.COALESCE_READS] = coalesce_reads
+
+        # Other request with the same parameters is being executed
+        controller.coalescing.coalesce = MagicMock(return_value=(('SHARED CONTENT', {controller.TOTAL_HEADER: '2'}), False))
+        utils.get_content_type.return_value = JSON['type']
+        controller.request.environ = {'pylons.routes_dict': {'action': 'search_entries'}}
+        controller.request.GET.mixed = Mock(return_value=copy.deepcopy(DEFAULT_SEARCH))
+        controller.response.headers = {}
+        controller.plugins.toolkit.get_action = MagicMock()
+        controller.plugins.toolkit.get_action.return_value.return_value = copy.deepcopy(DEFAULT_LOGIC_FUNCTION_RES)
+
+        self.restController.search_entries(resource_id)
+
+        assert_equal(expected_calls, controller.plugins.toolkit.get_action.call_count)
+        if expected_calls == 0:
+            # The requests of each user are coalesced separately
+            flight_key = controller.coalescing.coalesce.call_args[0][0]
+            assert_equal(('datastore_search', controller.plugins.toolkit.c.user, JSON['type']), flight_key[:3])
+            assert_equal('2', controller.response.headers[controller.TOTAL_HEADER])
+            utils.finish.assert_called_once_with(200, 'SHARED CONTENT', JSON['type'])
+
     @parameterized.expand([
         ('select * from 71bba7b5-6882-4099-88b3-4ca9a7468b38', JSON),
         ('select * from ddddbeab-d0e0-417a-9582-c7b02dd858da', XML),
@@ -839,3 +1287,327 @@ class TestDataStoreController(object):
 
         self._generic_test(self.restController.sql, logic_functions_prop, content_type,
                            get_content=get_parameters, fields='records')
+
+    @parameterized.expand([
+        ('select * from "a2b8ae15"', JSON),
+        ('select * from "a2b8ae15"', XML),
+        ('select * from "a2b8ae15"', CSV),
+        ('select * from "a2b8ae15"', JSON, NOT_AUTHORIZED),
+        ('select * from "a2b8ae15"', CSV, VALIDATION_ERROR)
+    ])
+    def test_sql_stream(self, sql, content_type, side_effect=None):
+
+        controller.db.config[controller.db.STREAM_SQL] = 'true'
+
+        get_parameters = {}
+        get_parameters['sql'] = sql
+
+        logic_functions_prop = []
+        logic_functions_prop.append({})     # 0
+        logic_functions_prop[0]['name'] = 'datastore_restful_stream_sql'
+        logic_functions_prop[0]['side_effect'] = side_effect
+        logic_functions_prop[0]['expected_call'] = copy.deepcopy(get_parameters)
+
+        self._generic_test(self.restController.sql, logic_functions_prop, content_type,
+                           get_content=get_parameters, fields='records')
+
+    @parameterized.expand([
+        ('select * from "a2b8ae15"', JSON),
+        ('select * from "a2b8ae15"', XML),
+        ('select * from "a2b8ae15"', CSV),
+        ('select * from "a2b8ae15"', JSON, QUERY_REJECTED),
+        ('select * from "a2b8ae15"', XML, QUERY_DEFERRED),
+        ('select * from "a2b8ae15"', CSV, VALIDATION_ERROR)
+    ])
+    def test_sql_admission(self, sql, content_type, side_effect=None):
+
+        controller.db.config[controller.db.SQL_MAX_COST] = '1000'
+
+        get_parameters = {}
+        get_parameters['sql'] = sql
+
+        logic_functions_prop = []
+        logic_functions_prop.append({})     # 0
+        logic_functions_prop[0]['name'] = 'datastore_restful_search_sql'
+        logic_functions_prop[0]['side_effect'] = side_effect
+        logic_functions_prop[0]['expected_call'] = copy.deepcopy(get_parameters)
+
+        self._generic_test(self.restController.sql, logic_functions_prop, content_type,
+                           get_content=get_parameters, fields='records')
+
+        # The estimate is included in the error and deferred queries can be retried
+        if side_effect in (QUERY_REJECTED, QUERY_DEFERRED):
+            error = utils.parse_response.call_args_list[0][0][0]['error']
+            assert_equal(side_effect['exception'].estimate, error['estimate'])
+            assert_equal(side_effect['exception'].limits, error['limits'])
+            assert_equal(side_effect == QUERY_DEFERRED, 'Retry-After' in controller.response.headers)
+
+    @parameterized.expand([
+        ('select * from "a2b8ae15" where a = $1 and b > $2', '["x", 3]', JSON),
+        ('select * from "a2b8ae15" where a = $1', '[null]', XML),
+        ('select * from "a2b8ae15"', '[]', CSV),
+        ('select * from "a2b8ae15" where a = $1', '["x"]', JSON, NOT_AUTHORIZED),
+        ('select * from "a2b8ae15" where a = $1', '["x"]', JSON, VALIDATION_ERROR)
+    ])
+    def test_sql_params(self, sql, params, content_type, side_effect=None):
+
+        get_parameters = {}
+        get_parameters['sql'] = sql
+        get_parameters['params'] = params
+
+        expected_call = copy.deepcopy(get_parameters)
+        expected_call['params'] = json.loads(params)
+
+        logic_functions_prop = []
+        logic_functions_prop.append({})     # 0
+        logic_functions_prop[0]['name'] = 'datastore_restful_search_sql'
+        logic_functions_prop[0]['side_effect'] = side_effect
+        logic_functions_prop[0]['expected_call'] = expected_call
+
+        self._generic_test(self.restController.sql, logic_functions_prop, content_type,
+                           get_content=get_parameters, fields='records')
+
+    @parameterized.expand([
+        ('71bba7b5-6882-4099-88b3-4ca9a7468b38', JSON),
+        ('ddddbeab-d0e0-417a-9582-c7b02dd858da', XML),
+        ('a04bf1c0-7b25-4e18-82a2-545741dacdf4', JSON, NOT_AUTHORIZED),
+        ('7445f342-c1fa-407c-8482-a03ca972d621', JSON, NOT_FOUND)
+    ])
+    def test_list_indexes(self, resource_id, content_type, side_effect=None):
+
+        logic_functions_prop = []
+        logic_functions_prop.append({})     # 0
+        logic_functions_prop[0]['name'] = 'datastore_restful_index_list'
+        logic_functions_prop[0]['side_effect'] = side_effect
+        logic_functions_prop[0]['expected_call'] = {'resource_id': resource_id}
+        logic_functions_prop[0]['return_value'] = {'resource_id': resource_id, 'indexes': [INDEX]}
+
+        self._generic_test(self.restController.list_indexes, logic_functions_prop, content_type, resource_id,
+                           fields='indexes')
+
+    @parameterized.expand([
+        ('71bba7b5-6882-4099-88b3-4ca9a7468b38', 'by_test', JSON),
+        ('ddddbeab-d0e0-417a-9582-c7b02dd858da', 'by_test', XML),
+        ('7445f342-c1fa-407c-8482-a03ca972d621', 'by_test', JSON, NOT_FOUND)
+    ])
+    def test_get_index(self, resource_id, index_name, content_type, side_effect=None):
+
+        logic_functions_prop = []
+        logic_functions_prop.append({})     # 0
+        logic_functions_prop[0]['name'] = 'datastore_restful_index_list'
+        logic_functions_prop[0]['side_effect'] = side_effect
+        logic_functions_prop[0]['expected_call'] = {'resource_id': resource_id, 'name': index_name}
+        logic_functions_prop[0]['return_value'] = {'resource_id': resource_id, 'indexes': [INDEX]}
+
+        self._generic_test(self.restController.get_index, logic_functions_prop, content_type, resource_id,
+                           index_name, fields='index')
+
+        if not side_effect:
+            assert_equal({'index': INDEX}, utils.parse_response.call_args[0][0])
+
+    @parameterized.expand([
+        ('71bba7b5-6882-4099-88b3-4ca9a7468b38', 'by_test', {'fields': ['test']}, JSON),
+        ('ddddbeab-d0e0-417a-9582-c7b02dd858da', 'by_test', {'fields': ['test', 'test1'], 'unique': True}, XML),
+        ('7b98539d-57f8-466d-9810-91cff04848ff', 'by_text', {'fields': ['test1'], 'method': 'gin'}, JSON),
+        ('a04bf1c0-7b25-4e18-82a2-545741dacdf4', 'by_test', {'fields': ['test']}, JSON, NOT_AUTHORIZED),
+        ('737d6f99-4a8a-42c2-8205-6907be05f103', 'by_test', {'fields': ['test']}, JSON, VALIDATION_ERROR),
+        ('6cdbf349-2dff-4003-b0c5-76b63809d329', 'by_test', ['test'], JSON, None, INVALID_CONTENT_UPSERT_INDEX)
+    ])
+    def test_upsert_index(self, resource_id, index_name, index, content_type, side_effect=None, expected_error=None):
+
+        expected_call = copy.deepcopy(index)
+        if isinstance(expected_call, dict):
+            expected_call['resource_id'] = resource_id
+            expected_call['name'] = index_name
+
+        logic_functions_prop = []
+        logic_functions_prop.append({})     # 0
+        logic_functions_prop[0]['name'] = 'datastore_restful_index_create'
+        logic_functions_prop[0]['side_effect'] = side_effect
+        logic_functions_prop[0]['expected_call'] = expected_call
+        logic_functions_prop[0]['return_value'] = {'resource_id': resource_id, 'index': INDEX}
+
+        self._generic_test(self.restController.upsert_index, logic_functions_prop, content_type, resource_id,
+                           index_name, post_content=index, fields='index', expected_error=expected_error)
+
+    @parameterized.expand([
+        ('71bba7b5-6882-4099-88b3-4ca9a7468b38', 'by_test', JSON),
+        ('a04bf1c0-7b25-4e18-82a2-545741dacdf4', 'by_test', JSON, NOT_AUTHORIZED),
+        ('7445f342-c1fa-407c-8482-a03ca972d621', 'by_test', XML, NOT_FOUND)
+    ])
+    def test_delete_index(self, resource_id, index_name, content_type, side_effect=None):
+
+        logic_functions_prop = []
+        logic_functions_prop.append({})     # 0
+        logic_functions_prop[0]['name'] = 'datastore_restful_index_delete'
+        logic_functions_prop[0]['side_effect'] = side_effect
+        logic_functions_prop[0]['expected_call'] = {'resource_id': resource_id, 'name': index_name}
+
+        self._generic_test(self.restController.delete_index, logic_functions_prop, content_type, resource_id,
+                           index_name)
+
+    @parameterized.expand([
+        ('71bba7b5-6882-4099-88b3-4ca9a7468b38', JSON),
+        ('ddddbeab-d0e0-417a-9582-c7b02dd858da', XML),
+        ('a04bf1c0-7b25-4e18-82a2-545741dacdf4', JSON, NOT_AUTHORIZED),
+        ('7445f342-c1fa-407c-8482-a03ca972d621', JSON, NOT_FOUND)
+    ])
+    def test_list_webhooks(self, resource_id, content_type, side_effect=None):
+
+        logic_functions_prop = []
+        logic_functions_prop.append({})     # 0
+        logic_functions_prop[0]['name'] = 'datastore_restful_webhook_list'
+        logic_functions_prop[0]['side_effect'] = side_effect
+        logic_functions_prop[0]['expected_call'] = {'resource_id': resource_id}
+        logic_functions_prop[0]['return_value'] = {'resource_id': resource_id, 'webhooks': [WEBHOOK]}
+
+        self._generic_test(self.restController.list_webhooks, logic_functions_prop, content_type, resource_id,
+                           fields='webhooks')
+
+    @parameterized.expand([
+        ('71bba7b5-6882-4099-88b3-4ca9a7468b38', 'sync', JSON),
+        ('7445f342-c1fa-407c-8482-a03ca972d621', 'sync', JSON, NOT_FOUND)
+    ])
+    def test_get_webhook(self, resource_id, webhook_name, content_type, side_effect=None):
+
+        logic_functions_prop = []
+        logic_functions_prop.append({})     # 0
+        logic_functions_prop[0]['name'] = 'datastore_restful_webhook_list'
+        logic_functions_prop[0]['side_effect'] = side_effect
+        logic_functions_prop[0]['expected_call'] = {'resource_id': resource_id, 'name': webhook_name}
+        logic_functions_prop[0]['return_value'] = {'resource_id': resource_id, 'webhooks': [WEBHOOK]}
+
+        self._generic_test(self.restController.get_webhook, logic_functions_prop, content_type, resource_id,
+                           webhook_name, fields='webhook')
+
+        if not side_effect:
+            assert_equal({'webhook': WEBHOOK}, utils.parse_response.call_args[0][0])
+
+    @parameterized.expand([
+        ('71bba7b5-6882-4099-88b3-4ca9a7468b38', 'sync', {'url': WEBHOOK['url']}, JSON),
+        ('a04bf1c0-7b25-4e18-82a2-545741dacdf4', 'sync', {'url': WEBHOOK['url']}, JSON, NOT_AUTHORIZED),
+        ('737d6f99-4a8a-42c2-8205-6907be05f103', 'sync', {'url': 'ftp://localhost'}, XML, VALIDATION_ERROR),
+        ('6cdbf349-2dff-4003-b0c5-76b63809d329', 'sync', [WEBHOOK['url']], JSON, None, INVALID_CONTENT_UPSERT_WEBHOOK)
+    ])
+    def test_upsert_webhook(self, resource_id, webhook_name, webhook, content_type, side_effect=None,
+                            expected_error=None):
+
+        expected_call = copy.deepcopy(webhook)
+        if isinstance(expected_call, dict):
+            expected_call['resource_id'] = resource_id
+            expected_call['name'] = webhook_name
+
+        logic_functions_prop = []
+        logic_functions_prop.append({})     # 0
+        logic_functions_prop[0]['name'] = 'datastore_restful_webhook_create'
+        logic_functions_prop[0]['side_effect'] = side_effect
+        logic_functions_prop[0]['expected_call'] = expected_call
+        logic_functions_prop[0]['return_value'] = {'resource_id': resource_id, 'webhook': WEBHOOK}
+
+        self._generic_test(self.restController.upsert_webhook, logic_functions_prop, content_type, resource_id,
+                           webhook_name, post_content=webhook, fields='webhook', expected_error=expected_error)
+
+    @parameterized.expand([
+        ('71bba7b5-6882-4099-88b3-4ca9a7468b38', 'sync', JSON),
+        ('7445f342-c1fa-407c-8482-a03ca972d621', 'sync', XML, NOT_FOUND)
+    ])
+    def test_delete_webhook(self, resource_id, webhook_name, content_type, side_effect=None):
+
+        logic_functions_prop = []
+        logic_functions_prop.append({})     # 0
+        logic_functions_prop[0]['name'] = 'datastore_restful_webhook_delete'
+        logic_functions_prop[0]['side_effect'] = side_effect
+        logic_functions_prop[0]['expected_call'] = {'resource_id': resource_id, 'name': webhook_name}
+
+        self._generic_test(self.restController.delete_webhook, logic_functions_prop, content_type, resource_id,
+                           webhook_name)
+
+    @parameterized.expand([
+        ([{'first_pk': 1, 'last_pk': 2, 'inserted': True}, {'first_pk': 3, 'last_pk': 4, 'inserted': True}], 200, 'records'),
+        ([{'first_pk': 1, 'last_pk': 2, 'inserted': True},
+          {'first_pk': 3, 'last_pk': 4, 'inserted': False, 'error': {'constraints': ['duplicate key']}}], 207, None)
+    ])
+    def test_create_entries_chunks(self, chunks, expected_status, expected_field):
+
+        resource_id = '71bba7b5-6882-4099-88b3-4ca9a7468b38'
+        records = [{'pk': chunk['first_pk']} for chunk in chunks if chunk['inserted']]
+        utils.get_content_type.return_value = JSON['type']
+        controller.request.environ = {'pylons.routes_dict': {'action': 'create_entries'}}
+        controller.request.body = json.dumps([{'test': 'a'}] * 4)
+        controller.plugins.toolkit.get_action = MagicMock()
+        controller.plugins.toolkit.get_action.return_value.return_value = {
+            'resource_id': resource_id, 'records': records, 'chunks': chunks}
+
+        self.restController.create_entries(resource_id)
+
+        # The report of the chunks is only returned when some of them have not been inserted
+        assert_equal(expected_field, utils.parse_response.call_args[0][2])
+        assert_equal(expected_status, utils.finish.call_args[0][0])
+        controller.webhooks.notify.assert_called_once_with(resource_id, 'create_entries',
+                                                           [record['pk'] for record in records])
+
+    @parameterized.expand([
+        ('create_entries', None, [{'test': 'a'}], [{'pk': 9}, {'pk': 10}], False, [9, 10]),
+        ('upsert_entry', 3, {'test': 'a'}, [{'pk': 3}], False, [3]),
+        ('upsert_entry', 3, {'test': 'a'}, [{'pk': 3}], True, None),
+        ('delete_entry', 3, None, [], False, [3]),
+        ('delete_resource', None, None, [], False, [])
+    ])
+    def test_webhooks_notified(self, action, entry_id, body, records, unchanged, expected_pks):
+
+        resource_id = '71bba7b5-6882-4099-88b3-4ca9a7468b38'
+        utils.get_content_type.return_value = JSON['type']
+        controller.request.environ = {'pylons.routes_dict': {'action': action}}
+        controller.request.GET.mixed = Mock(return_value={})
+        controller.request.body = json.dumps(body)
+        controller.plugins.toolkit.get_action = MagicMock()
+        controller.plugins.toolkit.get_action.return_value.return_value = {
+            'resource_id': resource_id, 'records': records, 'unchanged': unchanged}
+
+        function = getattr(self.restController, action)
+        if entry_id is None:
+            function(resource_id)
+        else:
+            function(resource_id, str(entry_id))
+
+        # Only the changes are notified, once they have been committed
+        if expected_pks is None:
+            assert_equal(0, controller.webhooks.notify.call_count)
+        else:
+            controller.webhooks.notify.assert_called_once_with(resource_id, action, expected_pks)
+
+    @parameterized.expand([
+        (JSON,),
+        (XML,),
+        (JSON, NOT_AUTHORIZED),
+        (XML, NOT_AUTHORIZED)
+    ])
+    def test_metrics(self, content_type, side_effect=None):
+
+        logic_functions_prop = []
+        logic_functions_prop.append({})     # 0
+        logic_functions_prop[0]['name'] = 'datastore_restful_metrics'
+        logic_functions_prop[0]['side_effect'] = side_effect
+        logic_functions_prop[0]['expected_call'] = {}
+        logic_functions_prop[0]['return_value'] = {'metrics': {'requests.sql.count': 1}}
+
+        self._generic_test(self.restController.metrics, logic_functions_prop, content_type, fields='metrics')
+
+    @parameterized.expand([
+        ('advisor', 'datastore_restful_advisor', {}, JSON),
+        ('advisor', 'datastore_restful_advisor', {'resource_id': 'res'}, XML),
+        ('advisor', 'datastore_restful_advisor', {}, JSON, NOT_AUTHORIZED),
+        ('apply_advisor', 'datastore_restful_advisor_apply', {}, JSON),
+        ('apply_advisor', 'datastore_restful_advisor_apply', {'resource_id': 'res'}, JSON, NOT_AUTHORIZED)
+    ])
+    def test_advisor(self, action, logic_function, get_parameters, content_type, side_effect=None):
+
+        logic_functions_prop = []
+        logic_functions_prop.append({})     # 0
+        logic_functions_prop[0]['name'] = logic_function
+        logic_functions_prop[0]['side_effect'] = side_effect
+        logic_functions_prop[0]['expected_call'] = get_parameters
+        logic_functions_prop[0]['return_value'] = {'recommendations': [{'resource_id': 'res', 'fields': ['a']}]}
+
+        self._generic_test(getattr(self.restController, action), logic_functions_prop, content_type,
+                           get_content=get_parameters, fields='recommendations')
@@ -0,0 +1,651 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN DataStore Restful Extension.
+
+# CKAN DataStore Restful Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN DataStore Restful Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN DataStore Restful Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import ckanext.datastore_restful.db as db
+
+from mock import MagicMock
+from nose_parameterized import parameterized
+from nose.tools import assert_equal, assert_not_equal, assert_true, assert_false, assert_raises
+
+
+class TestPreparedStatements(object):
+    '''Tests for the prepared statements LRU.'''
+
+    def setup(self):
+        self.connection = MagicMock()
+        self.statements = db.PreparedStatements(2)
+
+    def _executed(self):
+        return [args[0][0] for args in self.connection.execute.call_args_list]
+
+    def test_prepare_once_per_template(self):
+        name, prepared = self.statements.prepare(self.connection, 'SELECT * FROM "res" WHERE a = $1')
+        same_name, same_prepared = self.statements.prepare(self.connection, 'select *  from "res"\nwhere a = $1;')
+
+        assert_true(prepared)
+        assert_false(same_prepared)
+        assert_equal(name, same_name)
+        # The SQL sent the first time is the one prepared
+        assert_equal([u'PREPARE %s AS SELECT * FROM "res" WHERE a = $1' % name], self._executed())
+
+    def test_literals_are_escaped(self):
+        name, _ = self.statements.prepare(self.connection, 'SELECT * FROM "res" WHERE a LIKE \'A%\' AND b = $1')
+        assert_equal([u'PREPARE ' + name + u' AS SELECT * FROM "res" WHERE a LIKE \'A%%\' AND b = $1'], self._executed())
+
+    @parameterized.expand([
+        ('SELECT a -- c\nFROM "res" WHERE b = $1', 'SELECT a -- c FROM "res" WHERE b = $1'),
+        ("SELECT a FROM \"res\" WHERE b = E'It\\'S' AND c = $1", "SELECT a FROM \"res\" WHERE b = E'It\\'s' AND c = $1")
+    ])
+    def test_unnormalized_statements(self, sql, other_sql):
+        name, _ = self.statements.prepare(self.connection, sql)
+        other_name, other_prepared = self.statements.prepare(self.connection, other_sql)
+
+        # Statements with comments or escapes are prepared untouched and never shared with different ones
+        assert_true(other_prepared)
+        assert_not_equal(name, other_name)
+        assert_equal(u'PREPARE %s AS %s' % (name, sql), self._executed()[0])
+
+    def test_least_recently_used_is_deallocated(self):
+        first, _ = self.statements.prepare(self.connection, 'SELECT 1')
+        second, _ = self.statements.prepare(self.connection, 'SELECT 2')
+        self.statements.prepare(self.connection, 'SELECT 1')             # 'SELECT 2' is now the LRU
+        self.statements.prepare(self.connection, 'SELECT 3')
+
+        assert_equal(2, len(self.statements))
+        assert_equal(u'DEALLOCATE %s' % second, self._executed()[-1])
+        assert_false(self.statements.prepare(self.connection, 'SELECT 1')[1])
+        assert_true(self.statements.prepare(self.connection, 'SELECT 2')[1])
+
+    def test_discard(self):
+        name, _ = self.statements.prepare(self.connection, 'SELECT $1')
+        self.statements.discard(self.connection, 'SELECT $1')
+
+        assert_equal(0, len(self.statements))
+        assert_equal(u'DEALLOCATE %s' % name, self._executed()[-1])
+
+
+class TestPlans(object):
+    '''Tests for the plan inspection and the admission control.'''
+
+    def setup(self):
+        self._config = db.config
+        db.config = {}
+        db._heavy_slots.clear()
+
+    def teardown(self):
+        db.config = self._config
+
+    def test_plan_relations(self):
+        plan = {
+            'Node Type': 'Nested Loop',
+            'Plans': [
+                {'Node Type': 'Seq Scan', 'Relation Name': 'res'},
+                {'Node Type': 'Hash', 'Plans': [{'Node Type': 'Seq Scan', 'Relation Name': 'pg_class'}]}
+            ]
+        }
+        assert_equal(['res', 'pg_class'], db.plan_relations(plan))
+
+    @parameterized.expand([
+        ({}, 5000, 100000, None),
+        ({db.SQL_MAX_COST: '1000'}, 900, 100000, None),
+        ({db.SQL_MAX_COST: '1000'}, 5000, 10, 400),
+        ({db.SQL_MAX_ROWS: '1000'}, 5000, 100000, 400),
+        ({db.SQL_MAX_COST: '10000', db.SQL_MAX_ROWS: '1000'}, 5000, 10, None)
+    ])
+    def test_admit(self, config, cost, rows, expected_status):
+        db.config.update(config)
+        plan = {'Node Type': 'Seq Scan', 'Total Cost': cost, 'Plan Rows': rows}
+
+        try:
+            db.admit(plan)()
+            assert_equal(None, expected_status)
+        except db.QueryRejected as e:
+            assert_equal(expected_status, e.status)
+            assert_equal({'cost': cost, 'rows': rows}, dict(e.estimate))
+
+    def test_admit_heavy_queries(self):
+        db.config[db.SQL_HEAVY_COST] = '1000'
+        heavy_plan = {'Total Cost': 5000, 'Plan Rows': 10}
+        light_plan = {'Total Cost': 10, 'Plan Rows': 10}
+
+        release = db.admit(heavy_plan)
+
+        # Only one expensive query can be executed at the same time
+        try:
+            db.admit(heavy_plan)
+            assert False, 'The second expensive query should be deferred'
+        except db.QueryRejected as e:
+            assert_equal(503, e.status)
+            assert_equal(db.RETRY_AFTER, e.retry_after)
+
+        db.admit(light_plan)()
+        release()
+        db.admit(heavy_plan)()
+
+
+class TestArrays(object):
+    '''Tests for the array layouts of the search results.'''
+
+    def setup(self):
+        self._get_type = db.datastore_db._get_type
+        db.datastore_db._get_type = MagicMock(side_effect=lambda context, oid: {23: 'int4', 25: 'text', 16: 'bool'}[oid])
+
+        self.results = MagicMock()
+        self.results.cursor.description = [('pk', 23), ('name', 25), ('valid', 16), ('_full_count', 23)]
+        self.results.fetchall.return_value = [(1, u'a', True, 2), (2, u'b', None, 2)]
+
+    def teardown(self):
+        db.datastore_db._get_type = self._get_type
+
+    @parameterized.expand([
+        (db.LAYOUT_ARRAYS, 'records', [[1, u'a', True], [2, u'b', None]]),
+        (db.LAYOUT_COLUMNS, 'columns', [[1, 2], [u'a', u'b'], [True, None]])
+    ])
+    def test_format_arrays(self, layout, expected_key, expected_values):
+        result = db._format_arrays(MagicMock(), self.results, {'resource_id': 'res'}, layout)
+
+        assert_equal(['pk', 'name', 'valid'], [field['id'] for field in result['fields']])
+        assert_equal(2, result['total'])
+        assert_equal(expected_values, result[expected_key])
+
+
+class TestStreamedRecords(object):
+    '''Tests for the records fetched from server-side cursors.'''
+
+    def setup(self):
+        self._get_type = db.datastore_db._get_type
+        db.datastore_db._get_type = MagicMock(return_value='int4')
+
+        self.connection = MagicMock()
+        self.trans = MagicMock()
+        self.results = MagicMock()
+        self.results.cursor.description = [('_id', 23), ('a', 23)]
+
+    def teardown(self):
+        db.datastore_db._get_type = self._get_type
+
+    @parameterized.expand([
+        (0, 5, False),
+        (5, 5, False),
+        (4, 4, True),
+        (3, 3, True)
+    ])
+    def test_batches(self, max_rows, expected_count, expected_truncated):
+        rows = [(i, i * 10) for i in range(5)]
+        self.results.fetchmany.side_effect = lambda size: [rows.pop(0) for _ in range(min(size, len(rows)))]
+
+        records = db.StreamedRecords(self.connection, self.trans, self.results, 2, max_rows)
+        fetched = list(records)
+
+        assert_equal(expected_count, records.count)
+        assert_equal(expected_count, len(fetched))
+        assert_equal(expected_truncated, records.truncated)
+        assert_equal({'_id': 1, 'a': 10}, dict(fetched[1]))
+        assert_equal(['_id', 'a'], [field['id'] for field in records.fields])
+
+        # The transaction and the connection are released once consumed
+        self.trans.rollback.assert_called_once_with()
+        self.connection.close.assert_called_once_with()
+
+
+class TestIndexes(object):
+    '''Tests for the management of the indexes of the resources.'''
+
+    def setup(self):
+        self._get_engine = db.get_engine
+        self._get_field_ids = db._get_field_ids
+        self._list_indexes = db.list_indexes
+
+        self.connection = MagicMock()
+        db.get_engine = MagicMock()
+        db.get_engine.return_value.connect.return_value = self.connection
+        db._get_field_ids = MagicMock(return_value=['_id', 'a', 'b'])
+        db.list_indexes = MagicMock(return_value=[{'name': 'by_a'}])
+
+    def teardown(self):
+        db.get_engine = self._get_engine
+        db._get_field_ids = self._get_field_ids
+        db.list_indexes = self._list_indexes
+
+    def _executed(self):
+        return [args[0] for args in self.connection.execute.call_args_list]
+
+    @parameterized.expand([
+        (['a'], db.INDEX_BTREE, False, u'CREATE INDEX CONCURRENTLY "{0}" ON "res" ("a")', ()),
+        (['a', 'b'], db.INDEX_BTREE, True, u'CREATE UNIQUE INDEX CONCURRENTLY "{0}" ON "res" ("a", "b")', ()),
+        (['a', 'b'], db.INDEX_GIN, False,
+         u'CREATE INDEX CONCURRENTLY "{0}" ON "res" USING gin (to_tsvector(%s::regconfig, '
+         u'coalesce("a"::text, \'\') || \' \' || coalesce("b"::text, \'\')))', ([u'english'],))
+    ])
+    def test_create_index(self, fields, method, unique, expected_statement, expected_params):
+        index_name = db._index_prefix('res') + 'by_a'
+
+        assert_equal({'name': 'by_a'}, db.create_index('res', 'by_a', fields, method, unique))
+
+        # Indexes are replaced and built out of a transaction
+        assert_equal((u'DROP INDEX CONCURRENTLY IF EXISTS "{0}"'.format(index_name),), self._executed()[0])
+        assert_equal((expected_statement.format(index_name),) + expected_params, self._executed()[1])
+        assert_false(self.connection.connection.connection.autocommit)
+        self.connection.close.assert_called_once_with()
+
+    def test_create_index_unknown_field(self):
+        try:
+            db.create_index('res', 'by_c', ['c'])
+            assert False, 'Unknown fields cannot be indexed'
+        except db.plugins.toolkit.ValidationError as e:
+            assert 'fields' in e.error_dict
+
+        assert_equal([], self._executed())
+
+    def test_format_index(self):
+        prefix = db._index_prefix('res')
+        managed = db._format_index(prefix, (prefix + u'by_a', u'btree', False, False, True, [u'a'],
+                                            u'CREATE INDEX ...', 8192, None, None, None))
+        internal = db._format_index(prefix, (u'res_pkey', u'btree', True, True, True, [u'pk'],
+                                             u'CREATE UNIQUE INDEX ...', 16384, 3, 3, 3))
+
+        assert_equal((u'by_a', True, 0), (managed['name'], managed['managed'], managed['scans']))
+        assert_equal((u'res_pkey', False, 3), (internal['name'], internal['managed'], internal['scans']))
+        assert len(prefix + 'x' * 41) <= 63
+
+
+class TestDownsample(object):
+    '''Tests for the downsampling of time series.'''
+
+    def setup(self):
+        self._get_engine = db.get_engine
+        self._get_field_ids = db._get_field_ids
+        self._cache_types = db.datastore_db._cache_types
+        self._get_type = db.datastore_db._get_type
+
+        self.connection = MagicMock()
+        db.get_engine = MagicMock()
+        db.get_engine.return_value.connect.return_value = self.connection
+        db._get_field_ids = MagicMock(return_value=['_id', 'date', 'value'])
+        db.datastore_db._cache_types = MagicMock()
+        db.datastore_db._get_type = MagicMock(side_effect=lambda context, oid: {25: 'text', 701: 'float8'}[oid])
+
+    def teardown(self):
+        db.get_engine = self._get_engine
+        db._get_field_ids = self._get_field_ids
+        db.datastore_db._cache_types = self._cache_types
+        db.datastore_db._get_type = self._get_type
+
+    def test_downsample_series(self):
+        rows = [(u'2014-01-01T00:%02d:00' % i, float(i % 5), float(i * 60)) for i in range(50)]
+        results = self.connection.execution_options.return_value.execute.return_value
+        results.cursor.description = [('date', 25), ('value', 701), ('_x', 701)]
+        results.fetchmany.side_effect = lambda size: [rows.pop(0) for _ in range(min(size, len(rows)))]
+        self.connection.execute.return_value.fetchone.return_value = (50,)
+
+        result = db.downsample({'resource_id': 'res', 'time': 'date', 'value': 'value', 'points': 10})
+
+        assert_equal(10, len(result['records']))
+        assert_equal({'date': u'2014-01-01T00:00:00', 'value': 0.0}, result['records'][0])
+        assert_equal(['date', 'value'], [field['id'] for field in result['fields']])
+        self.connection.close.assert_called_once_with()
+
+
+class TestUnitOfWork(object):
+    '''Tests for the writes that take several steps.'''
+
+    def setup(self):
+        self._get_engine = db.get_engine
+        self._upsert_data = db.datastore_db.upsert_data
+        self._delete_data = db.datastore_db.delete_data
+        self._config = db.config
+        self._reservations_created = db._reservations_created
+
+        self.connection = MagicMock()
+        self.trans = self.connection.begin.return_value
+        db.get_engine = MagicMock()
+        db.get_engine.return_value.connect.return_value = self.connection
+        db.datastore_db.upsert_data = MagicMock()
+        db.datastore_db.delete_data = MagicMock()
+        db.config = {}
+        db._reservations_created = [True]
+
+    def teardown(self):
+        db.get_engine = self._get_engine
+        db.datastore_db.upsert_data = self._upsert_data
+        db.datastore_db.delete_data = self._delete_data
+        db.config = self._config
+        db._reservations_created = self._reservations_created
+
+    def _executed(self):
+        return [args[0] for args in self.connection.execute.call_args_list]
+
+    @parameterized.expand([
+        (0, True),
+        (1, False)
+    ])
+    def test_create_entries(self, reservations, expected_insert):
+        self.connection.execute.return_value.scalar.return_value = 8
+        self.connection.execute.return_value.rowcount = reservations
+
+        records = db.create_entries('res', [{'a': 1}, {'a': 2}], 'pk')
+
+        assert_equal([{'a': 1, 'pk': 9}, {'a': 2, 'pk': 10}], records)
+        db.datastore_db.upsert_data.assert_called_once_with({'connection': self.connection}, {
+            'resource_id': 'res', 'records': records, 'method': 'insert'})
+        # The identifiers are reserved and used in the same transaction, under the lock of the resource
+        executed = self._executed()
+        assert 'pg_advisory_xact_lock' in executed[2][0]
+        assert 'SELECT greatest((SELECT last_pk FROM "_restful_pk_reservations"' in executed[3][0]
+        assert_equal((u'UPDATE "_restful_pk_reservations" SET last_pk = %s WHERE resource_id = %s', 10, 'res'),
+                     executed[4])
+        assert_equal(expected_insert, len(executed) > 5 and executed[5][0].startswith(u'INSERT'))
+        self.trans.commit.assert_called_once_with()
+        assert_false(self.trans.rollback.called)
+        self.connection.close.assert_called_once_with()
+
+    def test_create_reservations_table(self):
+        db._reservations_created = []
+
+        db._create_reservations_table()
+        db._create_reservations_table()
+
+        # The table is created once, under a lock shared by all the resources
+        executed = self._executed()
+        assert_equal(2, len(executed))
+        assert_equal('_restful_pk_reservations', executed[0][2])
+        assert 'CREATE TABLE IF NOT EXISTS "_restful_pk_reservations"' in executed[1][0]
+        self.trans.commit.assert_called_once_with()
+
+    @parameterized.expand([
+        ((1,), ['_restful_pk_reservations', '_restful_tombstones', '_restful_webhooks']),
+        (None, ['_restful_pk_reservations', '_restful_webhooks'])
+    ])
+    def test_delete_resource(self, tombstones_table, expected_tables):
+        # The resource exists, and the shared tables may not exist yet
+        self.connection.execute.return_value.fetchone.side_effect = [(1,), (1,), tombstones_table, (1,)]
+
+        db.delete_resource('res', ['_restful_webhooks'])
+
+        # The table and its rows of the shared tables are deleted in the same transaction, under its lock
+        executed = self._executed()
+        assert 'pg_advisory_xact_lock' in executed[2][0]
+        assert_equal((u'DROP TABLE "res" CASCADE',), executed[3])
+        assert_equal([(u'DELETE FROM "%s" WHERE resource_id = %%s' % table, 'res') for table in expected_tables],
+                     [sql for sql in executed if sql[0].startswith(u'DELETE')])
+        self.trans.commit.assert_called_once_with()
+        self.connection.close.assert_called_once_with()
+
+    @parameterized.expand([
+        ('1', '100', 5000, None),
+        ('4', '100', 100, None),
+        ('4', '100', 101, 100)
+    ])
+    def test_ingestion_chunks(self, threads, chunk_size, records, expected_chunk_size):
+        db.config = {db.INGEST_THREADS: threads, db.INGEST_CHUNK_SIZE: chunk_size}
+        assert_equal(expected_chunk_size, db.ingestion_chunks([{}] * records))
+
+    @parameterized.expand([
+        ([], [(1, 3, True), (4, 6, True), (7, 7, True)]),
+        ([4], [(1, 3, True), (4, 6, False), (7, 7, True)]),
+        ([1, 4, 7], None)
+    ])
+    def test_ingest_entries(self, failed_pks, expected_chunks):
+        db.config = {db.INGEST_THREADS: '3'}
+        self.connection.execute.return_value.scalar.return_value = 0
+
+        def upsert_data(context, data_dict):
+            if data_dict['records'][0]['pk'] in failed_pks:
+                raise db.plugins.toolkit.ValidationError({'constraints': ['duplicate key']})
+        db.datastore_db.upsert_data = MagicMock(side_effect=upsert_data)
+
+        records = [{'a': i} for i in range(7)]
+
+        if expected_chunks is None:
+            # Nothing has been inserted
+            assert_raises(db.plugins.toolkit.ValidationError, db.ingest_entries, 'res', records, 'pk', 3)
+            return
+
+        inserted, chunks = db.ingest_entries('res', records, 'pk', 3)
+
+        # Chunks are numbered in order and inserted in their own transactions
+        assert_equal(expected_chunks, [(chunk['first_pk'], chunk['last_pk'], chunk['inserted']) for chunk in chunks])
+        assert_equal([record['pk'] for record in records if record['pk'] not in range(4, 7) or not failed_pks],
+                     [record['pk'] for record in inserted])
+        assert_equal(3, db.datastore_db.upsert_data.call_count)
+        assert_equal({'constraints': ['duplicate key']} if failed_pks else None, chunks[1].get('error'))
+        assert_equal(4, self.connection.close.call_count)
+
+    @parameterized.expand([
+        ((1,), True),
+        (None, False)
+    ])
+    def test_delete_entry(self, row, expected_result):
+        self.connection.execute.return_value.fetchone.side_effect = [(1,), row]
+
+        assert_equal(expected_result, db.delete_entry('res', 'pk', 3))
+        assert_equal(expected_result, db.datastore_db.delete_data.called)
+        self.trans.commit.assert_called_once_with()
+        self.connection.close.assert_called_once_with()
+
+    @parameterized.expand([
+        # metadata, hash column, stored hash
+        ([(1,), (1,), None], True, False),
+        ([(1,), (1,), ('other',)], True, False),
+        ([(1,), (1,), ('same',)], False, False),
+        ([(1,), None, None], True, True)
+    ])
+    def test_upsert_entry(self, rows, expected_written, expected_column_added):
+        record = {'pk': 3, 'a': 1}
+        rows = [(db._row_hash(record),) if row == ('same',) else row for row in rows]
+        self.connection.execute.return_value.fetchone.side_effect = rows
+
+        assert_equal(expected_written, db.upsert_entry('res', 'pk', record))
+
+        executed = [args[0][0] for args in self.connection.execute.call_args_list]
+        assert_equal(expected_column_added, any('ADD COLUMN "_restful_hash"' in sql for sql in executed))
+        assert_equal(expected_written, db.datastore_db.upsert_data.called)
+        if expected_written:
+            # The hash is only stored by the trigger when it is set in the transaction of the write
+            assert_equal((u'SELECT set_config(%s, %s, true)', 'datastore_restful.row_hash', db._row_hash(record)),
+                         self.connection.execute.call_args_list[-1][0])
+        self.trans.commit.assert_called_once_with()
+
+    def test_rollback(self):
+        db.datastore_db.upsert_data.side_effect = db.plugins.toolkit.ValidationError({'records': ['error']})
+
+        try:
+            db.create_entries('res', [{'a': 1}], 'pk')
+            assert False, 'The error should be raised'
+        except db.plugins.toolkit.ValidationError:
+            pass
+
+        self.trans.rollback.assert_called_once_with()
+        assert_false(self.trans.commit.called)
+        self.connection.close.assert_called_once_with()
+
+    def test_resource_not_found(self):
+        self.connection.execute.return_value.fetchone.return_value = None
+
+        try:
+            db.create_entries('res', [{'a': 1}], 'pk')
+            assert False, 'The resource does not exist'
+        except db.plugins.toolkit.ObjectNotFound:
+            pass
+
+        assert_false(db.datastore_db.upsert_data.called)
+        self.trans.rollback.assert_called_once_with()
+
+
+class TestChanges(object):
+    '''Tests for the change feed of the resources.'''
+
+    def setup(self):
+        self._get_engine = db.get_engine
+        self._get_field_ids = db._get_field_ids
+        self._format_results = db.format_results
+        self._cache_types = db.datastore_db._cache_types
+
+        self.connection = MagicMock()
+        db.get_engine = MagicMock()
+        db.get_engine.return_value.connect.return_value = self.connection
+        db._get_field_ids = MagicMock(return_value=['_id', 'pk', 'a'])
+        db.datastore_db._cache_types = MagicMock()
+        db.format_results = MagicMock(side_effect=lambda connection, results, data_dict: {
+            'fields': [{'id': 'pk'}, {'id': 'a'}, {'id': '_version'}],
+            'records': [{'pk': 1, 'a': 'x', '_version': 5}, {'pk': 2, 'a': 'y', '_version': 8}]
+        })
+
+    def teardown(self):
+        db.get_engine = self._get_engine
+        db._get_field_ids = self._get_field_ids
+        db.format_results = self._format_results
+        db.datastore_db._cache_types = self._cache_types
+
+    def _executed(self):
+        return [args[0][0] for args in self.connection.execute.call_args_list]
+
+    @parameterized.expand([
+        (10, [(1, 5, False), (3, 6, True), (2, 8, False), (4, 9, True)], 9, False),
+        (3, [(1, 5, False), (3, 6, True), (2, 8, False)], 8, True)
+    ])
+    def test_changes(self, limit, expected_changes, expected_next, expected_more):
+        self.connection.execute.return_value.fetchone.return_value = (1,)
+        self.connection.execute.return_value.__iter__.return_value = iter([(3, 6), (4, 9)])
+
+        result = db.changes('res', 'pk', 4, limit)
+
+        assert_equal(expected_changes, [(record['pk'], record['_version'], record['_deleted'])
+                                        for record in result['records']])
+        assert_equal((expected_next, expected_more), (result['next'], result['more']))
+        assert_equal(['pk', 'a'], [field['id'] for field in result['fields']])
+        # Writes in progress are waited for, so no version is skipped
+        assert 'pg_advisory_xact_lock_shared' in self._executed()[1]
+        self.connection.close.assert_called_once_with()
+
+    def test_changes_not_tracked(self):
+        self.connection.execute.return_value.fetchone.return_value = None
+
+        assert_raises(db.plugins.toolkit.ValidationError, db.changes, 'res', 'pk')
+
+        # Versions are never added while reading
+        assert not any(sql.startswith(u'ALTER TABLE') for sql in self._executed())
+        self.connection.close.assert_called_once_with()
+
+    @parameterized.expand([
+        (None, 1),
+        ((1,), 0)
+    ])
+    def test_track_changes(self, version_column, expected_alters):
+        # The resource exists, and then the version column is checked under its write lock
+        self.connection.execute.return_value.fetchone.side_effect = [(1,), version_column]
+
+        db.track_changes('res', 'pk')
+
+        executed = self._executed()
+        assert_equal(expected_alters, len([sql for sql in executed
+                                           if sql.startswith(u'ALTER TABLE "res" ADD COLUMN "_restful_version"')]))
+        assert_equal(2 * expected_alters, len([sql for sql in executed if sql.startswith(u'CREATE TRIGGER')]))
+        self.connection.begin.return_value.commit.assert_called_once_with()
+
+    def test_track_changes_without_identifier(self):
+        self.connection.execute.return_value.fetchone.side_effect = [(1,), None]
+        db._get_field_ids.return_value = ['_id', 'a']
+
+        assert_raises(db.plugins.toolkit.ValidationError, db.track_changes, 'res', 'pk')
+
+        # The DELETE trigger would reference a missing column
+        assert not any(sql.startswith((u'ALTER TABLE', u'CREATE')) for sql in self._executed())
+        assert not self.connection.begin.return_value.commit.called
+
+    def test_write_version(self):
+        self.connection.execute.return_value.fetchone.return_value = (1,)
+        self.connection.execute.return_value.scalar.return_value = 12
+
+        assert_equal(12, db.write_version('res', 'pk'))
+        self.connection.close.assert_called_once_with()
+
+    @parameterized.expand([
+        ('write_version',),
+        ('export_records',),
+        ('export_snapshot',)
+    ])
+    def test_export_not_tracked(self, function):
+        self.connection.execute.return_value.fetchone.return_value = None
+
+        def _export():
+            result = getattr(db, function)('res', 'pk')
+            if function == 'export_snapshot':
+                with result:
+                    pass
+
+        assert_raises(db.plugins.toolkit.ValidationError, _export)
+
+        # Versions are never added while exporting
+        assert not any(sql.startswith(u'ALTER TABLE') for sql in self._executed())
+        self.connection.close.assert_called_once_with()
+
+    def test_export_records(self):
+        snapshot = self.connection.execution_options.return_value
+        snapshot.execute.return_value.scalar.return_value = 12
+        results = snapshot.execution_options.return_value.execute.return_value
+        results.fetchmany.return_value = []
+        self.connection.execute.return_value.fetchone.return_value = (1,)
+
+        version, records = db.export_records('res', 'pk')
+
+        # The version and the rows are read from the same snapshot
+        assert_equal(12, version)
+        self.connection.execution_options.assert_called_once_with(isolation_level='REPEATABLE READ')
+        assert snapshot.execute.call_args[0][0].startswith(
+            u'SELECT greatest((SELECT max("_restful_version") FROM "res")')
+        assert_equal(u'SELECT "pk", "a" FROM "res" ORDER BY "pk"',
+                     snapshot.execution_options.return_value.execute.call_args[0][0])
+        snapshot.execution_options.assert_called_once_with(stream_results=True)
+
+        list(records.batches())
+        snapshot.close.assert_called_once_with()
+
+    @parameterized.expand([
+        (None, None, u'SELECT "pk", "a" FROM "res" ORDER BY "pk"', ()),
+        (10, 20, u'SELECT "pk", "a" FROM "res" WHERE "pk" >= %s AND "pk" < %s ORDER BY "pk"', (10, 20))
+    ])
+    def test_export_range(self, lower, upper, expected_sql, expected_params):
+        engine = MagicMock()
+        snapshot = engine.connect.return_value.execution_options.return_value
+        snapshot.execution_options.return_value.execute.return_value.fetchmany.return_value = []
+
+        records = db.export_range(engine, '00000003-1', 'res', 'pk', ['pk', 'a'], lower, upper)
+
+        # The snapshot exported by another session is read
+        engine.connect.return_value.execution_options.assert_called_once_with(isolation_level='REPEATABLE READ')
+        assert_equal((u'SET TRANSACTION SNAPSHOT %s', '00000003-1'), snapshot.execute.call_args[0])
+        assert_equal((expected_sql,) + expected_params, snapshot.execution_options.return_value.execute.call_args[0])
+
+        list(records.batches())
+        snapshot.close.assert_called_once_with()
+
+    def test_export_snapshot(self):
+        snapshot = self.connection.execution_options.return_value
+        snapshot.execute.return_value.scalar.side_effect = [12, '00000003-1']
+        snapshot.execute.return_value.fetchone.return_value = (1, 500)
+        self.connection.execute.return_value.fetchone.return_value = (1,)
+
+        with db.export_snapshot('res', 'pk') as exported:
+            assert_equal({'version': 12, 'snapshot': '00000003-1', 'field_ids': ['pk', 'a'], 'lower': 1, 'upper': 500},
+                         exported)
+            # The snapshot is kept while the block runs
+            assert_equal(0, snapshot.close.call_count)
+
+        snapshot.close.assert_called_once_with()
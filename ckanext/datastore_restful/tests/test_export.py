@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN DataStore Restful Extension.
+
+# CKAN DataStore Restful Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN DataStore Restful Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN DataStore Restful Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import contextlib
+import gzip
+import os
+import shutil
+import tempfile
+
+import ckanext.datastore_restful.export as export
+import ckanext.datastore_restful.stats as stats
+
+from mock import MagicMock
+from nose_parameterized import parameterized
+from nose.tools import assert_equal, assert_raises
+from webob import Request
+
+RECORDS = [{'pk': 1, 'a': u'x'}, {'pk': 2, 'a': u'ñ'}]
+ROWS = [{'pk': pk, 'a': u'ñ%d' % pk} for pk in range(1, 31)]
+
+
+class FakeRecords(object):
+
+    def __init__(self, batches, fail=False):
+        self.fields = [{'id': 'pk', 'type': 'int4'}, {'id': 'a', 'type': 'text'}]
+        self.truncated = False
+        self.count = 0
+        self.closed = False
+        self._batches = batches
+        self._fail = fail
+
+    def batches(self):
+        for batch in self._batches:
+            self.count += len(batch)
+            yield batch
+        self.truncated = self._fail
+
+    def close(self):
+        self.closed = True
+
+
+def export_range(engine, snapshot, resource_id, identifier, field_ids, lower=None, upper=None):
+    # Runs in the processes of the pool, which inherit it from the tests
+    if lower is not None and lower <= 40 < upper:
+        return FakeRecords([[{'pk': 40, 'a': u'z'}]], fail=True)
+    return FakeRecords([[row for row in ROWS if lower is None or lower <= row['pk'] < upper]])
+
+
+class TestExport(object):
+    '''Tests for the module.'''
+
+    def setup(self):
+        self._config = export.config
+        self._export_records = export.db.export_records
+        self._export_snapshot = export.db.export_snapshot
+        self._export_range = export.db.export_range
+        self._start = export._start
+        self.directory = tempfile.mkdtemp()
+
+        export.config = {export.EXPORT_DIRECTORY: self.directory, export.db.WRITE_URL: 'postgresql://ckan@db/datastore'}
+        export.db.export_records = MagicMock()
+        export.db.export_range = export_range
+        stats.reset_metrics()
+
+    def teardown(self):
+        export.config = self._config
+        export.db.export_records = self._export_records
+        export.db.export_snapshot = self._export_snapshot
+        export.db.export_range = self._export_range
+        export._start = self._start
+        shutil.rmtree(self.directory)
+
+    def _read(self, fmt, version):
+        with gzip.open(export.export_path('res', fmt, version)) as f:
+            return f.read()
+
+    @parameterized.expand([
+        ('csv', 'pk,a\r\n1,x\r\n2,\xc3\xb1\r\n'),
+        ('json', '{"records": [{"pk": 1, "a": "x"}, {"pk": 2, "a": "\\u00f1"}], "truncated": false}')
+    ])
+    def test_generate(self, fmt, expected_content):
+        records = FakeRecords([RECORDS[:1], RECORDS[1:]])
+        export.db.export_records.return_value = (7, records)
+
+        export.generate('res', fmt, 'pk')
+
+        export.db.export_records.assert_called_once_with('res', 'pk')
+        assert_equal(expected_content, self._read(fmt, 7))
+        assert records.closed
+        assert_equal(1, stats.metrics()['exports.generated'])
+
+    def test_generate_failure(self):
+        # Records that could not be read are never published
+        records = FakeRecords([RECORDS], fail=True)
+        export.db.export_records.return_value = (7, records)
+
+        assert_raises(IOError, export.generate, 'res', 'csv', 'pk')
+
+        assert_equal([], export._exports('res', 'csv'))
+        assert_equal([export._prefix('res') + 'csv.lock'], [os.path.join(self.directory, name)
+                                                           for name in os.listdir(self.directory)])
+        assert records.closed
+
+    def test_generate_old_exports(self):
+        for version in [3, 5, 7]:
+            export.db.export_records.return_value = (version, FakeRecords([RECORDS]))
+            export.generate('res', 'csv', 'pk')
+        export.db.export_records.return_value = (3, FakeRecords([RECORDS]))
+        export.generate('res', 'json', 'pk')
+
+        # The previous export is kept while it may still be being downloaded
+        assert_equal([7, 5], export._exports('res', 'csv'))
+        assert_equal([3], export._exports('res', 'json'))
+
+    @parameterized.expand([
+        (1, 10, 2, [(1, 6), (6, 11)]),
+        (1, 10, 3, [(1, 5), (5, 9), (9, 13)]),
+        (5, 6, 4, [(5, 6), (6, 7)]),
+        (7, 7, 4, [(7, 8)]),
+        (None, None, 4, [(None, None)]),
+        (u'a', u'z', 4, [(None, None)])
+    ])
+    def test_ranges(self, lower, upper, parts, expected_ranges):
+        assert_equal(expected_ranges, export._ranges(lower, upper, parts))
+
+    def _snapshot(self, lower, upper):
+        @contextlib.contextmanager
+        def export_snapshot(resource_id, identifier):
+            yield {'version': 7, 'snapshot': '00000003-1', 'field_ids': ['pk', 'a'], 'lower': lower, 'upper': upper}
+        return export_snapshot
+
+    @parameterized.expand([
+        ('csv', 1, 30),
+        ('json', 1, 30),
+        ('csv', 100, 200),
+        ('json', 100, 200),
+        ('json', None, None)
+    ])
+    def test_generate_parallel(self, fmt, lower, upper):
+        records = [row for row in ROWS if lower is None or lower <= row['pk'] <= upper]
+        export.db.export_records.return_value = (6, FakeRecords([records]))
+        export.db.export_snapshot = self._snapshot(lower, upper)
+
+        export.generate('res', fmt, 'pk')
+        export.generate('res', fmt, 'pk', 3)
+
+        # The parts written by the processes are stitched in the same order the rows are exported serially
+        assert_equal(self._read(fmt, 6), self._read(fmt, 7))
+        assert_equal([7, 6], export._exports('res', fmt))
+        assert_equal(['6.%s.gz' % fmt, '7.%s.gz' % fmt, '%s.lock' % fmt],
+                     sorted(name.split('.', 1)[1] for name in os.listdir(self.directory)))
+
+    def test_generate_parallel_failure(self):
+        export.db.export_snapshot = self._snapshot(1, 50)
+
+        assert_raises(IOError, export.generate, 'res', 'csv', 'pk', 2)
+
+        # Neither the export nor its parts are kept
+        assert_equal(['csv.lock'], [name.split('.', 1)[1] for name in os.listdir(self.directory)])
+
+    @parameterized.expand([
+        ([], 4, None, True),
+        ([4], 4, 4, False),
+        ([3], 4, 3, True),
+        ([3, 4], 3, 4, False)
+    ])
+    def test_get_export(self, exports, version, expected_version, expected_stale):
+        export._start = MagicMock()
+        for export_version in exports:
+            open(export.export_path('res', 'json', export_version), 'w').close()
+
+        result = export.get_export('res', 'json', version, 'pk')
+
+        assert_equal({'export_version': expected_version, 'stale': expected_stale}, result)
+        # Missing and stale exports are regenerated in the background
+        assert_equal(expected_stale, export._start.called)
+        if expected_stale:
+            export._start.assert_called_once_with('res', 'json', 'pk')
+
+    def test_generate_locked(self):
+        with open(export._prefix('res') + 'csv.lock', 'a') as lock:
+            export.fcntl.flock(lock, export.fcntl.LOCK_EX)
+            # The lock is not shared with the descriptors opened by other calls
+            assert_equal(False, export.generate('res', 'csv', 'pk'))
+
+        assert_equal(0, export.db.export_records.call_count)
+
+    def test_start(self):
+        # Processes are never forked from the server
+        export.config[export.EXPORT_PROCESSES] = '3'
+        export.db.export_records.return_value = (9, FakeRecords([RECORDS]))
+
+        export._start('res', 'csv', 'pk')
+        export._generators[('res', 'csv')].join(5)
+
+        assert_equal([9], export._exports('res', 'csv'))
+
+
+class TestExportApp(object):
+    '''Tests for the application that serves the exports.'''
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'export.csv.gz')
+        # Bigger than the files that are kept in memory by paste
+        self.content = ''.join(chr(i % 256) for i in range(100000))
+        with open(self.path, 'wb') as f:
+            f.write(self.content)
+        self.app = export.ExportApp(self.path, '"7-csv"', content_type='text/csv;charset=utf-8')
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def _get(self, headers, file_wrapper=None):
+        request = Request.blank('/export', headers=headers)
+        if file_wrapper is not None:
+            request.environ['wsgi.file_wrapper'] = file_wrapper
+        return request.get_response(self.app)
+
+    @parameterized.expand([
+        ({}, 200, 0, 100000),
+        ({'Range': 'bytes=100-199'}, 206, 100, 200),
+        ({'Range': 'bytes=99000-'}, 206, 99000, 100000),
+        ({'Range': 'bytes=100-199', 'If-Range': '"7-csv"'}, 206, 100, 200),
+        ({'Range': 'bytes=100-199', 'If-Range': '"6-csv"'}, 200, 0, 100000)
+    ])
+    def test_range(self, headers, expected_status, lower, upper):
+        response = self._get(headers)
+
+        assert_equal(expected_status, response.status_int)
+        assert_equal(self.content[lower:upper], response.body)
+        assert_equal('"7-csv"', response.headers['ETag'])
+        assert_equal('text/csv;charset=utf-8', response.headers['Content-Type'])
+        assert_equal('gzip', response.headers['Content-Encoding'])
+
+    def test_not_modified(self):
+        assert_equal(304, self._get({'If-None-Match': '"7-csv"'}).status_int)
+
+    @parameterized.expand([
+        ({}, True),
+        ({'Range': 'bytes=99000-'}, True),
+        ({'Range': 'bytes=100-199'}, False)
+    ])
+    def test_file_wrapper(self, headers, expected_wrapped):
+        file_wrapper = MagicMock(side_effect=lambda f, block_size: iter([f.read()]))
+
+        response = self._get(headers, file_wrapper)
+
+        # File wrappers send the file until its end, so they are not used for closed ranges
+        assert_equal(expected_wrapped, file_wrapper.called)
+        assert_equal(int(response.headers['Content-Length']), len(response.body))
@@ -17,8 +17,11 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with CKAN DataStore Restful Extension.  If not, see <http://www.gnu.org/licenses/>.
 
+import json
 import ckanext.datastore_restful.response_parser as response_parser
 
+from collections import OrderedDict
+from nose.plugins.skip import SkipTest
 from nose_parameterized import parameterized
 from nose.tools import assert_equal
 
@@ -113,6 +116,26 @@ JKL,GHI,1987-07-22T00:00:00,1991-07-13T00:00:00\r
 PQR,MNO,1991-07-13T00:00:00,\r\n'''
 
 
+class StreamedRecords(object):
+    '''Records fetched in batches, as returned by the streaming actions.'''
+
+    def __init__(self, batches, truncated=False):
+        self.fields = CONTENT_TO_CONVERT_IN_CSV['fields']
+        self.count = 0
+        self.truncated = False
+        self._batches = batches
+        self._truncated = truncated
+
+    def batches(self):
+        for batch in self._batches:
+            self.count += len(batch)
+            yield batch
+        self.truncated = self._truncated
+
+
+STREAMED_BATCHES = [CONTENT_TO_CONVERT_IN_CSV['records'][:2], CONTENT_TO_CONVERT_IN_CSV['records'][2:]]
+
+
 class TestParsers(object):
     '''Tests for the module.'''
 
@@ -139,3 +162,106 @@ class TestParsers(object):
         except Exception as e:
             print e
             assert exception is True
+
+    @parameterized.expand([
+        (False,),
+        (True,)
+    ])
+    def test_json_stream_parser(self, truncated):
+        records = StreamedRecords(STREAMED_BATCHES, truncated)
+        result = json.loads(''.join(response_parser.json_stream_parser(records, json.dumps)), object_pairs_hook=OrderedDict)
+
+        assert_equal(truncated, result['truncated'])
+        assert_equal(3, len(result['records']))
+        assert_equal(['nombre', 'apellido1', 'fecha_nombramiento', 'fecha_cese'], result['records'][0].keys())
+        assert_equal('PQR', result['records'][2]['nombre'])
+
+    @parameterized.expand([
+        (False,),
+        (True,)
+    ])
+    def test_xml_stream_parser(self, truncated):
+        records = StreamedRecords([[{'nombre': 'A&B', 'apellido1': 'C', 'fecha_nombramiento': None,
+                                     'fecha_cese': 1, '_id': 1}]], truncated)
+        result = ''.join(response_parser.xml_stream_parser(records, 'records'))
+
+        expected = '<?xml version="1.0" encoding="utf-8"?>\n<records><record><nombre>A&amp;B</nombre>' + \
+                   '<apellido1>C</apellido1><fecha_nombramiento/><fecha_cese>1</fecha_cese></record>'
+        expected += '<truncated>1</truncated>' if truncated else ''
+        expected += '</records>\n'
+        assert_equal(expected, result)
+
+    @parameterized.expand([
+        (False,),
+        (True,)
+    ])
+    def test_csv_stream_parser(self, truncated):
+        records = StreamedRecords(STREAMED_BATCHES, truncated)
+        result = ''.join(response_parser.csv_stream_parser(records))
+
+        expected = EXPECTED_CSV + ('# truncated at 3 rows\n' if truncated else '')
+        assert_equal(expected, result)
+
+    def _read_arrow(self, chunks):
+        if not response_parser.arrow_available():
+            raise SkipTest('pyarrow is not installed')
+
+        import pyarrow
+        return pyarrow.ipc.open_stream(b''.join(chunks)).read_all()
+
+    def test_arrow_parser(self):
+        table = self._read_arrow(response_parser.arrow_parser(CONTENT_TO_CONVERT_IN_CSV))
+
+        assert_equal(['nombre', 'apellido1', 'fecha_nombramiento', 'fecha_cese'], table.schema.names)
+        assert_equal('timestamp[us]', str(table.schema.field_by_name('fecha_nombramiento').type))
+        assert_equal(3, table.num_rows)
+        assert_equal(['DEF', 'JKL', 'PQR'], table.column(0).to_pylist())
+
+    @parameterized.expand([
+        ({'columns': [[1, 2], ['30', None], [['a'], []]]},),
+        ({'records': [[1, '30', ['a']], [2, None, []]]},)
+    ])
+    def test_arrow_parser_arrays(self, values):
+        result = {'fields': [{'id': '_id', 'type': 'int4'}, {'id': 'big', 'type': 'int8'},
+                             {'id': 'tags', 'type': '_text'}]}
+        result.update(values)
+        table = self._read_arrow(response_parser.arrow_parser(result))
+
+        assert_equal(['_id', 'big', 'tags'], table.schema.names)
+        assert_equal([30, None], table.column(1).to_pylist())
+        assert_equal([['a'], []], table.column(2).to_pylist())
+
+    def test_arrow_stream_parser(self):
+        chunks = list(response_parser.arrow_stream_parser(StreamedRecords(STREAMED_BATCHES)))
+        table = self._read_arrow(chunks)
+
+        # Each batch is written as soon as it is fetched
+        assert_equal(len(STREAMED_BATCHES) + 1, len(chunks))
+        assert_equal(3, table.num_rows)
+
+    def test_arrow_parser_no_records(self):
+        result = {'fields': [{'id': 'a', 'type': 'int4'}], 'records': []}
+        table = self._read_arrow(response_parser.arrow_parser(result))
+
+        assert_equal(['a'], table.schema.names)
+        assert_equal(0, table.num_rows)
+
+    def test_msgpack_parser(self):
+        if not response_parser.msgpack_available():
+            raise SkipTest('msgpack is not installed')
+
+        content = response_parser.msgpack_parser(CONTENT_TO_CONVERT_IN_CSV)
+        assert_equal(CONTENT_TO_CONVERT_IN_CSV, response_parser.msgpack_loads(content))
+
+    def test_msgpack_parser_text(self):
+        if not response_parser.msgpack_available():
+            raise SkipTest('msgpack is not installed')
+
+        content = response_parser.msgpack_parser({'records': [{'name': 'Ana', u'city': u'M\xe1laga', 'age': 3}]})
+        result = response_parser.msgpack_loads(content)
+
+        # Byte strings are packed as text, so they are not decoded as binaries
+        record = result[u'records'][0]
+        assert all(isinstance(key, unicode) for key in result.keys() + record.keys())
+        assert_equal({u'name': u'Ana', u'city': u'M\xe1laga', u'age': 3}, record)
+        assert isinstance(record[u'name'], unicode)
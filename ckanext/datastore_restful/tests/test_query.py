@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN DataStore Restful Extension.
+
+# CKAN DataStore Restful Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN DataStore Restful Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN DataStore Restful Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import ckanext.datastore_restful.query as query
+
+from nose_parameterized import parameterized
+from nose.tools import assert_equal, assert_raises
+
+FIELD_IDS = ['_id', 'pk', 'name', 'age']
+
+
+class TestQuery(object):
+    '''Tests for the module.'''
+
+    @parameterized.expand([
+        ('res', 'res'),
+        ('a"b', 'a""b'),
+        ('a%b', 'a%%b')
+    ])
+    def test_quote(self, identifier, expected_identifier):
+        assert_equal('"%s"' % expected_identifier, query.quote(identifier))
+
+    @parameterized.expand([
+        ({}, FIELD_IDS),
+        ({'fields': 'name, age'}, ['name', 'age']),
+        ({'fields': ['pk']}, ['pk'])
+    ])
+    def test_select(self, data_dict, expected_fields):
+        assert_equal(expected_fields, query.select(FIELD_IDS, data_dict))
+
+    @parameterized.expand([
+        ({}, '', []),
+        ({'filters': {'name': 'a', 'age': 3}}, 'WHERE "age" = %s AND "name" = %s', [3, 'a']),
+        ({'filters': {'name': 'a'}, 'q': 'text'}, 'WHERE "name" = %s AND _full_text @@ query', ['a']),
+        ({'filters': {'age': {'lt': '65', 'gte': '18'}}}, 'WHERE "age" >= %s AND "age" < %s', ['18', '65']),
+        ({'filters': {'age': {'between': '18,65'}, 'name': {'ne': 'a'}}},
+         'WHERE "age" BETWEEN %s AND %s AND "name" <> %s', ['18', '65', 'a']),
+        ({'filters': {'name': {'in': 'a,b,c'}}}, 'WHERE "name" IN (%s, %s, %s)', ['a', 'b', 'c']),
+        ({'filters': {'name': {'in': ['a', 'b']}, 'age': {'eq': 3}}}, 'WHERE "age" = %s AND "name" IN (%s, %s)',
+         [3, 'a', 'b']),
+        ({'filters': {'name': {'null': 'true'}, 'age': {'null': 'false'}}},
+         'WHERE "age" IS NOT NULL AND "name" IS NULL', [])
+    ])
+    def test_where(self, data_dict, expected_clause, expected_values):
+        assert_equal((expected_clause, expected_values), query.where(FIELD_IDS, data_dict))
+
+    @parameterized.expand([
+        ({'fields': 'unknown'}, 'fields'),
+        ({'filters': {'unknown': 'a'}}, 'filters'),
+        ({'filters': 'a'}, 'filters'),
+        ({'filters': {'age': {'like': 'a'}}}, 'filters'),
+        ({'filters': {'age': {'between': '1,2,3'}}}, 'filters'),
+        ({'filters': {'age': {'in': {}}}}, 'filters'),
+        ({'filters': {'age': {'null': 'maybe'}}}, 'filters'),
+        ({'sort': 'unknown desc'}, 'sort')
+    ])
+    def test_invalid_fields(self, data_dict, expected_parameter):
+        with assert_raises(query.plugins.toolkit.ValidationError) as cm:
+            query.search('res', FIELD_IDS, data_dict)
+        assert expected_parameter in cm.exception.error_dict
+
+    def test_search(self):
+        data_dict = {'filters': {'name': 'a'}, 'q': 'text', 'language': 'spanish', 'sort': 'age desc',
+                     'fields': 'pk, name', 'limit': 10, 'offset': 20}
+        sql, values = query.search('res', FIELD_IDS, data_dict, total=True)
+
+        assert_equal('SELECT "pk", "name", ts_rank(_full_text, query, 32) AS rank, count(*) over() AS "_full_count" '
+                     'FROM "res", plainto_tsquery(%s, %s) query WHERE "name" = %s AND _full_text @@ query '
+                     'order by "age" desc LIMIT %s OFFSET %s', sql)
+        assert_equal(['spanish', 'text', 'a', 10, 20], values)
+
+    def test_count(self):
+        sql, values = query.count('res', FIELD_IDS, {'filters': {'age': 3}})
+
+        assert_equal('SELECT count(*) FROM "res" WHERE "age" = %s', sql)
+        assert_equal([3], values)
+
+    @parameterized.expand([
+        ({'group_by': 'name', 'sum': 'age', 'count': '*'},
+         'SELECT "name" AS "name", count(*) AS "count", sum("age") AS "sum_age" FROM "res"  '
+         'GROUP BY "name" ORDER BY "name" LIMIT %s OFFSET %s', [100, 0]),
+        ({'avg': ['age'], 'min': 'age', 'max': 'age', 'filters': {'age': {'gt': 18}}, 'limit': 1},
+         'SELECT avg("age") AS "avg_age", min("age") AS "min_age", max("age") AS "max_age" FROM "res" '
+         'WHERE "age" > %s   LIMIT %s OFFSET %s', [18, 1, 0]),
+        ({'group_by': 'name, pk', 'count': 'age', 'sort': 'count_age desc'},
+         'SELECT "name" AS "name", "pk" AS "pk", count("age") AS "count_age" FROM "res"  '
+         'GROUP BY "name", "pk" order by "count_age" desc LIMIT %s OFFSET %s', [100, 0])
+    ])
+    def test_aggregate(self, data_dict, expected_sql, expected_values):
+        assert_equal((expected_sql, expected_values), query.aggregate('res', FIELD_IDS, data_dict))
+
+    @parameterized.expand([
+        ({}, 'group_by'),
+        ({'group_by': 'unknown'}, 'group_by'),
+        ({'sum': 'unknown'}, 'sum'),
+        ({'sum': '*'}, 'sum'),
+        ({'group_by': 'name', 'sort': 'age'}, 'sort')     # Only the returned columns can be sorted
+    ])
+    def test_aggregate_invalid(self, data_dict, expected_parameter):
+        with assert_raises(query.plugins.toolkit.ValidationError) as cm:
+            query.aggregate('res', FIELD_IDS, data_dict)
+        assert expected_parameter in cm.exception.error_dict
+
+    @parameterized.expand([
+        ({'time': 'date', 'interval': 'hour', 'avg': 'age'},
+         'SELECT "_bucket" AS "date", avg("age") AS "avg_age", extract(epoch from "_bucket")::float8 AS "_x" '
+         'FROM (SELECT date_trunc(%s, "date") AS "_bucket", * FROM "res" ) AS records '
+         'WHERE "_bucket" IS NOT NULL GROUP BY "_bucket" ORDER BY "_bucket" LIMIT %s OFFSET %s',
+         ['hour', 1000, 0]),
+        ({'time': 'date', 'interval': '15 minutes', 'filters': {'name': 'a'}, 'limit': 10},
+         'SELECT "_bucket" AS "date", count(*) AS "count", extract(epoch from "_bucket")::float8 AS "_x" '
+         'FROM (SELECT timestamp \'epoch\' + floor(extract(epoch from "date") / extract(epoch from %s::interval)) * '
+         'extract(epoch from %s::interval) * interval \'1 second\' AS "_bucket", * FROM "res" WHERE "name" = %s) '
+         'AS records WHERE "_bucket" IS NOT NULL GROUP BY "_bucket" ORDER BY "_bucket" LIMIT %s OFFSET %s',
+         ['15 minutes', '15 minutes', 'a', 10, 0])
+    ])
+    def test_buckets(self, data_dict, expected_sql, expected_values):
+        assert_equal((expected_sql, expected_values), query.buckets('res', FIELD_IDS + ['date'], data_dict))
+
+    def test_series(self):
+        sql, count_sql, values = query.series('res', FIELD_IDS + ['date'],
+                                              {'time': 'date', 'value': 'age', 'filters': {'name': 'a'}})
+
+        assert_equal('SELECT "date", "age", extract(epoch from "date")::float8 AS "_x" FROM "res" '
+                     'WHERE "name" = %s AND "date" IS NOT NULL AND "age" IS NOT NULL ORDER BY "date"', sql)
+        assert_equal('SELECT count(*) FROM "res" WHERE "name" = %s AND "date" IS NOT NULL AND "age" IS NOT NULL',
+                     count_sql)
+        assert_equal(['a'], values)
+
+    @parameterized.expand([
+        ({'interval': 'hour'}, 'time'),
+        ({'time': 'unknown', 'interval': 'hour'}, 'time'),
+        ({'time': 'date', 'interval': 'hour', 'sum': 'unknown'}, 'sum')
+    ])
+    def test_buckets_invalid(self, data_dict, expected_parameter):
+        with assert_raises(query.plugins.toolkit.ValidationError) as cm:
+            query.buckets('res', FIELD_IDS + ['date'], data_dict)
+        assert expected_parameter in cm.exception.error_dict
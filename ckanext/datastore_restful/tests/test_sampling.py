@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN DataStore Restful Extension.
+
+# CKAN DataStore Restful Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN DataStore Restful Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN DataStore Restful Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import ckanext.datastore_restful.sampling as sampling
+
+from nose_parameterized import parameterized
+from nose.tools import assert_equal
+
+
+def _x(point):
+    return point[0]
+
+
+def _y(point):
+    return point[1]
+
+
+class TestSampling(object):
+    '''Tests for the module.'''
+
+    @parameterized.expand([
+        (10, 10),
+        (10, 20),
+        (10, 2)
+    ])
+    def test_lttb_not_reduced(self, length, threshold):
+        points = [(i, i * i) for i in range(length)]
+        assert_equal(points, list(sampling.lttb(points, length, threshold, _x, _y)))
+
+    def test_lttb_keeps_peaks(self):
+        points = [(i, 0) for i in range(100)]
+        points[25] = (25, 10)
+        points[70] = (70, -10)
+
+        reduced = list(sampling.lttb(iter(points), len(points), 10, _x, _y))
+
+        assert_equal(10, len(reduced))
+        assert_equal(points[0], reduced[0])
+        assert_equal(points[-1], reduced[-1])
+        assert (25, 10) in reduced
+        assert (70, -10) in reduced
+        assert_equal(sorted(reduced), reduced)
+
+    @parameterized.expand([
+        (100, 10),      # The series is shorter than expected
+        (1000, 10)      # and longer
+    ])
+    def test_lttb_unexpected_length(self, actual_length, threshold):
+        points = [(i, i % 7) for i in range(actual_length)]
+        reduced = list(sampling.lttb(points, 200, threshold, _x, _y))
+
+        assert_equal(points[0], reduced[0])
+        assert_equal(points[-1], reduced[-1])
+        assert len(reduced) <= threshold
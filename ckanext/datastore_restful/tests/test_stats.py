@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN DataStore Restful Extension.
+
+# CKAN DataStore Restful Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN DataStore Restful Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN DataStore Restful Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import ckanext.datastore_restful.stats as stats
+
+from mock import MagicMock
+from nose_parameterized import parameterized
+from nose.tools import assert_equal, assert_not_equal
+
+
+class TestStats(object):
+    '''Tests for the module.'''
+
+    def setup(self):
+        self._config = stats.config
+        self._slow_log = stats.slow_log
+
+        stats.config = {}
+        stats.slow_log = MagicMock()
+
+    def teardown(self):
+        stats.config = self._config
+        stats.slow_log = self._slow_log
+
+    @parameterized.expand([
+        ('SELECT * FROM "abc-123" WHERE a = 5', 'select * from "abc-123" where a = ?'),
+        ('select *   from "abc-123"\nwhere a=\'x\';', 'select * from "abc-123" where a=?'),
+        ('SELECT t1.a FROM "Res" t1 WHERE b IN (1, 2, 3)', 'select t1.a from "Res" t1 where b in (?)'),
+        ('SELECT a FROM "res" WHERE b = \'it\'\'s\' AND c > 3.5', 'select a from "res" where b = ? and c > ?')
+    ])
+    def test_normalize_sql(self, sql, expected_shape):
+        assert_equal(expected_shape, stats.normalize_sql(sql))
+
+    def test_sql_fingerprint(self):
+        fingerprint = stats.sql_fingerprint('SELECT * FROM "res" WHERE a = 5')
+        assert_equal(fingerprint, stats.sql_fingerprint('select * from "res" where a = 27'))
+        assert_not_equal(fingerprint, stats.sql_fingerprint('select * from "res" where b = 27'))
+
+    @parameterized.expand([
+        ({'resource_id': 'res', 'filters': {}},
+         {'filters': [], 'offset': False, 'q': False}),
+        ({'resource_id': 'res', 'filters': {'b': '1', 'a': '2'}, 'sort': 'a DESC,b', 'limit': 10, 'offset': 20},
+         {'filters': ['a', 'b'], 'sort': 'a desc, b asc', 'limit': 10, 'offset': True, 'q': False}),
+        ({'resource_id': 'res', 'q': 'text'},
+         {'filters': [], 'offset': False, 'q': True})
+    ])
+    def test_query_shape(self, request_data, expected_shape):
+        assert_equal(expected_shape, dict(stats.query_shape(request_data)))
+
+    @parameterized.expand([
+        ({'resource_id': 'res', 'filters': {'a': 1}}, True, False),
+        ({'sql': 'SELECT 1'}, False, True),
+        ({'resource_id': 'res', 'records': [{'a': 1}]}, False, False)
+    ])
+    def test_describe(self, request_data, expected_shape, expected_fingerprint):
+        request_stats = stats.RequestStats('search_entries', 'datastore_search')
+        request_stats.describe(request_data)
+
+        assert_equal(request_data.get('resource_id'), request_stats.resource_id)
+        assert_equal(expected_shape, request_stats.shape is not None)
+        assert_equal(expected_fingerprint, request_stats.fingerprint is not None)
+
+    @parameterized.expand([
+        ('-1', False),
+        ('0', True),
+        ('100000', False)
+    ])
+    def test_finish(self, threshold, expected_log):
+        stats.config[stats.SLOW_REQUEST_THRESHOLD] = threshold
+
+        request_stats = stats.RequestStats('search_entries', 'datastore_search')
+        request_stats.describe({'resource_id': 'res', 'filters': {'a': 1}})
+        request_stats.phase('parameters')
+        request_stats.count_rows({'records': [{'a': 1}, {'a': 2}]})
+        request_stats.count_bytes('EXAMPLE CONTENT')
+        request_stats.finish()
+
+        assert_equal(expected_log, stats.slow_log.warning.called)
+
+        if expected_log:
+            entry = json.loads(stats.slow_log.warning.call_args[0][0])
+            assert_equal('search_entries', entry['action'])
+            assert_equal('res', entry['resource_id'])
+            assert_equal(['a'], entry['shape']['filters'])
+            assert_equal(2, entry['rows'])
+            assert_equal(len('EXAMPLE CONTENT'), entry['bytes'])
+            assert 'parameters' in entry['phases']
+
+    def test_round_trips(self):
+        stats.reset_metrics()
+
+        request_stats = stats.RequestStats('get_entry', 'datastore_search')
+        stats.count_action()
+        stats._count_statement(None, None, 'SELECT 1', None, None, False)
+        stats._count_statement(None, None, 'SELECT 2', None, None, False)
+        request_stats.finish()
+
+        # Once finished, the request does not count anymore
+        stats.count_action()
+
+        assert_equal(1, request_stats.actions)
+        assert_equal(2, request_stats.statements)
+        assert_equal({stats.ACTIONS_HEADER: 1, stats.STATEMENTS_HEADER: 2}, dict(request_stats.headers()))
+
+        metrics = stats.metrics()
+        assert_equal(1, metrics['requests.get_entry.count'])
+        assert_equal(1, metrics['requests.get_entry.actions'])
+        assert_equal(2, metrics['requests.get_entry.statements'])
+
+    def test_record_shape(self):
+        stats.pop_workload()
+
+        request_stats = stats.RequestStats('search_entries', 'datastore_search')
+        request_stats.describe({'resource_id': 'res', 'filters': {'b': '1', 'a': '2'}, 'sort': 'c desc'})
+        request_stats.finish()
+        stats.record_shape('res', {'filters': ['a', 'b'], 'sort': 'c asc'}, 10.0)
+
+        # SQL queries have no shape
+        request_stats = stats.RequestStats('sql', 'datastore_search_sql')
+        request_stats.describe({'sql': 'SELECT 1'})
+        request_stats.finish()
+
+        # Only the shapes of the searches are recorded
+        for action in ['get_entry', 'aggregate', 'structure']:
+            request_stats = stats.RequestStats(action, 'datastore_search')
+            request_stats.describe({'resource_id': 'res', 'filters': {'pk': 1}})
+            request_stats.finish()
+
+        workload = stats.pop_workload()
+        assert_equal([('res', ('a', 'b'), ('c',))], workload.keys())
+        assert_equal(2, workload[('res', ('a', 'b'), ('c',))][0])
+        assert_equal({}, stats.pop_workload())
+
+    def test_record_shape_limit(self):
+        stats.pop_workload()
+        stats.reset_metrics()
+
+        for i in range(stats.MAX_SHAPES + 1):
+            stats.record_shape('res', {'filters': ['field%d' % i]}, 1.0)
+        stats.record_shape('res', {'filters': ['field0']}, 1.0)
+
+        workload = stats.pop_workload()
+        assert_equal(stats.MAX_SHAPES, len(workload))
+        assert_equal((2, 2.0), workload[('res', ('field0',), ())])
+        assert_equal(1, stats.metrics()['workload.dropped'])
@@ -21,6 +21,7 @@ import copy
 import ckanext.datastore_restful.utils as utils
 
 from mock import ANY, MagicMock
+from nose.plugins.skip import SkipTest
 from nose_parameterized import parameterized
 from nose.tools import assert_equal
 
@@ -40,11 +41,16 @@ ALL_XML07 = '*/*,application/xml;q=0.7'
 XML07_ALL06 = 'application/xml;q=0.7,*/*;q=0.6'
 ALL06_XML07 = '*/*;q=0.6,application/xml;q=0.7'
 JSON08_XML07_CSV_ACCEPTED = 'application/json;q=0.8,application/xml;q=0.7,text/csv'
+ARROW = 'application/vnd.apache.arrow.stream'
+JSON08_ARROW = 'application/json;q=0.8,application/vnd.apache.arrow.stream'
+MSGPACK = 'application/msgpack'
 
 CONTENT_TYPES = {
     utils.JSON: 'application/json',
     utils.XML: 'application/xml',
     utils.CSV: 'text/csv',
+    utils.ARROW: 'application/vnd.apache.arrow.stream',
+    utils.MSGPACK: 'application/msgpack',
     utils.TEXT: 'text/plain'
 }
 
@@ -152,6 +158,14 @@ class TestUtils(object):
         ([utils.CSV, utils.XML], JSON08_XML07_CSV_ACCEPTED, utils.CSV),
         ([utils.JSON, utils.CSV], JSON08_XML07_CSV_ACCEPTED, utils.CSV),
         ([utils.JSON, utils.XML, utils.CSV], JSON08_XML07_CSV_ACCEPTED, utils.CSV),
+        # Arrow
+        ([utils.JSON, utils.ARROW], ARROW, utils.ARROW),
+        ([utils.JSON, utils.ARROW], JSON08_ARROW, utils.ARROW),
+        ([utils.JSON, utils.ARROW], ALL, utils.JSON),
+        ([utils.JSON], ARROW, None, True),
+        # MessagePack
+        ([utils.JSON, utils.XML, utils.MSGPACK], MSGPACK, utils.MSGPACK),
+        ([utils.JSON, utils.XML], MSGPACK, None, True),
         # accepted_content_types is empty
         ([], JSON, None, True),
     ])
@@ -172,6 +186,25 @@ class TestUtils(object):
             assert_equal(expected_msg, error['message'])
             assert_equal({'Accept': content_type}, error['data'])
 
+    @parameterized.expand([
+        ('pyarrow', utils.ARROW, ARROW),
+        ('msgpack', utils.MSGPACK, MSGPACK)
+    ])
+    def test_get_content_type_not_installed(self, library, content_type, accept):
+
+        utils.request.headers = {'ACCEPT': accept}
+        module = getattr(utils.response_parser, library)
+        setattr(utils.response_parser, library, None)
+
+        try:
+            utils.get_content_type([utils.JSON, content_type])
+            assert False, 'The format should not be accepted when %s is not installed' % library
+        except utils.plugins.toolkit.ValidationError as e:
+            assert_equal('Only application/json can be placed in the \'Accept\' header for this request',
+                         e.error_dict['message'])
+        finally:
+            setattr(utils.response_parser, library, module)
+
     @parameterized.expand([
         # JSON
         (utils.JSON, 'records', None, EXAMPLE_CONTENT['records']),
@@ -252,6 +285,28 @@ class TestUtils(object):
 
         utils.helpers.json.loads.assert_called_once_with(content, encoding=ANY)
 
+    @parameterized.expand([
+        ('\x81\xa4test\x01', {'test': 1}),
+        ('\xc1', None, True)
+    ])
+    def test_parse_body_msgpack(self, content, expected_body, throw_exception=False):
+
+        if not utils.response_parser.msgpack_available():
+            raise SkipTest('msgpack is not installed')
+
+        utils.request.body = content
+        utils.request.content_type = 'application/msgpack'
+
+        try:
+            assert_equal(expected_body, utils.parse_body())
+            assert throw_exception is False
+        except ValueError as e:
+            assert throw_exception is True
+            assert str(e).startswith('MessagePack Error: Error decoding MessagePack data. Error:')
+
+        # MessagePack bodies are not parsed as JSON
+        assert_equal(0, utils.helpers.json.loads.call_count)
+
     @parameterized.expand([
         (200, 'EXAMPLE TEST'),
         (200, 'EXAMPLE TEST', utils.JSON),
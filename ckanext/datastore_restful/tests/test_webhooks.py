@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN DataStore Restful Extension.
+
+# CKAN DataStore Restful Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN DataStore Restful Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN DataStore Restful Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import socket
+
+import ckanext.datastore_restful.stats as stats
+import ckanext.datastore_restful.webhooks as webhooks
+
+from mock import MagicMock
+from nose_parameterized import parameterized
+from nose.tools import assert_equal, assert_raises
+from webhook_server import WebhookServer
+
+
+class TestWebhooks(object):
+    '''Tests for the module.'''
+
+    def setup(self):
+        self._config = webhooks.config
+        self._subscriptions = webhooks._subscriptions
+        self._resolve = webhooks._resolve
+        self._server = WebhookServer()
+        self._server.start()
+
+        # The test server listens on the loopback interface
+        webhooks.config = {webhooks.WEBHOOK_ALLOWED_HOSTS: '127.0.0.1'}
+        webhooks._subscriptions = MagicMock(return_value={'res': [('sync', self._server.url('/events'))]})
+        stats.reset_metrics()
+
+    def teardown(self):
+        webhooks.config = self._config
+        webhooks._subscriptions = self._subscriptions
+        webhooks._resolve = self._resolve
+        self._server.stop()
+
+    def _dispatcher(self, window=0.05, retries=3):
+        return webhooks.Dispatcher(window, 2, retries, 0.01, 1.0)
+
+    def test_batch(self):
+        dispatcher = self._dispatcher()
+        dispatcher.notify('res', {'action': 'create_entries', 'pks': [1, 2]})
+        dispatcher.notify('res', {'action': 'upsert_entry', 'pks': [1]})
+        dispatcher.notify('other', {'action': 'delete_entry', 'pks': [5]})
+
+        # The events gathered during the window are sent together, to the resources with webhooks
+        requests = self._server.wait(1)
+        assert_equal(1, len(requests))
+        path, payload, status = requests[0]
+        assert_equal('/events', path)
+        assert_equal({'resource_id': 'res', 'webhook': 'sync', 'events': [
+            {'action': 'create_entries', 'pks': [1, 2]},
+            {'action': 'upsert_entry', 'pks': [1]}
+        ]}, payload)
+        assert_equal(set(['res', 'other']), set(webhooks._subscriptions.call_args[0][0]))
+
+    @parameterized.expand([
+        ([], 1, True),
+        ([500, 503], 3, True),
+        ([429], 2, True),
+        ([500, 500, 500, 500], 4, False),
+        ([400], 1, False),
+        ([404], 1, False),
+        # Redirections are not followed
+        ([302], 1, False)
+    ])
+    def test_retries(self, statuses, expected_requests, expected_delivered):
+        self._server.statuses = statuses
+        dispatcher = self._dispatcher(window=60)
+        dispatcher.notify('res', {'action': 'delete_entry', 'pks': [3]})
+
+        deliveries = dispatcher.flush()
+
+        assert_equal([expected_delivered], [delivery.get(5) for delivery in deliveries])
+        assert_equal(expected_requests, len(self._server.requests))
+        metrics = stats.metrics()
+        assert_equal(expected_requests - 1, metrics.get('webhooks.retries', 0))
+        assert_equal(int(expected_delivered), metrics.get('webhooks.delivered', 0))
+        assert_equal(int(not expected_delivered), metrics.get('webhooks.failed', 0))
+
+    def test_unreachable(self):
+        webhooks._subscriptions.return_value = {'res': [('sync', 'http://127.0.0.1:1/events')]}
+        dispatcher = self._dispatcher(window=60, retries=1)
+        dispatcher.notify('res', {'action': 'delete_resource'})
+
+        assert_equal([False], [delivery.get(5) for delivery in dispatcher.flush()])
+        assert_equal(1, stats.metrics()['webhooks.failed'])
+
+    def test_private_address(self):
+        webhooks.config = {}
+        dispatcher = self._dispatcher(window=60)
+        dispatcher.notify('res', {'action': 'delete_resource'})
+
+        # The host is checked again before delivering the events
+        assert_equal([False], [delivery.get(5) for delivery in dispatcher.flush()])
+        assert_equal([], self._server.wait(1, timeout=0.1))
+        assert_equal(1, stats.metrics()['webhooks.failed'])
+
+    def test_subscriptions_error(self):
+        webhooks._subscriptions.side_effect = Exception('Database error')
+        dispatcher = self._dispatcher(window=60)
+        dispatcher.notify('res', {'action': 'delete_resource'})
+
+        assert_equal([], dispatcher.flush())
+        assert_equal([], dispatcher.flush())
+        assert_equal(1, stats.metrics()['webhooks.failed'])
+
+    @parameterized.expand([
+        ('false', 0),
+        ('true', 1)
+    ])
+    def test_notify(self, enabled, expected_batches):
+        webhooks.config = {webhooks.WEBHOOKS: enabled, webhooks.WEBHOOK_WINDOW: '0.01',
+                           webhooks.WEBHOOK_ALLOWED_HOSTS: '127.0.0.1'}
+
+        webhooks.notify('res', 'create_entries', [1, 2])
+
+        requests = self._server.wait(expected_batches, timeout=1.0 if expected_batches else 0.1)
+        assert_equal(expected_batches, len(requests))
+        if requests:
+            event = requests[0][1]['events'][0]
+            assert_equal(('create_entries', [1, 2]), (event['action'], event['pks']))
+
+    @parameterized.expand([
+        ('https://example.com/hook?token=abc', [(socket.AF_INET, '93.184.216.34')]),
+        ('http://example.com:8080/events', [(socket.AF_INET6, '2606:2800:220:1::248')]),
+        # Allowed hosts are not resolved
+        ('http://127.0.0.1:8080/events', None)
+    ])
+    def test_check_url(self, url, addresses):
+        webhooks._resolve = MagicMock(return_value=addresses)
+        webhooks.check_url(url)
+
+    @parameterized.expand([
+        ('ftp://example.com/events', [(socket.AF_INET, '93.184.216.34')]),
+        ('/events', [(socket.AF_INET, '93.184.216.34')]),
+        (None, [(socket.AF_INET, '93.184.216.34')]),
+        ('http://localhost/events', [(socket.AF_INET, '127.0.0.1'), (socket.AF_INET6, '::1')]),
+        ('http://metadata/latest', [(socket.AF_INET, '169.254.169.254')]),
+        # A single private address is enough to reject the host
+        ('http://example.com/events', [(socket.AF_INET, '93.184.216.34'), (socket.AF_INET, '10.0.0.1')]),
+        ('http://unknown.invalid/events', [])
+    ])
+    def test_check_url_invalid(self, url, addresses):
+        webhooks._resolve = MagicMock(return_value=addresses)
+        assert_raises(webhooks.plugins.toolkit.ValidationError, webhooks.check_url, url)
+
+    @parameterized.expand([
+        (socket.AF_INET, '8.8.8.8', False),
+        (socket.AF_INET, '0.0.0.0', True),
+        (socket.AF_INET, '10.1.2.3', True),
+        (socket.AF_INET, '100.64.0.1', True),
+        (socket.AF_INET, '127.0.0.1', True),
+        (socket.AF_INET, '169.254.169.254', True),
+        (socket.AF_INET, '172.15.255.255', False),
+        (socket.AF_INET, '172.16.0.1', True),
+        (socket.AF_INET, '192.168.1.1', True),
+        (socket.AF_INET, '224.0.0.1', True),
+        (socket.AF_INET, '255.255.255.255', True),
+        (socket.AF_INET6, '2001:4860:4860::8888', False),
+        (socket.AF_INET6, '::', True),
+        (socket.AF_INET6, '::1', True),
+        (socket.AF_INET6, 'fd00::1', True),
+        (socket.AF_INET6, 'fe80::1%eth0', True),
+        (socket.AF_INET6, 'ff02::1', True),
+        (socket.AF_INET6, '::ffff:127.0.0.1', True),
+        (socket.AF_INET6, '::ffff:8.8.8.8', False)
+    ])
+    def test_is_private(self, family, address, expected_private):
+        assert_equal(expected_private, webhooks._is_private(family, address))
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN DataStore Restful Extension.
+
+# CKAN DataStore Restful Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN DataStore Restful Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN DataStore Restful Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Local stand-in of the HTTP servers that receive the webhooks, so the
+deliveries can be tested without a real server.
+'''
+import BaseHTTPServer
+import SocketServer
+import json
+import threading
+import time
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+
+        with self.server.lock:
+            status = self.server.statuses.pop(0) if self.server.statuses else 200
+            self.server.requests.append((self.path, json.loads(body), status))
+            self.server.received.notify_all()
+
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class WebhookServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    '''Records the POSTed events in a background thread and replies with the
+    queued statuses (200 when there are no more)'''
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), _Handler)
+        self.statuses = []
+        self.requests = []
+        self.lock = threading.Lock()
+        self.received = threading.Condition(self.lock)
+
+    def url(self, path='/'):
+        return 'http://%s:%d%s' % (self.server_address + (path,))
+
+    def wait(self, count, timeout=5.0):
+        '''Waits until the given number of requests has been received'''
+        deadline = time.time() + timeout
+        with self.lock:
+            while len(self.requests) < count and time.time() < deadline:
+                self.received.wait(deadline - time.time())
+            return list(self.requests)
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, args=(0.01,))
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -18,6 +18,7 @@
 # along with CKAN DataStore Restful Extension.  If not, see <http://www.gnu.org/licenses/>.
 
 import cgi
+import itertools
 import operator
 import re
 
@@ -36,13 +37,23 @@ HTML = 'html'
 JSON = 'json'
 XML = 'xml'
 CSV = 'csv'
+ARROW = 'arrow'
+MSGPACK = 'msgpack'
 
 CONTENT_TYPES = {
     TEXT: 'text/plain;charset=utf-8',
     HTML: 'text/html;charset=utf-8',
     JSON: 'application/json;charset=utf-8',
     XML: 'application/xml;charset=utf-8',
-    CSV: 'text/csv;charset=utf-8'
+    CSV: 'text/csv;charset=utf-8',
+    ARROW: 'application/vnd.apache.arrow.stream',
+    MSGPACK: 'application/msgpack'
+}
+
+# Formats that depend on optional libraries
+OPTIONAL_FORMATS = {
+    ARROW: response_parser.arrow_available,
+    MSGPACK: response_parser.msgpack_available
 }
 
 
@@ -75,14 +86,30 @@ def parse_get_parameters():
     return get_parameters
 
 
-def parse_body():
+def parse_json(content):
     try:
-        return helpers.json.loads(request.body, encoding='utf-8')
+        return helpers.json.loads(content, encoding='utf-8')
     except ValueError, e:
         raise ValueError(_('JSON Error: Error decoding JSON data. '
                          'Error: %r ' % e))
 
 
+def parse_msgpack(content):
+    if not response_parser.msgpack_available():
+        raise ValueError(_('MessagePack Error: MessagePack bodies are not supported by this server'))
+    try:
+        return response_parser.msgpack_loads(content)
+    except Exception, e:
+        raise ValueError(_('MessagePack Error: Error decoding MessagePack data. '
+                         'Error: %r ' % e))
+
+
+def parse_body():
+    if request.content_type == CONTENT_TYPES[MSGPACK]:
+        return parse_msgpack(request.body)
+    return parse_json(request.body)
+
+
 def get_content_type(accepted_headers):
 
     def _get_quality(accept_entry):
@@ -95,6 +122,9 @@ def get_content_type(accepted_headers):
 
         return quality
 
+    # Optional formats are only offered when their libraries are installed
+    accepted_headers = [k for k in accepted_headers if k not in OPTIONAL_FORMATS or OPTIONAL_FORMATS[k]()]
+
     accept_header = request.headers['ACCEPT']
     accepts = accept_header.split(',')
     valid_accepts = OrderedDict()
@@ -159,10 +189,41 @@ def parse_response(data, content_type, field=None, entry=None):
         response_msg = response_parser.xml_parser(element, field_xml_name)
     elif content_type == CSV:
         response_msg = response_parser.csv_parser(data)
+    elif content_type == ARROW:
+        response_msg = response_parser.arrow_parser(data)
+    elif content_type == MSGPACK:
+        response_msg = response_parser.msgpack_parser(element)
 
     return response_msg
 
 
+def stream_response(data, content_type, field):
+    '''Returns an iterator that serializes the records of the data, which are
+    fetched in batches while the response is being written'''
+
+    records = data[field]
+
+    if content_type == JSON:
+        chunks = response_parser.json_stream_parser(records, helpers.json.dumps)
+    elif content_type == XML:
+        chunks = response_parser.xml_stream_parser(records, field)
+    elif content_type == CSV:
+        chunks = response_parser.csv_stream_parser(records)
+    elif content_type == ARROW:
+        chunks = response_parser.arrow_stream_parser(records)
+
+    return (chunk.encode('utf-8') if isinstance(chunk, unicode) else chunk for chunk in chunks)
+
+
+def set_response_headers(headers):
+    for name, value in headers.items():
+        _set_response_header(name, value)
+
+
+def get_response_headers(names):
+    return dict((name, response.headers[name]) for name in names if name in response.headers)
+
+
 def finish(status_int, response_data=None,
            content_type='text'):
     '''When a controller method has completed, call this method
@@ -179,11 +240,24 @@ def finish(status_int, response_data=None,
     if content_type == JSON and status_int == 200 and CALLBACK_PARAMETER in request.params and \
             request.method == 'GET':
             callback = cgi.escape(request.params[CALLBACK_PARAMETER])
-            response_data = _wrap_jsonp(callback, response_data)
+            if isinstance(response_data, basestring):
+                response_data = _wrap_jsonp(callback, response_data)
+            else:
+                response_data = itertools.chain([('%s(' % callback).encode('utf-8')], response_data, [');'])
 
     return response_data
 
 
+def finish_application(app):
+    '''Returns the response of a WSGI application, like the files served by
+    paste's FileApp, with its status and headers'''
+    status, headers, app_iter = request.call_application(app)
+    response.status = status
+    for name, value in headers:
+        response.headers[name] = value
+    return app_iter
+
+
 def parse_and_finish(status_int, response_data, content_type=JSON):
     parsed_data = parse_response(response_data, content_type)
     return finish(status_int, parsed_data, content_type)
@@ -0,0 +1,351 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN DataStore Restful Extension.
+
+# CKAN DataStore Restful Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN DataStore Restful Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN DataStore Restful Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import logging
+import os
+import re
+import socket
+import threading
+import time
+import urllib2
+import urlparse
+
+import ckan.plugins as plugins
+import ckanext.datastore_restful.db as db
+import ckanext.datastore_restful.stats as stats
+
+from multiprocessing.pool import ThreadPool
+from pylons import config
+
+log = logging.getLogger(__name__)
+
+# The changes of the resources are notified to the URLs subscribed to them.
+# Events are gathered by each process during a short window and delivered in
+# batches, from a pool of threads, so writes never wait for the subscribers
+
+WEBHOOKS = 'ckanext.datastore_restful.webhooks'
+WEBHOOK_WINDOW = 'ckanext.datastore_restful.webhook_window'
+DEFAULT_WEBHOOK_WINDOW = 1.0        # seconds
+WEBHOOK_THREADS = 'ckanext.datastore_restful.webhook_threads'
+DEFAULT_WEBHOOK_THREADS = 4
+WEBHOOK_RETRIES = 'ckanext.datastore_restful.webhook_retries'
+DEFAULT_WEBHOOK_RETRIES = 3
+WEBHOOK_BACKOFF = 'ckanext.datastore_restful.webhook_backoff'
+DEFAULT_WEBHOOK_BACKOFF = 1.0       # seconds, doubled after each retry
+WEBHOOK_TIMEOUT = 'ckanext.datastore_restful.webhook_timeout'
+DEFAULT_WEBHOOK_TIMEOUT = 5.0       # seconds
+WEBHOOK_ALLOWED_HOSTS = 'ckanext.datastore_restful.webhook_allowed_hosts'
+
+WEBHOOK_NAME = re.compile(r'^[A-Za-z0-9_]{1,41}$')
+WEBHOOK_SCHEMES = ['http', 'https']
+USER_AGENT = 'ckanext-datastore_restful'
+
+WEBHOOKS_TABLE = '_restful_webhooks'
+
+# Webhooks can not be sent to the network of the server, unless their host is
+# allowed, so users can not make it request its internal services
+_PRIVATE_NETWORKS = [
+    (socket.AF_INET, '0.0.0.0', 8),
+    (socket.AF_INET, '10.0.0.0', 8),
+    (socket.AF_INET, '100.64.0.0', 10),
+    (socket.AF_INET, '127.0.0.0', 8),
+    (socket.AF_INET, '169.254.0.0', 16),
+    (socket.AF_INET, '172.16.0.0', 12),
+    (socket.AF_INET, '192.168.0.0', 16),
+    (socket.AF_INET, '224.0.0.0', 3),       # Multicast and reserved
+    (socket.AF_INET6, '::', 127),           # Unspecified and loopback
+    (socket.AF_INET6, 'fc00::', 7),
+    (socket.AF_INET6, 'fe80::', 10),
+    (socket.AF_INET6, 'ff00::', 8)
+]
+_IPV4_MAPPED_PREFIX = '\0' * 10 + '\xff\xff'
+
+_lock = threading.Lock()
+_dispatchers = {}
+
+
+###############################################################################################
+#########################################  AUXILIAR  ##########################################
+###############################################################################################
+
+def _format_webhook(row):
+    return {'name': row[0], 'url': row[1], 'created': row[2].isoformat()}
+
+
+def _subscriptions(resource_ids):
+    '''Returns the URLs subscribed to each resource'''
+    connection = db.get_engine(write=True).connect()
+
+    try:
+        results = connection.execute(u'SELECT resource_id, name, url FROM "{0}" WHERE resource_id = ANY(%s)'.format(
+            WEBHOOKS_TABLE), list(resource_ids))
+        subscriptions = {}
+        for resource_id, name, url in results:
+            subscriptions.setdefault(resource_id, []).append((name, url))
+        return subscriptions
+    finally:
+        connection.close()
+
+
+def _packed_int(packed):
+    return int(packed.encode('hex'), 16)
+
+
+def _is_private(family, address):
+    packed = socket.inet_pton(family, address.split('%')[0])     # Without the scope of IPv6 addresses
+    if family == socket.AF_INET6 and packed.startswith(_IPV4_MAPPED_PREFIX):
+        family, packed = socket.AF_INET, packed[len(_IPV4_MAPPED_PREFIX):]
+
+    value, bits = _packed_int(packed), len(packed) * 8
+    return any(value >> (bits - prefix) == _packed_int(socket.inet_pton(family, network)) >> (bits - prefix)
+               for network_family, network, prefix in _PRIVATE_NETWORKS if network_family == family)
+
+
+def _resolve(host):
+    return [(info[0], info[4][0]) for info in socket.getaddrinfo(host, None)
+            if info[0] in (socket.AF_INET, socket.AF_INET6)]
+
+
+def _check_host(host):
+    if host in config.get(WEBHOOK_ALLOWED_HOSTS, '').split():
+        return
+
+    try:
+        addresses = _resolve(host)
+    except socket.error:
+        addresses = []
+
+    if not addresses:
+        raise plugins.toolkit.ValidationError({
+            'url': ['The host of the webhook could not be resolved']
+        })
+
+    if any(_is_private(family, address) for family, address in addresses):
+        raise plugins.toolkit.ValidationError({
+            'url': ['Webhooks can not be sent to private, loopback, link-local or reserved addresses']
+        })
+
+
+class _NoRedirection(urllib2.HTTPRedirectHandler):
+    # Redirections could lead to addresses that have not been checked
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+_opener = urllib2.build_opener(_NoRedirection)
+
+
+def _post(url, body, timeout):
+    request = urllib2.Request(url, body, {'Content-Type': 'application/json', 'User-Agent': USER_AGENT})
+    _opener.open(request, timeout=timeout).close()
+
+
+class Dispatcher(object):
+    '''Gathers the events of the resources during a window of time and
+    delivers them in batches to the URLs subscribed to each resource.
+    Failed deliveries are retried with an exponential backoff.'''
+
+    def __init__(self, window, threads, retries, backoff, timeout):
+        self.window = window
+        self.threads = threads
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self._condition = threading.Condition()
+        self._events = {}
+        self._pid = None
+
+    def _start(self):
+        # Threads are not inherited by the processes forked by the server
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._events = {}
+            self._pool = ThreadPool(self.threads)
+            self._flusher = threading.Thread(target=self._run, name='datastore_restful-webhooks')
+            self._flusher.daemon = True
+            self._flusher.start()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._events:
+                    self._condition.wait()
+            time.sleep(self.window)
+            self.flush()
+
+    def _deliver(self, resource_id, name, url, events):
+        body = json.dumps({'resource_id': resource_id, 'webhook': name, 'events': events})
+
+        # The host may resolve to other addresses since the webhook was created
+        try:
+            check_url(url)
+        except plugins.toolkit.ValidationError as e:
+            log.warning('Webhook %s of the resource %s can not be delivered: %s', name, resource_id, e.error_dict)
+            stats.increment('webhooks.failed')
+            return False
+
+        for attempt in range(self.retries + 1):
+            try:
+                _post(url, body, self.timeout)
+                stats.increment('webhooks.delivered')
+                return True
+            except urllib2.HTTPError as e:
+                # The request is wrong or redirected, so it would fail again
+                if e.code < 500 and e.code not in (408, 429):
+                    log.warning('Webhook %s of the resource %s rejected the events: %s', name, resource_id, e)
+                    break
+            except Exception as e:
+                log.debug('Webhook %s of the resource %s failed: %s', name, resource_id, e)
+
+            if attempt < self.retries:
+                stats.increment('webhooks.retries')
+                time.sleep(self.backoff * 2 ** attempt)
+
+        log.warning('Unable to deliver %d events to the webhook %s of the resource %s', len(events), name, resource_id)
+        stats.increment('webhooks.failed')
+        return False
+
+    def notify(self, resource_id, event):
+        with self._condition:
+            self._start()
+            self._events.setdefault(resource_id, []).append(event)
+            self._condition.notify()
+        stats.increment('webhooks.events')
+
+    def flush(self):
+        '''Sends the gathered events. Returns the pending deliveries.'''
+        with self._condition:
+            events, self._events = self._events, {}
+
+        if not events:
+            return []
+
+        try:
+            subscriptions = _subscriptions(events.keys())
+        except Exception:
+            log.exception('Unable to read the webhooks of the resources')
+            stats.increment('webhooks.failed')
+            return []
+
+        return [self._pool.apply_async(self._deliver, (resource_id, name, url, events[resource_id]))
+                for resource_id in events for name, url in subscriptions.get(resource_id, [])]
+
+
+###############################################################################################
+###########################################  MAIN  ############################################
+###############################################################################################
+
+def webhooks_enabled():
+    return config.get(WEBHOOKS, 'false').lower() in ('true', 'yes', 'on', '1')
+
+
+def get_dispatcher():
+    settings = (float(config.get(WEBHOOK_WINDOW, DEFAULT_WEBHOOK_WINDOW)),
+                int(config.get(WEBHOOK_THREADS, DEFAULT_WEBHOOK_THREADS)),
+                int(config.get(WEBHOOK_RETRIES, DEFAULT_WEBHOOK_RETRIES)),
+                float(config.get(WEBHOOK_BACKOFF, DEFAULT_WEBHOOK_BACKOFF)),
+                float(config.get(WEBHOOK_TIMEOUT, DEFAULT_WEBHOOK_TIMEOUT)))
+
+    with _lock:
+        if settings not in _dispatchers:
+            _dispatchers[settings] = Dispatcher(*settings)
+        return _dispatchers[settings]
+
+
+def notify(resource_id, action, entry_ids=None):
+    '''Notifies a committed change of a resource (and of some of its
+    entries) to its webhooks, when they are enabled'''
+    if webhooks_enabled():
+        event = {'action': action, 'timestamp': time.time()}
+        if entry_ids:
+            event['pks'] = list(entry_ids)
+        get_dispatcher().notify(resource_id, event)
+
+
+def check_url(url):
+    '''Checks that the URL is absolute and that its host is allowed or only
+    resolves to public addresses'''
+    parsed = urlparse.urlparse(url) if isinstance(url, basestring) else None
+    if parsed is None or parsed.scheme not in WEBHOOK_SCHEMES or not parsed.hostname:
+        raise plugins.toolkit.ValidationError({
+            'url': ['Webhooks must be absolute %s URLs' % ' or '.join(WEBHOOK_SCHEMES)]
+        })
+
+    _check_host(parsed.hostname)
+
+
+def create_webhooks_table():
+    '''Creates the table of the webhooks, if it does not exist. Called once,
+    when the plugin is configured.'''
+    db.create_table(WEBHOOKS_TABLE, u'''CREATE TABLE IF NOT EXISTS "{0}" (
+        resource_id text NOT NULL,
+        name text NOT NULL,
+        url text NOT NULL,
+        created timestamp NOT NULL,
+        PRIMARY KEY (resource_id, name))'''.format(WEBHOOKS_TABLE))
+
+
+def list_webhooks(resource_id, name=None):
+    connection = db.get_engine(write=True).connect()
+
+    try:
+        sql = u'SELECT name, url, created FROM "{0}" WHERE resource_id = %s'.format(WEBHOOKS_TABLE)
+        if name is None:
+            results = connection.execute(sql + u' ORDER BY name', resource_id)
+        else:
+            results = connection.execute(sql + u' AND name = %s', resource_id, name)
+        return [_format_webhook(row) for row in results]
+    finally:
+        connection.close()
+
+
+def create_webhook(resource_id, name, url):
+    '''Subscribes (or replaces) the URL of the webhook to the changes of
+    the resource'''
+    connection = db.get_engine(write=True).connect()
+
+    try:
+        trans = connection.begin()
+        try:
+            connection.execute(u'DELETE FROM "{0}" WHERE resource_id = %s AND name = %s'.format(WEBHOOKS_TABLE),
+                               resource_id, name)
+            row = connection.execute(u'INSERT INTO "{0}" VALUES (%s, %s, %s, now()) '
+                                     u'RETURNING name, url, created'.format(WEBHOOKS_TABLE),
+                                     resource_id, name, url).fetchone()
+            trans.commit()
+            return _format_webhook(row)
+        except Exception:
+            trans.rollback()
+            raise
+    finally:
+        connection.close()
+
+
+def delete_webhook(resource_id, name):
+    connection = db.get_engine(write=True).connect()
+
+    try:
+        result = connection.execute(u'DELETE FROM "{0}" WHERE resource_id = %s AND name = %s'.format(WEBHOOKS_TABLE),
+                                    resource_id, name)
+        if not result.rowcount:
+            raise plugins.toolkit.ObjectNotFound(plugins.toolkit._('Webhook "{0}" was not found.'.format(name)))
+    finally:
+        connection.close()
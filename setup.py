@@ -41,8 +41,15 @@ setup(
     install_requires=[
         # -*- Extra requirements: -*-
     ],
+    extras_require={
+        'arrow': ['pyarrow<0.17'],
+        'msgpack': ['msgpack<1.0'],
+    },
     entry_points='''
         [ckan.plugins]
         datastore_restful=ckanext.datastore_restful.plugin:RestfulDataStorePlugin
+
+        [paste.paster_command]
+        datastore_restful=ckanext.datastore_restful.commands:DatastoreRestfulCommand
     ''',
 )